@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Offline performance benchmarks for updown.py.
+
+Runs bin/updown.py in upload, download and sync mode against synthetic file trees served by the local fake dropbox
+server in fakedropbox.py and records files/sec, MB/sec and the peak RSS of the updown.py process for each run. Results
+can be saved as json and compared against a saved baseline to catch performance regressions before a release:
+
+    ./benchmark.py --output results.json
+    ./benchmark.py --baseline results.json --tolerance 20
+
+Each run uses a fresh copy of updown.py in a temporary app folder so its lock, log and state folders don't touch the
+checkout. Extra updown.py arguments (e.g. worker counts) can be passed after --, e.g. ./benchmark.py -- -uw 8
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unicodedata
+
+import fakedropbox
+
+BENCHMARK_PATH = os.path.dirname(os.path.realpath(__file__))
+UPDOWN_PATH = os.path.join(os.path.dirname(BENCHMARK_PATH), 'bin', 'updown.py')
+# the dropbox folder synced by the benchmark runs
+DROPBOX_FOLDER = 'benchmark'
+MODES = ('upload', 'download', 'sync')
+# names mixing accents in both unicode normal forms, non latin scripts and emoji
+UNICODE_NAMES = (u'café', unicodedata.normalize('NFD', u'résumé'), u'日本語',
+                 u'مرحبا', u'Привет', u'naïve \U0001f600',
+                 u'über straße', u'ελληνικά')
+
+
+# returns the (relative path, size) of the files of the named synthetic tree, scaled by the given factor
+def generate_tree(name, scale):
+    rng = random.Random(name)
+    if name == 'tiny':
+        # many tiny files spread over a few folders
+        return [('d%02d/f%05d.txt' % (i % 20, i), rng.randint(0, 4096)) for i in range(int(2000 * scale))]
+    if name == 'deep':
+        # a few files in every folder of a deep narrow tree
+        files = []
+        for branch in range(max(1, int(8 * scale))):
+            folder = 'b%d' % branch
+            for depth in range(16):
+                folder += '/l%02d' % depth
+                files.extend(('%s/f%d.dat' % (folder, i), rng.randint(0, 65536)) for i in range(4))
+        return files
+    if name == 'huge':
+        # a few files large enough to take the upload session path
+        return [('huge/h%d.bin' % i, int(48 * 1024 * 1024 * scale) + i) for i in range(3)]
+    if name == 'unicode':
+        return [(u'%s/%s %d.txt' % (UNICODE_NAMES[i % len(UNICODE_NAMES)], UNICODE_NAMES[(i * 3) % len(UNICODE_NAMES)],
+                                    i), rng.randint(0, 16384)) for i in range(int(400 * scale))]
+    raise ValueError('Unknown tree ' + name)
+
+
+# returns size bytes of random content
+def random_content(size):
+    return os.urandom(size)
+
+
+# writes the given files below the given local folder
+def write_local_tree(folder, files):
+    for relative_path, size in files:
+        full_name = os.path.join(folder, relative_path)
+        os.makedirs(os.path.dirname(full_name), exist_ok=True)
+        with open(full_name, 'wb') as f:
+            f.write(random_content(size))
+
+
+# adds the given files to the fake server below the benchmark dropbox folder
+def write_remote_tree(server, files):
+    for relative_path, size in files:
+        server.store.add_file('/%s/%s' % (DROPBOX_FOLDER, relative_path), random_content(size),
+                              '2020-01-01T00:00:00Z')
+
+
+# runs updown.py in the given mode against a fresh fake server and returns its measurements
+def run_benchmark(tree_name, files, mode, args):
+    server = fakedropbox.FakeDropboxServer(args.latency / 1000.0, args.bandwidth * 1024 * 1024, args.rate_limit)
+    server.start()
+    work_dir = tempfile.mkdtemp(prefix='updown-benchmark.')
+    try:
+        local_folder = os.path.join(work_dir, 'local')
+        os.makedirs(local_folder)
+        if mode == 'upload':
+            write_local_tree(local_folder, files)
+        elif mode == 'download':
+            write_remote_tree(server, files)
+        else:
+            # sync: half the files on each side
+            write_local_tree(local_folder, files[0::2])
+            write_remote_tree(server, files[1::2])
+
+        # a private copy of the script so that its lock / log / state folders live in the work folder
+        app_bin = os.path.join(work_dir, 'app', 'bin')
+        os.makedirs(app_bin)
+        shutil.copy(UPDOWN_PATH, app_bin)
+        command = [args.python, os.path.join(app_bin, 'updown.py'), '--token', 'benchmark', '--yes',
+                   '--' + mode] + args.updown_args + [DROPBOX_FOLDER, local_folder]
+        environment = dict(os.environ, **server.environment())
+
+        with open(os.path.join(work_dir, 'updown.out'), 'w') as output:
+            start = time.time()
+            process = subprocess.Popen(command, stdout=output, stderr=subprocess.STDOUT, env=environment)
+            _, status, usage = os.wait4(process.pid, 0)
+            seconds = time.time() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0 and args.verbose:
+            with open(os.path.join(work_dir, 'updown.out')) as output:
+                sys.stderr.write(output.read()[-4000:])
+
+        byte_count = sum(size for _, size in files)
+        return {
+            'tree': tree_name,
+            'mode': mode,
+            'files': len(files),
+            'bytes': byte_count,
+            'seconds': round(seconds, 3),
+            'files_per_sec': round(len(files) / seconds, 1),
+            'mb_per_sec': round(byte_count / seconds / (1024 * 1024), 2),
+            'peak_rss_mb': round(usage.ru_maxrss / 1024.0, 1),
+            'exit_code': process.returncode,
+            'requests': dict(server.request_counts)}
+    finally:
+        server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# returns the regressions of the given results against the given baseline results: runs whose files/sec or MB/sec
+# dropped, or whose peak RSS grew, by more than tolerance percent
+def find_regressions(results, baseline, tolerance):
+    baseline_runs = dict(((r['tree'], r['mode']), r) for r in baseline['results'])
+    regressions = []
+    for result in results:
+        before = baseline_runs.get((result['tree'], result['mode']))
+        if before is None:
+            continue
+        for key, lower_is_worse in (('files_per_sec', True), ('mb_per_sec', True), ('peak_rss_mb', False)):
+            if not before[key]:
+                continue
+            change = (result[key] - before[key]) * 100.0 / before[key]
+            if (change < -tolerance) if lower_is_worse else (change > tolerance):
+                regressions.append('{0}/{1} {2}: {3} -> {4} ({5:+.1f}%)'.format(
+                    result['tree'], result['mode'], key, before[key], result[key], change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark updown.py against a local fake dropbox server',
+                                     epilog='Arguments after -- are passed to updown.py')
+    parser.add_argument('--tree', '-t', action='append', choices=('tiny', 'deep', 'huge', 'unicode'),
+                        help='The synthetic trees to benchmark (default: all)')
+    parser.add_argument('--mode', '-m', action='append', choices=MODES, help='The modes to benchmark (default: all)')
+    parser.add_argument('--scale', type=float, default=1.0, help='Scales the file counts and sizes of the trees')
+    parser.add_argument('--latency', type=float, default=20, metavar='MS', help='Milliseconds added to every request')
+    parser.add_argument('--bandwidth', type=float, default=0, metavar='MBPS',
+                        help='Per connection bandwidth in megabytes/sec (default: unlimited)')
+    parser.add_argument('--rate-limit', type=float, default=0, metavar='P',
+                        help='The probability (0-1) of answering a request with a 429 rate limit response')
+    parser.add_argument('--python', default=sys.executable, help='The python interpreter used to run updown.py')
+    parser.add_argument('--output', '-o', metavar='FILE', help='Save the results as json to this file')
+    parser.add_argument('--baseline', '-b', metavar='FILE', help='Compare the results with these saved results')
+    parser.add_argument('--tolerance', type=float, default=15, metavar='PERCENT',
+                        help='The change against the baseline reported as a regression')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Show the output of failed updown.py runs')
+    argv = sys.argv[1:]
+    updown_args = argv[argv.index('--') + 1:] if '--' in argv else []
+    args = parser.parse_args(argv[:argv.index('--')] if '--' in argv else argv)
+    args.updown_args = updown_args
+
+    results = []
+    print('{0:<8} {1:<9} {2:>7} {3:>9} {4:>9} {5:>9} {6:>9} {7:>5}'.format(
+        'tree', 'mode', 'files', 'secs', 'files/s', 'MB/s', 'RSS MB', 'exit'))
+    for tree_name in args.tree or ('tiny', 'deep', 'huge', 'unicode'):
+        files = generate_tree(tree_name, args.scale)
+        for mode in args.mode or MODES:
+            result = run_benchmark(tree_name, files, mode, args)
+            results.append(result)
+            print('{tree:<8} {mode:<9} {files:>7} {seconds:>9} {files_per_sec:>9} {mb_per_sec:>9} {peak_rss_mb:>9} '
+                  '{exit_code:>5}'.format(**result))
+
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'settings': {'scale': args.scale, 'latency_ms': args.latency, 'bandwidth_mbps': args.bandwidth,
+                           'rate_limit': args.rate_limit, 'updown_args': args.updown_args},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    exit_code = 1 if any(r['exit_code'] != 0 for r in results) else 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            exit_code = 2
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,681 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A local stand-in for the dropbox API v2 endpoints used by updown.py, for offline benchmarking.
+
+The dropbox sdk always talks https so the server listens with a throwaway self signed certificate. Point updown.py at
+it by exporting the DROPBOX_API_HOST, DROPBOX_API_CONTENT_HOST and DROPBOX_API_NOTIFY_HOST variables returned by
+FakeDropboxServer.environment() (REQUESTS_CA_BUNDLE makes the sdk trust the certificate) before the script starts.
+
+Per request latency, per connection bandwidth and random 429 rate limit responses can be configured to approximate a
+real account. File content is kept on disk in a temporary folder so that large files don't need to fit in memory.
+"""
+
+import argparse
+import datetime
+import hashlib
+import http.server
+import itertools
+import json
+import os
+import random
+import shutil
+import socketserver
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import zipfile
+
+# block size of the dropbox content_hash algorithm
+CONTENT_HASH_BLOCK_SIZE = 4 * 1024 * 1024
+# the number of entries returned by a list_folder / list_folder/continue page
+LIST_FOLDER_PAGE_SIZE = 2000
+# data is read / written in chunks of this size, sleeping between chunks when a bandwidth limit is set
+IO_CHUNK_SIZE = 64 * 1024
+
+
+# the files, folders and upload sessions held by the fake server. Every change takes the next sequence number which
+# doubles as the file rev and as the list_folder cursor position. Removed entries are kept as deleted entries so that
+# list_folder/continue reports them
+class FakeDropboxStore(object):
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.lock = threading.Lock()
+        self.sequence = itertools.count(1)
+        self.ids = itertools.count(1)
+        # path_lower -> entry dictionary
+        self.entries = {}
+        # session id -> [data file name, offset, closed, (offset, length) of the appended chunks of a concurrent session
+        # or None]
+        self.sessions = {}
+        self.last_change = 0
+
+    # returns the file or folder entry at the given lower case path, or None
+    def get(self, path_lower):
+        with self.lock:
+            return self.get_live(path_lower)
+
+    # returns the file or folder entry at the given lower case path, or None. Callers hold the lock
+    def get_live(self, path_lower):
+        entry = self.entries.get(path_lower)
+        return entry if entry is not None and entry['.tag'] != 'deleted' else None
+
+    # creates the parent folders of the given display path that don't exist yet. Callers hold the lock
+    def ensure_parents(self, path_display):
+        parts = path_display.strip('/').split('/')[:-1]
+        for i in range(len(parts)):
+            folder = '/' + '/'.join(parts[:i + 1])
+            if self.get_live(folder.lower()) is None:
+                self.entries[folder.lower()] = {
+                    '.tag': 'folder',
+                    'name': parts[i],
+                    'path_lower': folder.lower(),
+                    'path_display': folder,
+                    'id': 'id:folder%d' % next(self.ids),
+                    'seq': self.next_sequence()}
+            elif self.entries[folder.lower()]['.tag'] != 'folder':
+                raise FakeApiError('conflict/file/', {'.tag': 'conflict', 'conflict': {'.tag': 'file'}})
+
+    # returns the next change sequence number. Callers hold the lock
+    def next_sequence(self):
+        self.last_change = next(self.sequence)
+        return self.last_change
+
+    # stores the content of the given data file (which is moved into the store) under the given path and returns the
+    # new entry. mode is the WriteMode tag of the upload. Conflicts raise a FakeApiError holding the WriteError which
+    # the route handlers wrap in their own error type
+    def commit(self, path_display, data_file_name, client_modified=None, mode='add'):
+        path_display = '/' + path_display.strip('/')
+        size = os.path.getsize(data_file_name)
+        content_hash = get_content_hash(data_file_name)
+        with self.lock:
+            existing = self.get_live(path_display.lower())
+            if existing is not None and (existing['.tag'] == 'folder' or mode == 'add'):
+                os.remove(data_file_name)
+                if existing['.tag'] == 'file' and existing['content_hash'] == content_hash:
+                    return existing
+                raise FakeApiError('conflict/%s/' % existing['.tag'], {
+                    '.tag': 'conflict', 'conflict': {'.tag': existing['.tag']}})
+            self.ensure_parents(path_display)
+            seq = self.next_sequence()
+            stored_file_name = os.path.join(self.data_dir, 'file%d' % seq)
+            shutil.move(data_file_name, stored_file_name)
+            if existing is not None:
+                os.remove(existing['data'])
+            now = format_time(datetime.datetime.utcnow())
+            entry = {
+                '.tag': 'file',
+                'name': path_display.rsplit('/', 1)[1],
+                'path_lower': path_display.lower(),
+                'path_display': path_display,
+                'id': existing['id'] if existing else 'id:file%d' % next(self.ids),
+                'client_modified': client_modified or now,
+                'server_modified': now,
+                'rev': '%09x' % seq,
+                'size': size,
+                'content_hash': content_hash,
+                'seq': seq,
+                'data': stored_file_name}
+            self.entries[path_display.lower()] = entry
+            return entry
+
+    # copies or moves the file at the given lower case path to the given display path and returns the new entry.
+    # Errors raise a FakeApiError holding the RelocationError
+    def relocate(self, from_path_lower, to_path_display, move):
+        to_path_display = '/' + to_path_display.strip('/')
+        with self.lock:
+            source = self.get_live(from_path_lower.rstrip('/'))
+            if source is None or source['.tag'] != 'file':
+                raise FakeApiError('from_lookup/not_found/', {'.tag': 'from_lookup', 'from_lookup': {
+                    '.tag': 'not_found'}})
+            if self.get_live(to_path_display.lower()) is not None:
+                raise FakeApiError('to/conflict/file/', {'.tag': 'to', 'to': {
+                    '.tag': 'conflict', 'conflict': {'.tag': 'file'}}})
+            self.ensure_parents(to_path_display)
+            seq = self.next_sequence()
+            entry = dict(source, name=to_path_display.rsplit('/', 1)[1], path_lower=to_path_display.lower(),
+                         path_display=to_path_display, rev='%09x' % seq, seq=seq,
+                         data=os.path.join(self.data_dir, 'file%d' % seq))
+            if move:
+                os.rename(source['data'], entry['data'])
+                self.delete(source)
+            else:
+                shutil.copyfile(source['data'], entry['data'])
+                entry['id'] = 'id:file%d' % next(self.ids)
+            self.entries[entry['path_lower']] = entry
+            return entry
+
+    # deletes the file or folder (with everything in it) at the given lower case path, checking the rev of a file when
+    # a parent_rev is given, and returns the deleted entry. Errors raise a FakeApiError holding the DeleteError
+    def delete_path(self, path_lower, parent_rev=None):
+        path_lower = path_lower.rstrip('/')
+        with self.lock:
+            entry = self.get_live(path_lower)
+            if entry is None:
+                raise FakeApiError('path_lookup/not_found/', {'.tag': 'path_lookup', 'path_lookup': {
+                    '.tag': 'not_found'}})
+            if parent_rev is not None and entry.get('rev') != parent_rev:
+                raise FakeApiError('path_write/conflict/file/', {'.tag': 'path_write', 'path_write': {
+                    '.tag': 'conflict', 'conflict': {'.tag': 'file'}}})
+            if entry['.tag'] == 'folder':
+                for child in [e for p, e in self.entries.items() if p.startswith(path_lower + '/')]:
+                    if child['.tag'] != 'deleted':
+                        self.delete(child)
+            self.delete(entry)
+            return entry
+
+    # creates a folder at the given display path and returns its entry. Errors raise a FakeApiError holding the
+    # WriteError
+    def create_folder(self, path_display):
+        path_display = '/' + path_display.strip('/')
+        with self.lock:
+            existing = self.get_live(path_display.lower())
+            if existing is not None:
+                raise FakeApiError('conflict/%s/' % existing['.tag'], {
+                    '.tag': 'conflict', 'conflict': {'.tag': existing['.tag']}})
+            self.ensure_parents(path_display + '/child')
+            return self.entries[path_display.lower()]
+
+    # replaces the given entry with a deleted entry. Callers hold the lock
+    def delete(self, entry):
+        self.entries[entry['path_lower']] = {
+            '.tag': 'deleted',
+            'name': entry['name'],
+            'path_lower': entry['path_lower'],
+            'path_display': entry['path_display'],
+            'seq': self.next_sequence()}
+
+    # adds a file with the given content directly, used to populate the server before download benchmarks
+    def add_file(self, path_display, data, client_modified=None):
+        fd, data_file_name = tempfile.mkstemp(dir=self.data_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return self.commit(path_display, data_file_name, client_modified, 'overwrite')
+
+    # returns one page of the entries below the given lower case folder path that changed after the given sequence
+    # number, along with the sequence number to continue from and whether more entries remain
+    def list_changes(self, path_lower, recursive, after_sequence):
+        prefix = path_lower + '/'
+        with self.lock:
+            changes = sorted((e for p, e in self.entries.items() if e['seq'] > after_sequence and p.startswith(prefix)
+                              and (recursive or '/' not in p[len(prefix):])
+                              and (after_sequence or e['.tag'] != 'deleted')), key=lambda e: e['seq'])
+            last_change = self.last_change
+        page = changes[:LIST_FOLDER_PAGE_SIZE]
+        has_more = len(changes) > LIST_FOLDER_PAGE_SIZE
+        return page, page[-1]['seq'] if has_more else max(after_sequence, last_change), has_more
+
+    # starts an upload session and returns its id
+    def start_session(self, concurrent=False):
+        fd, data_file_name = tempfile.mkstemp(dir=self.data_dir, suffix='.session')
+        os.close(fd)
+        with self.lock:
+            session_id = 'session%d' % next(self.ids)
+            self.sessions[session_id] = [data_file_name, 0, False, [] if concurrent else None]
+        return session_id
+
+    # returns the session with the given id, checking that the given offset is the next one expected. The chunks of a
+    # concurrent session may arrive in any order but must start at a multiple of CONTENT_HASH_BLOCK_SIZE
+    def get_session(self, session_id, offset):
+        with self.lock:
+            session = self.sessions.get(session_id)
+        if session is None:
+            raise FakeApiError('not_found/', {'.tag': 'not_found'})
+        if session[3] is not None:
+            if offset % CONTENT_HASH_BLOCK_SIZE:
+                raise FakeApiError('concurrent_session_invalid_offset/', {'.tag': 'concurrent_session_invalid_offset'})
+        elif offset != session[1]:
+            raise FakeApiError('incorrect_offset/', {'.tag': 'incorrect_offset', 'correct_offset': session[1]})
+        if session[2]:
+            raise FakeApiError('closed/', {'.tag': 'closed'})
+        return session
+
+    # returns the size of the data of the given closed concurrent session, checking that its chunks leave no gaps
+    def get_concurrent_session_size(self, session):
+        if not session[2]:
+            raise FakeApiError('concurrent_session_not_closed/', {'.tag': 'concurrent_session_not_closed'})
+        size = 0
+        with self.lock:
+            chunks = sorted(session[3])
+        for offset, length in chunks:
+            if offset != size:
+                raise FakeApiError('concurrent_session_missing_data/', {'.tag': 'concurrent_session_missing_data'})
+            size += length
+        return size
+
+
+# an error reported with a 409 response, the way dropbox reports route specific errors
+class FakeApiError(Exception):
+
+    def __init__(self, summary, error):
+        Exception.__init__(self, summary)
+        self.summary = summary
+        self.error = error
+
+
+# handles a single https connection. Requests are dispatched to a handle_<route> method named after the route path
+class FakeDropboxHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # responses are written as separate header and body sends; without TCP_NODELAY every response waits for the
+    # client's delayed ack
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        route = self.path.strip('/').split('/', 1)[-1]
+        server.count_request(route)
+        if server.latency:
+            time.sleep(server.latency)
+
+        body = self.read_body()
+        if server.rate_limit and random.random() < server.rate_limit:
+            server.count_request('429')
+            return self.send_json(429, {'error_summary': 'too_many_requests/',
+                                        'error': {'reason': {'.tag': 'too_many_requests'}, 'retry_after': 1}},
+                                  {'Retry-After': '1'})
+
+        handler = getattr(self, 'handle_' + route.replace('/', '_'), None)
+        if handler is None:
+            return self.send_json(400, 'Unknown route ' + route)
+        try:
+            arg = self.headers.get('Dropbox-API-Arg')
+            handler(json.loads(arg) if arg else json.loads(body or b'null'), body)
+        except FakeApiError as e:
+            self.send_json(409, {'error_summary': e.summary, 'error': e.error})
+
+    # reads the request body at the configured bandwidth
+    def read_body(self):
+        remaining = int(self.headers.get('Content-Length', 0))
+        chunks = []
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, IO_CHUNK_SIZE))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+            self.throttle(len(chunk))
+        return b''.join(chunks)
+
+    # sleeps long enough for the given number of bytes to take their share of the configured bandwidth
+    def throttle(self, byte_count):
+        if self.server.bandwidth:
+            time.sleep(byte_count / self.server.bandwidth)
+
+    def send_json(self, status, result, headers=None):
+        data = json.dumps(result).encode('utf-8') if not isinstance(result, str) else result.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json' if not isinstance(result, str) else 'text/plain')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_users_get_current_account(self, arg, body):
+        self.send_json(200, {
+            'account_id': 'dbid:' + 'A' * 35,
+            'name': {'given_name': 'Bench', 'surname': 'Mark', 'familiar_name': 'Bench',
+                     'display_name': 'Bench Mark', 'abbreviated_name': 'BM'},
+            'email': 'benchmark@example.com',
+            'email_verified': True,
+            'disabled': False,
+            'locale': 'en',
+            'referral_link': 'https://www.dropbox.com/referrals/benchmark',
+            'is_paired': False,
+            'account_type': {'.tag': 'basic'},
+            'root_info': {'.tag': 'user', 'root_namespace_id': '1', 'home_namespace_id': '1'}})
+
+    def handle_files_list_folder(self, arg, body):
+        path_lower = arg['path'].lower().rstrip('/')
+        if path_lower and (self.server.store.get(path_lower) or {}).get('.tag') != 'folder':
+            raise FakeApiError('path/not_found/', {'.tag': 'path', 'path': {'.tag': 'not_found'}})
+        self.send_list_folder_result(path_lower, arg.get('recursive', False), 0)
+
+    def handle_files_list_folder_continue(self, arg, body):
+        try:
+            path_lower, recursive, after_sequence = json.loads(arg['cursor'])
+        except ValueError:
+            raise FakeApiError('reset/', {'.tag': 'reset'})
+        self.send_list_folder_result(path_lower, recursive, after_sequence)
+
+    def handle_files_list_folder_get_latest_cursor(self, arg, body):
+        path_lower = arg['path'].lower().rstrip('/')
+        if path_lower and (self.server.store.get(path_lower) or {}).get('.tag') != 'folder':
+            raise FakeApiError('path/not_found/', {'.tag': 'path', 'path': {'.tag': 'not_found'}})
+        with self.server.store.lock:
+            last_change = self.server.store.last_change
+        self.send_json(200, {'cursor': json.dumps([path_lower, arg.get('recursive', False), last_change])})
+
+    def send_list_folder_result(self, path_lower, recursive, after_sequence):
+        page, next_sequence, has_more = self.server.store.list_changes(path_lower, recursive, after_sequence)
+        self.send_json(200, {'entries': [get_metadata(e) for e in page],
+                             'cursor': json.dumps([path_lower, recursive, next_sequence]),
+                             'has_more': has_more})
+
+    def handle_files_list_folder_longpoll(self, arg, body):
+        path_lower, recursive, after_sequence = json.loads(arg['cursor'])
+        deadline = time.time() + min(arg.get('timeout', 30), 480)
+        while time.time() < deadline:
+            if self.server.store.list_changes(path_lower, recursive, after_sequence)[0]:
+                return self.send_json(200, {'changes': True})
+            time.sleep(0.1)
+        self.send_json(200, {'changes': False})
+
+    def handle_files_upload(self, arg, body):
+        fd, data_file_name = tempfile.mkstemp(dir=self.server.store.data_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(body)
+        self.send_commit(arg, data_file_name)
+
+    def send_commit(self, commit, data_file_name):
+        try:
+            entry = self.server.store.commit(commit['path'], data_file_name, commit.get('client_modified'),
+                                             get_tag(commit.get('mode', 'add')))
+        except FakeApiError as e:
+            raise FakeApiError('path/' + e.summary, {'.tag': 'path', 'reason': e.error, 'upload_session_id': ''})
+        self.send_json(200, get_metadata(entry))
+
+    def handle_files_upload_session_start(self, arg, body):
+        concurrent = get_tag(arg.get('session_type') or 'sequential') == 'concurrent'
+        if concurrent and body:
+            raise FakeApiError('concurrent_session_data_not_allowed/', {'.tag': 'concurrent_session_data_not_allowed'})
+        session_id = self.server.store.start_session(concurrent)
+        session = self.server.store.get_session(session_id, 0)
+        self.append(session, 0, body, arg.get('close', False))
+        self.send_json(200, {'session_id': session_id})
+
+    def handle_files_upload_session_append_v2(self, arg, body):
+        session = self.server.store.get_session(arg['cursor']['session_id'], arg['cursor']['offset'])
+        self.append(session, arg['cursor']['offset'], body, arg.get('close', False))
+        self.send_json(200, None)
+
+    # writes a chunk of data to a session. The chunks of a concurrent session are written at their offset, and all but
+    # the closing chunk must be a whole number of CONTENT_HASH_BLOCK_SIZE blocks
+    def append(self, session, offset, body, close):
+        if session[3] is None:
+            with open(session[0], 'ab') as f:
+                f.write(body)
+            session[1] += len(body)
+        else:
+            if not close and len(body) % CONTENT_HASH_BLOCK_SIZE:
+                raise FakeApiError('concurrent_session_invalid_data_size/', {
+                    '.tag': 'concurrent_session_invalid_data_size'})
+            fd = os.open(session[0], os.O_WRONLY)
+            try:
+                os.pwrite(fd, body, offset)
+            finally:
+                os.close(fd)
+            with self.server.store.lock:
+                session[3].append((offset, len(body)))
+        session[2] = session[2] or close
+
+    def handle_files_upload_session_finish(self, arg, body):
+        self.send_json(200, get_metadata(self.finish_session(arg, body)))
+
+    def finish_session(self, arg, body):
+        store = self.server.store
+        session_id = arg['cursor']['session_id']
+        with store.lock:
+            session = store.sessions.get(session_id)
+        if session is None:
+            raise FakeApiError('lookup_failed/not_found/', {'.tag': 'lookup_failed',
+                                                            'lookup_failed': {'.tag': 'not_found'}})
+        if session[3] is not None:
+            if body:
+                raise FakeApiError('concurrent_session_data_not_allowed/', {
+                    '.tag': 'concurrent_session_data_not_allowed'})
+            session[1] = store.get_concurrent_session_size(session)
+        if arg['cursor']['offset'] != session[1]:
+            raise FakeApiError('lookup_failed/incorrect_offset/', {'.tag': 'lookup_failed', 'lookup_failed': {
+                '.tag': 'incorrect_offset', 'correct_offset': session[1]}})
+        with open(session[0], 'ab') as f:
+            f.write(body)
+        with store.lock:
+            store.sessions.pop(session_id, None)
+        commit = arg['commit']
+        try:
+            return store.commit(commit['path'], session[0], commit.get('client_modified'),
+                                get_tag(commit.get('mode', 'add')))
+        except FakeApiError as e:
+            raise FakeApiError('path/' + e.summary, {'.tag': 'path', 'path': e.error})
+
+    def handle_files_upload_session_finish_batch_v2(self, arg, body):
+        entries = []
+        for finish_arg in arg['entries']:
+            try:
+                entries.append(dict(get_metadata(self.finish_session(finish_arg, b'')), **{'.tag': 'success'}))
+            except FakeApiError as e:
+                entries.append({'.tag': 'failure', 'failure': e.error})
+        self.send_json(200, {'entries': entries})
+
+    def handle_files_get_metadata(self, arg, body):
+        entry = self.server.store.get(arg['path'].lower().rstrip('/'))
+        if entry is None:
+            raise FakeApiError('path/not_found/', {'.tag': 'path', 'path': {'.tag': 'not_found'}})
+        self.send_json(200, get_metadata(entry))
+
+    def handle_files_move_v2(self, arg, body):
+        entry = self.server.store.relocate(arg['from_path'].lower(), arg['to_path'], True)
+        self.send_json(200, {'metadata': get_metadata(entry)})
+
+    def handle_files_copy_batch_v2(self, arg, body):
+        entries = []
+        for relocation_path in arg['entries']:
+            try:
+                entry = self.server.store.relocate(relocation_path['from_path'].lower(), relocation_path['to_path'],
+                                                   False)
+                entries.append({'.tag': 'success', 'success': get_metadata(entry)})
+            except FakeApiError as e:
+                entries.append({'.tag': 'failure',
+                                'failure': {'.tag': 'relocation_error', 'relocation_error': e.error}})
+        self.send_json(200, {'.tag': 'complete', 'entries': entries})
+
+    def handle_files_delete_batch(self, arg, body):
+        entries = []
+        for delete_arg in arg['entries']:
+            try:
+                entry = self.server.store.delete_path(delete_arg['path'].lower(), delete_arg.get('parent_rev'))
+                entries.append({'.tag': 'success', 'metadata': get_metadata(entry)})
+            except FakeApiError as e:
+                entries.append({'.tag': 'failure', 'failure': e.error})
+        self.send_json(200, {'.tag': 'complete', 'entries': entries})
+
+    def handle_files_create_folder_batch(self, arg, body):
+        entries = []
+        for path in arg['paths']:
+            try:
+                entry = get_metadata(self.server.store.create_folder(path))
+                del entry['.tag']
+                entries.append({'.tag': 'success', 'metadata': entry})
+            except FakeApiError as e:
+                entries.append({'.tag': 'failure', 'failure': {'.tag': 'path', 'path': e.error}})
+        self.send_json(200, {'.tag': 'complete', 'entries': entries})
+
+    def handle_files_download(self, arg, body):
+        entry = self.server.store.get(arg['path'].lower())
+        if entry is None or entry['.tag'] != 'file':
+            raise FakeApiError('path/not_found/', {'.tag': 'path', 'path': {'.tag': 'not_found'}})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(entry['size']))
+        self.send_header('Dropbox-API-Result', json.dumps(get_metadata(entry), ensure_ascii=True))
+        self.end_headers()
+        self.send_data_file(entry['data'])
+
+    # sends the content of the given file at the configured bandwidth
+    def send_data_file(self, data_file_name):
+        with open(data_file_name, 'rb') as f:
+            while True:
+                chunk = f.read(IO_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                self.throttle(len(chunk))
+
+    # sends the folder with everything in it as a zip archive whose members are named relative to the parent of the
+    # folder. The archive is written to an unseekable stream, like the zip archives dropbox streams, so its members
+    # carry data descriptors
+    def handle_files_download_zip(self, arg, body):
+        store = self.server.store
+        folder = store.get(arg['path'].lower().rstrip('/'))
+        if folder is None or folder['.tag'] != 'folder':
+            raise FakeApiError('path/not_found/', {'.tag': 'path', 'path': {'.tag': 'not_found'}})
+        with store.lock:
+            entries = sorted((e for p, e in store.entries.items()
+                              if p.startswith(folder['path_lower'] + '/') and e['.tag'] != 'deleted'),
+                             key=lambda e: e['path_lower'])
+        parent_length = len(folder['path_display'].rsplit('/', 1)[0]) + 1
+        fd, zip_file_name = tempfile.mkstemp(dir=store.data_dir, suffix='.zip')
+        try:
+            with os.fdopen(fd, 'wb') as f, zipfile.ZipFile(UnseekableFile(f), 'w', zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr(folder['path_display'][parent_length:] + '/', b'')
+                for entry in entries:
+                    name = entry['path_display'][parent_length:]
+                    if entry['.tag'] == 'folder':
+                        archive.writestr(name + '/', b'')
+                    else:
+                        with open(entry['data'], 'rb') as data:
+                            archive.writestr(name, data.read())
+            metadata = get_metadata(folder)
+            del metadata['.tag']
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/zip')
+            self.send_header('Content-Length', str(os.path.getsize(zip_file_name)))
+            self.send_header('Dropbox-API-Result', json.dumps({'metadata': metadata}, ensure_ascii=True))
+            self.end_headers()
+            self.send_data_file(zip_file_name)
+        finally:
+            os.remove(zip_file_name)
+
+
+# a write only file wrapper without tell / seek
+class UnseekableFile(object):
+
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+# the https server. Holds the store, the simulated network conditions and per route request counts
+class FakeDropboxServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, bandwidth=0, rate_limit=0.0, port=0):
+        self.work_dir = tempfile.mkdtemp(prefix='fakedropbox.')
+        self.store = FakeDropboxStore(self.work_dir)
+        # seconds added to every request, bytes/sec per connection (0 for unlimited), probability of a 429
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.rate_limit = rate_limit
+        self.request_counts = {}
+        self.counts_lock = threading.Lock()
+        self.thread = None
+        http.server.HTTPServer.__init__(self, ('127.0.0.1', port), FakeDropboxHandler)
+        self.cert_file = create_certificate(self.work_dir)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.cert_file)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+
+    def count_request(self, route):
+        with self.counts_lock:
+            self.request_counts[route] = self.request_counts.get(route, 0) + 1
+
+    # returns the environment variables that make the dropbox sdk use this server
+    def environment(self):
+        host = '127.0.0.1:%d' % self.server_address[1]
+        return {'DROPBOX_API_HOST': host,
+                'DROPBOX_API_CONTENT_HOST': host,
+                'DROPBOX_API_NOTIFY_HOST': host,
+                'REQUESTS_CA_BUNDLE': self.cert_file}
+
+    # serves requests on a background thread
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='fakedropbox')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+# creates a self signed certificate for 127.0.0.1 in the given folder with the openssl cli and returns the name of the
+# pem file holding the key and certificate
+def create_certificate(folder):
+    cert_file = os.path.join(folder, 'cert.pem')
+    key_file = os.path.join(folder, 'key.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '2',
+                           '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1,DNS:localhost',
+                           '-keyout', key_file, '-out', cert_file],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    with open(key_file) as key, open(cert_file, 'a') as cert:
+        cert.write(key.read())
+    return cert_file
+
+
+# returns the dropbox api metadata of the given store entry
+def get_metadata(entry):
+    return dict((k, v) for k, v in entry.items() if k not in ('seq', 'data'))
+
+
+# returns the tag of a serialised union value such as a WriteMode
+def get_tag(value):
+    return value['.tag'] if isinstance(value, dict) else value
+
+
+# formats a datetime the way the dropbox api does
+def format_time(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+# returns the dropbox content_hash of the given file
+def get_content_hash(file_name):
+    block_hashes = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        while True:
+            block = f.read(CONTENT_HASH_BLOCK_SIZE)
+            if not block:
+                break
+            block_hashes.update(hashlib.sha256(block).digest())
+    return block_hashes.hexdigest()
+
+
+# runs the fake server standalone until interrupted
+def main():
+    parser = argparse.ArgumentParser(description='Serve a fake dropbox API for offline benchmarking')
+    parser.add_argument('--port', type=int, default=0, help='The port to listen on (default: any free port)')
+    parser.add_argument('--latency', type=float, default=0, metavar='MS', help='Milliseconds added to every request')
+    parser.add_argument('--bandwidth', type=float, default=0, metavar='MBPS',
+                        help='Per connection bandwidth in megabytes/sec (default: unlimited)')
+    parser.add_argument('--rate-limit', type=float, default=0, metavar='P',
+                        help='The probability (0-1) of answering a request with a 429 rate limit response')
+    args = parser.parse_args()
+
+    server = FakeDropboxServer(args.latency / 1000.0, args.bandwidth * 1024 * 1024, args.rate_limit, args.port)
+    for name, value in sorted(server.environment().items()):
+        print('export {0}={1}'.format(name, value))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        shutil.rmtree(server.work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Checks that a --longpoll updown.py process stops promptly on SIGTERM while it waits on files_list_folder_longpoll.
+
+Runs against the local fake dropbox server in fakedropbox.py:
+
+    python3 -m unittest test_longpoll
+
+The python interpreter used to run updown.py can be set with the UPDOWN_PYTHON environment variable.
+"""
+
+import glob
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import fakedropbox
+
+BENCHMARK_PATH = os.path.dirname(os.path.realpath(__file__))
+UPDOWN_PATH = os.path.join(os.path.dirname(BENCHMARK_PATH), 'bin', 'updown.py')
+# how long the first traversal may take and how soon the process must exit after SIGTERM
+START_TIMEOUT = 60
+STOP_TIMEOUT = 10
+
+
+class LongpollStopTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakedropbox.FakeDropboxServer().start()
+        self.server.store.add_file('/longpoll/a.txt', b'a', '2020-01-01T00:00:00Z')
+        self.work_dir = tempfile.mkdtemp(prefix='updown-test.')
+        self.local_folder = os.path.join(self.work_dir, 'local')
+        os.makedirs(self.local_folder)
+        # a private copy of the script so that its lock / log / state folders live in the work folder
+        app_bin = os.path.join(self.work_dir, 'app', 'bin')
+        os.makedirs(app_bin)
+        shutil.copy(UPDOWN_PATH, app_bin)
+        self.updown = os.path.join(app_bin, 'updown.py')
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    # starts updown.py with the given mode arguments, sends SIGTERM once a longpoll request is in flight and checks that
+    # the process exits cleanly and releases its lock in time
+    def check_stop_during_longpoll(self, *mode):
+        process = subprocess.Popen(
+            [os.environ.get('UPDOWN_PYTHON', sys.executable), self.updown, '--token', 'test', '--yes'] + list(mode) +
+            ['longpoll', self.local_folder],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=dict(os.environ, **self.server.environment()))
+        try:
+            deadline = time.time() + START_TIMEOUT
+            while not self.server.request_counts.get('files/list_folder/longpoll'):
+                self.assertIsNone(process.poll(), 'updown.py exited before longpolling')
+                self.assertLess(time.time(), deadline, 'updown.py did not start longpolling')
+                time.sleep(0.1)
+            time.sleep(1)
+
+            process.send_signal(signal.SIGTERM)
+            self.assertEqual(process.wait(STOP_TIMEOUT), 0)
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        self.assertTrue(os.path.exists(os.path.join(self.local_folder, 'a.txt')))
+        self.assertEqual(glob.glob(os.path.join(self.work_dir, 'app', 'lock', '*.lock')), [])
+
+    def test_longpoll_stops_on_sigterm(self):
+        self.check_stop_during_longpoll('--longpoll')
+
+    def test_watch_longpoll_stops_on_sigterm(self):
+        self.check_stop_during_longpoll('--watch', '--longpoll')
+
+
+if __name__ == '__main__':
+    unittest.main()
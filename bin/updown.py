@@ -10,16 +10,38 @@ https://github.com/dropbox/dropbox-sdk-python/tree/master/example
 from __future__ import print_function
 
 import argparse
+import atexit
+import builtins
+import collections
+import concurrent.futures
 import contextlib
+import ctypes
+import ctypes.util
 import datetime
+import errno
+import hashlib
+import json
 import lockfile
 import logging
+import logging.handlers
 import os
+import queue
+import random
+import re
 import requests
-import six
+import select
+import signal
+import sqlite3
+import stat
+import struct
 import sys
+import tempfile
+import threading
 import time
+import types
 import unicodedata
+import zipfile
+import zlib
 
 import dropbox
 from dropbox.files import FileMetadata
@@ -37,28 +59,198 @@ parser = argparse.ArgumentParser(description='Synchronise a local folder with a
 parser.add_argument('dropbox_folder', nargs='?', default='Downloads', help='The target folder in your Dropbox account')
 parser.add_argument('local_sync_folder', nargs='?', default='~/Downloads',
                     help='The local target folder to upload / populate from Dropbox / sync')
+parser.add_argument('--config', '-c', metavar='PATH',
+                    help='Sync every dropbox folder / local folder pair listed in this json file in a single process')
 parser.add_argument('--token', default=TOKEN, help='Access token (see https://www.dropbox.com/developers/apps)')
 parser.add_argument('--yes', '-y', action='store_true', help='Automated answer yes to all runtime prompt questions')
 parser.add_argument('--no', '-n', action='store_true', help='Automated answer no to all runtime prompt questions')
 parser.add_argument('--default', '-df', action='store_true',
                     help='Take the default answer to all runtime prompt questions')
 parser.add_argument('--hidden', '-ih', action='store_true', help='Upload hidden files')
+parser.add_argument('--ignore-file', '-if', metavar='PATH',
+                    help='Ignore the files and folders matching the rules in this file, in addition to the rules in '
+                         'the .dropboxignore file of the local folder')
 parser.add_argument('--upload', '-u', action='store_true', help='Upload mode enabled')
 parser.add_argument('--download', '-d', action='store_true', help='Download mode enabled')
 parser.add_argument('--sync', '-s', action='store_true', help='Full upload/download sync mode enabled')
+parser.add_argument('--full-scan', '-fs', action='store_true',
+                    help='Ignore the local sync state index and compare every file with dropbox')
+parser.add_argument('--dry-run', '-dr', action='store_true',
+                    help='Plan the upload / download and print the planned transfers without making any changes')
+parser.add_argument('--plan-file', metavar='PATH', help='Save the upload / download plan of this run as json')
+parser.add_argument('--mirror', '-mr', action='store_true',
+                    help='Also delete files that were deleted on the other side since the last run and create '
+                         'empty folders on dropbox')
+parser.add_argument('--watch', '-w', action='store_true',
+                    help='Keep running and upload local changes as they happen (linux inotify)')
+parser.add_argument('--watch-debounce', type=float, default=2, metavar='SECS',
+                    help='Watch mode: upload a changed file once it has been unchanged for this many seconds')
+parser.add_argument('--watch-rescan', type=float, default=60, metavar='MINS',
+                    help='Watch mode: the interval between full scans that pick up any missed changes')
+parser.add_argument('--longpoll', '-lp', action='store_true',
+                    help='Keep running and download remote changes as they happen (implies --download)')
+parser.add_argument('--quiet', '-q', action='store_true',
+                    help='Only print errors and the run summary instead of a line per file to the console')
+parser.add_argument('--progress', '-pg', action='store_true',
+                    help='Print an aggregate progress line every 10 seconds instead of a line per file to the console')
+parser.add_argument('--metrics-textfile', '-mt', metavar='PATH',
+                    help='Write per operation metrics to this prometheus node-exporter textfile (.prom)')
+parser.add_argument('--scan-workers', '-sw', type=int, default=1, metavar='N',
+                    help='The number of top level local sub folders scanned concurrently')
+parser.add_argument('--upload-workers', '-uw', type=int, default=1, metavar='N',
+                    help='The number of files uploaded in parallel, each worker using its own connection pool')
+parser.add_argument('--upload-buffer', '-ub', type=int, default=64, metavar='MB',
+                    help='The maximum number of megabytes held in memory by in flight parallel uploads')
+parser.add_argument('--upload-chunk-size', '-cs', type=int, default=8, metavar='MB',
+                    help='Files larger than 10 megabytes are uploaded in chunks of this many megabytes (a multiple of '
+                         '4, at most 148)')
+parser.add_argument('--upload-chunk-workers', '-cw', type=int, default=1, metavar='N',
+                    help='The number of chunks of a large file uploaded in parallel through a concurrent upload '
+                         'session, which starts over when interrupted (default: 1, uploading the chunks one at a time '
+                         'through a resumable upload session)')
+parser.add_argument('--batch-uploads', '-bu', action='store_true',
+                    help='Commit small file uploads in batches of up to 1000 files to avoid write rate limiting')
+parser.add_argument('--download-workers', '-dw', type=int, default=1, metavar='N',
+                    help='The number of files downloaded in parallel, each worker using its own connection pool')
+parser.add_argument('--zip-downloads', '-zd', action='store_true',
+                    help='Download folders of many small files that are mostly new locally as a single zip archive '
+                         'each instead of a request per file')
+parser.add_argument('--upload-limit', '-ul', type=float, default=0, metavar='MBPS',
+                    help='Limit uploads to this many megabytes/sec across all workers (default: unlimited)')
+parser.add_argument('--download-limit', '-dl', type=float, default=0, metavar='MBPS',
+                    help='Limit downloads to this many megabytes/sec across all workers (default: unlimited)')
+parser.add_argument('--bandwidth-schedule', '-bs', metavar='PATH',
+                    help='A file of "HH:MM-HH:MM UPLOAD DOWNLOAD" lines giving the megabytes/sec limits (0 for '
+                         'unlimited) that replace --upload-limit / --download-limit during those local times. The file '
+                         'is re-read when it changes')
 
 # globals
-processLockFile = ''
+# the lock files held by this process, one per local sync folder
+processLockFiles = []
 app_logger = None
+log_filename = None
+# the background thread writing queued log records to the log file, see start_logging
+log_listener = None
+# the log file of a run is rotated at LOG_MAX_SIZE bytes keeping LOG_BACKUP_COUNT old files. Logs older than
+# LOG_MAX_AGE days are removed from the log folder, then the oldest logs until it holds at most LOG_MAX_TOTAL_SIZE bytes
+LOG_MAX_SIZE = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_MAX_AGE = 30
+LOG_MAX_TOTAL_SIZE = 100 * 1024 * 1024
+# aggregate transfer counters printed every PROGRESS_INTERVAL seconds by --progress, see ProgressReporter
+progress = None
+PROGRESS_INTERVAL = 10
 start_time = None
 # files not supported on dropbox (https://www.dropbox.com/help/145):
 banned_files = set(['desktop.ini', 'thumbs.db', '.ds_store', 'icon\r', '.dropbox', '.dropbox.attr'])
+# the ignore rules file read from the root of each local sync folder, see IgnoreRules
+IGNORE_FILE_NAME = '.dropboxignore'
 dropbox_traverse_count = 0
+local_traverse_count = 0
+# set to stop the long running --watch / --longpoll loops
+stop_event = threading.Event()
+# per operation metrics for this run, see MetricsRegistry
+metrics = None
+# compact record of a scanned local file, stat'ed once by the scanner and carried through comparison and upload
+LocalFile = collections.namedtuple('LocalFile', ['name', 'size', 'mtime_ns', 'inode', 'device'])
+# a single step of a SyncPlan: upload, upload_overwrite, copy, move or case_conflict on the upload side, download,
+# download_overwrite or create_folder on the download side, or skip. job holds the arguments of the transfer pool call
+PlanAction = collections.namedtuple('PlanAction', ['action', 'local_path', 'dropbox_path', 'size', 'reason', 'job'])
+# (direction, local sync folder) -> the latest upload / download plan of each sync root, exported by --plan-file. Only
+# kept with --plan-file, and a --watch / --longpoll pass replaces the plan of the previous pass
+sync_plans = {}
+# local path -> (dropbox path, conflicting name, 'dropbox' or 'local') of the files not uploaded because dropbox would
+# see them as the same path as another entry, see find_case_conflict. Reported at the end of the run
+case_conflicts = {}
+# the longest files_list_folder_longpoll wait (seconds) and the delay before retrying a failed poll or traversal
+LONGPOLL_TIMEOUT = 480
+LONGPOLL_RETRY_DELAY = 60
+# linux inotify constants used by --watch, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o0004000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+# struct inotify_event header: int wd, uint32 mask, uint32 cookie, uint32 len
+INOTIFY_EVENT = struct.Struct('iIII')
+# block size of the dropbox content_hash algorithm
+CONTENT_HASH_BLOCK_SIZE = 4 * 1024 * 1024
+# files of at least CONTENT_HASH_PARALLEL_SIZE bytes have their blocks read and hashed in parallel
+CONTENT_HASH_PARALLEL_SIZE = 4 * CONTENT_HASH_BLOCK_SIZE
+# hashes the blocks of large files; hashlib releases the GIL while hashing so the threads use every core
+content_hash_executor = None
+# files larger than UPLOAD_MAX_SIZE are uploaded in an upload session, upload_chunk_size bytes (--upload-chunk-size, a
+# multiple of UPLOAD_CHUNK_SIZE) at a time
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # 4mb chunks
+UPLOAD_MAX_SIZE = 10 * 1024 * 1024  # 10mb max
+upload_chunk_size = 2 * UPLOAD_CHUNK_SIZE
+# reads the next chunk of a chunked upload from disk while the current chunk is sent, see prefetch_chunk
+upload_prefetch_executor = None
+# appends the chunks of large files to concurrent upload sessions, --upload-chunk-workers chunks of a file at a time.
+# None when chunks are uploaded one at a time through resumable sessions
+upload_chunk_executor = None
+upload_chunk_workers = 1
+# the dropbox client of each upload_chunk_executor thread, see get_upload_chunk_dbx
+upload_chunk_state = threading.local()
+# upload sessions expire after 7 days; older saved sessions aren't resumed
+UPLOAD_SESSION_MAX_AGE = 6 * 24 * 60 * 60
+# transfers larger than LARGE_TRANSFER_SIZE run on workers of their own, see SyncPlan.execute
+LARGE_TRANSFER_SIZE = UPLOAD_MAX_SIZE
+# the maximum number of upload sessions committed by a single upload_session/finish_batch call
+UPLOAD_BATCH_SIZE = 1000
+# new files of at least RELOCATE_MIN_SIZE bytes whose content is already on dropbox under another indexed path are
+# moved / copied on dropbox instead of being uploaded, copies being made RELOCATE_BATCH_SIZE files at a time
+RELOCATE_MIN_SIZE = 1024 * 1024
+RELOCATE_BATCH_SIZE = 1000
+# the maximum number of paths deleted / folders created by a single --mirror files_delete_batch /
+# files_create_folder_batch call
+MIRROR_BATCH_SIZE = 1000
+# downloads are streamed to disk DOWNLOAD_CHUNK_SIZE bytes at a time
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# with --zip-downloads a dropbox folder is downloaded as a single zip archive when at least ZIP_DOWNLOAD_MIN_FILES of
+# its files, and ZIP_DOWNLOAD_MIN_NEW_SHARE of all its files, are new locally and its files average at most
+# ZIP_DOWNLOAD_MAX_AVERAGE_SIZE bytes. files_download_zip takes folders of up to ZIP_DOWNLOAD_MAX_ENTRIES entries
+ZIP_DOWNLOAD_MIN_FILES = 50
+ZIP_DOWNLOAD_MIN_NEW_SHARE = 0.8
+ZIP_DOWNLOAD_MAX_AVERAGE_SIZE = 256 * 1024
+ZIP_DOWNLOAD_MAX_ENTRIES = 10000
+# dropbox calls failing with a rate limit, 5xx, timeout or connection error are retried up to DROPBOX_MAX_RETRIES
+# times with a jittered exponential backoff of up to DROPBOX_MAX_BACKOFF seconds (or the delay dropbox asks for)
+DROPBOX_MAX_RETRIES = 6
+DROPBOX_MIN_BACKOFF = 1
+DROPBOX_MAX_BACKOFF = 120
+# adaptive limit on the number of concurrent dropbox calls, see ConcurrencyLimiter
+concurrency_limiter = None
+# the upload / download TransferScheduler shared by every sync root and the in flight upload MemoryBudget
+transfer_schedulers = {}
+upload_buffer = None
+# upload / download bandwidth limits, see BandwidthLimiter
+bandwidth_limiter = None
+# how often (seconds) the --bandwidth-schedule file is checked for changes
+BANDWIDTH_SCHEDULE_CHECK_INTERVAL = 10
+# the process umask, applied to downloaded files as tempfile.mkstemp always creates files with mode 0600
+process_umask = os.umask(0)
+os.umask(process_umask)
+sync_state_db = None
+sync_state_lock = threading.Lock()
+sync_state_pending_writes = 0
+# the listing cursor of the upload side of a folder pair is saved under its dropbox folder with this prefix, apart from
+# the cursor of the download traversal, see list_remote_changes
+UPLOAD_CURSOR_PREFIX = 'upload:'
 
 
 # global exception handler
 def handle_exception(exc_type, exc_value, exc_traceback):
     global app_logger
+    metrics.write(force=True)
+    close_sync_state()
     releaseLock()
     logging.error('\n')
     logging.error('Caught unhandled exception', exc_info=(exc_type, exc_value, exc_traceback))
@@ -77,30 +269,69 @@ def main():
     log_info_event('Process started')
 
     args = validate_args()
+    set_console_mode(args)
 
-    dropbox_folder = args.dropbox_folder
-    local_sync_folder = os.path.expanduser(args.local_sync_folder)
-
-    if not acquireLock(local_sync_folder):
-        global processLockFile
-        abortProcess('Unable to acquireLock for ' + processLockFile + '; script is likely already running', 3)
+    global bandwidth_limiter
+    try:
+        bandwidth_limiter = BandwidthLimiter(args.upload_limit, args.download_limit, args.bandwidth_schedule)
+    except (OSError, ValueError) as err:
+        abortProcess('Unable to load --bandwidth-schedule: {0}'.format(err), 2)
 
-    dbx = dropbox.Dropbox(args.token)
+    sync_roots = load_sync_roots(args.config, args) if args.config else [args]
 
-    upload_result = (0, 0, 0)
-    if args.upload or args.sync:
-        upload_result = traverse_local_folders(dbx, local_sync_folder, dropbox_folder, args)
+    dbx = create_dropbox_client(args.token, session=dropbox.create_session(max_connections=len(sync_roots) + 1))
+    if not checkToken(dbx):
+        abortProcess('Invalid access token', 1)
 
-    download_result = (0, 0, 0)
-    if args.download or args.sync:
-        dropbox_root = dropbox_folder.replace('~', '')
-        if dropbox_root == '/':
-            dropbox_root = ''
-        download_result = traverse_dropbox_folders(dbx, dropbox_root, local_sync_folder, args)
-        if test_dropbox_folder(dbx, dropbox_root):
-            download_result = traverse_dropbox_folders(dbx, dropbox_root, local_sync_folder, args)
-        else:
-            print('unable to start dropbox files download')
+    for root_args in sync_roots:
+        local_sync_folder = os.path.expanduser(root_args.local_sync_folder)
+        if not acquireLock(local_sync_folder):
+            releaseLock()
+            abortProcess('Unable to acquireLock for ' + local_sync_folder + '; script is likely already running', 3)
+
+    metrics.textfile = args.metrics_textfile
+    metrics.labels = (
+        {'config': os.path.abspath(args.config)}
+        if args.config
+        else {'dropbox_folder': args.dropbox_folder, 'local_sync_folder': os.path.expanduser(args.local_sync_folder)})
+
+    transfer_schedulers['upload'] = TransferScheduler(args.upload_workers, 'upload')
+    transfer_schedulers['download'] = TransferScheduler(args.download_workers, 'download')
+    global upload_buffer
+    upload_buffer = MemoryBudget(args.upload_buffer * 1024 * 1024)
+    start_chunk_uploads(args)
+    # the chunk appends of the concurrent upload sessions run on threads of their own alongside the transfer workers
+    concurrency_limiter.set_maximum(args.upload_workers + args.download_workers +
+                                    (args.upload_workers * upload_chunk_workers if upload_chunk_executor else 0))
+
+    open_sync_state()
+
+    upload_result = [0, 0, 0]
+    download_result = [0, 0, 0]
+    if len(sync_roots) == 1:
+        root_upload_result, root_download_result = sync_root(dbx, sync_roots[0])
+        add_upload_result(upload_result, root_upload_result)
+        add_upload_result(download_result, root_download_result)
+    else:
+        # every root syncs on a thread of its own sharing the client, the transfer workers and the sync state index
+        if any(root_args.watch or root_args.longpoll for root_args in sync_roots):
+            install_stop_signal_handlers()
+        root_executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(sync_roots), thread_name_prefix='root')
+        root_futures = [root_executor.submit(sync_root, dbx, root_args) for root_args in sync_roots]
+        for root_args, root_future in zip(sync_roots, root_futures):
+            try:
+                root_upload_result, root_download_result = root_future.result()
+                add_upload_result(upload_result, root_upload_result)
+                add_upload_result(download_result, root_download_result)
+            except Exception as e:
+                print('*** sync of', root_args.local_sync_folder.encode('ascii', 'ignore'), 'failed', e)
+                app_logger.error('Caught an exception syncing {0}; the other roots continue'.format(
+                    root_args.local_sync_folder), exc_info=True)
+        root_executor.shutdown()
+
+    if args.plan_file:
+        write_file_atomically(args.plan_file, json.dumps({'plans': [plan.to_dict() for plan in sync_plans.values()]},
+                                                         indent=2))
 
     # process complete
     complete_process(
@@ -112,15 +343,142 @@ def main():
         download_result[2])
 
 
+# syncs a single dropbox folder / local folder pair with the given arguments and returns its upload and download
+# results
+def sync_root(dbx, args):
+    dropbox_folder = args.dropbox_folder
+    local_sync_folder = os.path.expanduser(args.local_sync_folder)
+
+    upload_result = (0, 0, 0)
+    if (args.upload or args.sync) and not args.watch:
+        upload_result = traverse_local_folders(dbx, local_sync_folder, dropbox_folder, args)
+
+    download_result = (0, 0, 0)
+    if (args.download or args.sync) and not args.longpoll:
+        dropbox_root = get_dropbox_root(dropbox_folder)
+        if test_dropbox_folder(dbx, dropbox_root):
+            download_result = traverse_dropbox_folders(dbx, dropbox_root, local_sync_folder, args)
+        else:
+            print('*** unable to start dropbox files download')
+
+    # with a --config of several roots the handlers are installed by main as signals only reach the main thread
+    if (args.watch or args.longpoll) and threading.current_thread() is threading.main_thread():
+        install_stop_signal_handlers()
+
+    if args.watch and args.longpoll:
+        # remote changes are applied on a background thread with its own client while local changes are watched
+        longpoll_results = []
+        longpoll_thread = threading.Thread(
+            target=lambda: longpoll_results.append(
+                longpoll_dropbox_folders(None, dropbox_folder, local_sync_folder, args)),
+            name='longpoll')
+        longpoll_thread.start()
+        try:
+            upload_result = watch_local_folders(dbx, local_sync_folder, dropbox_folder, args)
+        finally:
+            stop_event.set()
+            longpoll_thread.join()
+        download_result = longpoll_results[0] if longpoll_results else download_result
+    elif args.watch:
+        upload_result = watch_local_folders(dbx, local_sync_folder, dropbox_folder, args)
+    elif args.longpoll:
+        download_result = longpoll_dropbox_folders(None, dropbox_folder, local_sync_folder, args)
+
+    return upload_result, download_result
+
+
+# loads the sync roots of a --config file and returns the validated arguments of each root. The file holds a json
+# list of roots, each with a dropbox_folder, a local_sync_folder and optional extra command line options, e.g.
+#   {"roots": [{"dropbox_folder": "Photos", "local_sync_folder": "/volume1/Photos", "options": ["--sync"]},
+#              {"dropbox_folder": "Backup", "local_sync_folder": "/volume1/Backup", "options": ["--upload"]}]}
+# options not given by a root are taken from the command line. Process wide options such as the token, the worker
+# counts, --upload-buffer, the upload chunk options, the bandwidth limits and the console / metrics options always come
+# from the command line
+def load_sync_roots(config_file, args):
+    try:
+        with open(config_file) as f:
+            roots = json.load(f)['roots']
+        sync_roots = []
+        for root in roots:
+            root_args = argparse.Namespace(**vars(args))
+            parser.parse_args([str(option) for option in root.get('options', [])] +
+                              [root['dropbox_folder'], root['local_sync_folder']], root_args)
+            sync_roots.append(root_args)
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        abortProcess('Unable to load --config {0}: {1}'.format(config_file, err), 2)
+    if not sync_roots:
+        abortProcess('--config {0} has no roots'.format(config_file), 2)
+    for root_args in sync_roots:
+        check_args(root_args)
+    local_sync_folders = [os.path.realpath(os.path.expanduser(r.local_sync_folder)) for r in sync_roots]
+    if len(set(local_sync_folders)) != len(local_sync_folders):
+        abortProcess('--config {0} lists a local_sync_folder more than once'.format(config_file), 2)
+    return sync_roots
+
+
+# --quiet and --progress replace the line per file console output. print is rebound to quiet_print for this module so
+# that the per file lines cost no console io; --progress also starts the periodic progress line
+def set_console_mode(args):
+    global print
+    if args.quiet or args.progress:
+        print = quiet_print
+    if args.progress:
+        progress.start()
+
+
+# prints only error lines, which start with ***
+def quiet_print(*values, **kwargs):
+    if values and isinstance(values[0], str) and values[0].startswith('***'):
+        builtins.print(*values, **kwargs)
+
+
 # parses and validates cli arguments passed to this script
 def validate_args():
     args = parser.parse_args()
+    if args.config:
+        if (args.dropbox_folder, args.local_sync_folder) != (parser.get_default('dropbox_folder'),
+                                                             parser.get_default('local_sync_folder')):
+            abortProcess('--config can not be combined with dropbox_folder / local_sync_folder arguments', 2)
+        if not (args.yes or args.no or args.default):
+            abortProcess('--config runs its roots in parallel and requires one of --yes, --no, --default', 2)
+        return args
+    return check_args(args)
+
+
+# validates the arguments of a sync root
+def check_args(args):
     if sum([bool(b) for b in (args.yes, args.no, args.default)]) > 1:
         abortProcess('At most one of --yes, --no, --default is allowed', 2)
 
     if not args.token:
         abortProcess('--token is mandatory', 2)
 
+    if (args.watch or args.longpoll) and not (args.yes or args.no or args.default):
+        abortProcess('--watch and --longpoll run unattended and require one of --yes, --no, --default', 2)
+    if args.dry_run and (args.watch or args.longpoll):
+        abortProcess('--dry-run can not be combined with --watch or --longpoll', 2)
+
+    if args.scan_workers < 1:
+        abortProcess('--scan-workers must be at least 1', 2)
+
+    if args.upload_workers < 1:
+        abortProcess('--upload-workers must be at least 1', 2)
+
+    if args.upload_buffer < 1:
+        abortProcess('--upload-buffer must be at least 1', 2)
+
+    if args.upload_chunk_size < 4 or args.upload_chunk_size > 148 or args.upload_chunk_size % 4:
+        abortProcess('--upload-chunk-size must be a multiple of 4 between 4 and 148', 2)
+
+    if args.upload_chunk_workers < 1:
+        abortProcess('--upload-chunk-workers must be at least 1', 2)
+
+    if args.download_workers < 1:
+        abortProcess('--download-workers must be at least 1', 2)
+
+    if args.upload_limit < 0 or args.download_limit < 0:
+        abortProcess('--upload-limit and --download-limit must not be negative', 2)
+
     if args.token == '[YOUR_OAUTH2_TOKEN]':
         abortProcess(
             '--token == [YOUR_OAUTH2_TOKEN] and it needs to be correctly configured. Visit https://www.dropbox.com/developers/apps, create a new app and generate an oauth2 access token',
@@ -137,218 +495,867 @@ def validate_args():
     elif not os.path.isdir(local_sync_folder):
         abortProcess(local_sync_folder + 'is not a folder on your filesystem', 1)
 
-    dbx = dropbox.Dropbox(args.token)
-    if not checkToken(dbx):
-        abortProcess('Invalid access token', 1)
+    try:
+        args.ignore_rules = load_ignore_rules(local_sync_folder, args.ignore_file)
+    except (OSError, ValueError) as err:
+        abortProcess('Unable to load the ignore rules: {0}'.format(err), 2)
 
     return args
 
 
-# traverses local folders in the given local_sync_folder tree and uploads files
+# traverses local folders in the given local_sync_folder tree, plans the uploads and then runs the plan
 def traverse_local_folders(dbx, local_sync_folder, dropbox_folder, args):
-    upload_new_file_count = 0
-    upload_updated_file_count = 0
-    upload_byte_count = 0
-    loop_count = 0
-
-    for dn, dirs, files in os.walk(local_sync_folder):
-
-        if len(files) > 0:
-
-            sub_folder = dn[len(local_sync_folder):].strip(os.path.sep)
-            listing = list_folder(dbx, dropbox_folder, sub_folder)
-            print('Descending into', sub_folder.encode('ascii', 'ignore'), '...')
-
-            # Traverse all the files in this directory
-            for filename in files:
-
-                loop_count = check_log_runtime(loop_count, upload_new_file_count + upload_updated_file_count)
+    plan = SyncPlan('upload', args)
+    dropbox_root = get_dropbox_root(dropbox_folder)
+    plan.remote_changes, cursor = list_remote_changes(dbx, dropbox_root, local_sync_folder, args)
+    mirror = UploadMirror(dbx, local_sync_folder, dropbox_folder, args) if args.mirror and not args.dry_run else None
 
-                full_filename = os.path.join(dn, filename)
-                file_size = os.path.getsize(full_filename)
+    for dn, files, dirs in walk_local_folders(local_sync_folder, args):
 
-                if not isinstance(filename, six.text_type):
-                    filename = filename.decode('utf-8')
+        if mirror is not None:
+            mirror.add_folder(dn, files)
 
-                normalized_filename = unicodedata.normalize('NFC', filename)
-
-                if not is_existing_valid_filename(args, filename):
-                    continue
-                elif normalized_filename in listing:
-                    meta_data = listing[normalized_filename]
-                    modified_time = os.path.getmtime(full_filename)
-                    modified_datetime = datetime.datetime(*time.gmtime(modified_time)[:6])
-                    if isinstance(meta_data,
-                                  dropbox.files.FileMetadata) and modified_datetime == meta_data.client_modified and file_size == meta_data.size:
-                        print(filename.encode('ascii', 'ignore'), 'is already synced [stats match]')
-                    else:
-                        print(filename.encode('ascii', 'ignore'), 'exists with different stats, downloading')
-                        res = download(dbx, dropbox_folder, sub_folder, filename)
-                        with open(full_filename, 'rb') as f:
-                            data = f.read()
-                        if res is None:
-                            print(filename.encode('ascii', 'ignore'), 'download failure')
-                        elif res == data:
-                            print(filename.encode('ascii', 'ignore'), 'is already synced [content match]')
-                        else:
-                            print(filename.encode('ascii', 'ignore'), 'has changed since last sync')
-                            if yesno('Upload and overwrite %s' % filename, False, args):
-                                res = upload(dbx, full_filename, dropbox_folder, sub_folder, filename, overwrite=True)
-                                if res is not None:
-                                    upload_updated_file_count += 1
-                                    upload_byte_count += file_size
-
-                elif yesno('Upload and save %s' % filename, True, args):
-                    res = upload(dbx, full_filename, dropbox_folder, sub_folder, filename)
-                    if res is not None:
-                        upload_new_file_count += 1
-                        upload_byte_count += file_size
+        process_local_files(dbx, dn, files, local_sync_folder, dropbox_folder, plan, args, dirs)
 
         # Then setup the subdirectories to traverse
         keep = []
         for folder_name in dirs:
-            if not is_valid_folder(args, folder_name):
-                continue
-            elif yesno('Descend into %s' % folder_name, True, args):
+            if yesno('Descend into %s' % folder_name, True, args):
                 print('Keeping directory:', folder_name.encode('ascii', 'ignore'))
                 keep.append(folder_name)
             else:
                 print('OK, skipping directory:', folder_name.encode('ascii', 'ignore'))
         dirs[:] = keep
 
-    return upload_new_file_count, upload_updated_file_count, upload_byte_count
+    upload_result = plan.run(dbx)
+    if mirror is not None and not stop_event.is_set():
+        mirror.close()
+    # like the download cursor, the upload cursor is only advanced once every change has been applied
+    if cursor is not None and not args.dry_run and plan.failure_count == 0 and not stop_event.is_set():
+        save_sync_cursor(UPLOAD_CURSOR_PREFIX + dropbox_root, local_sync_folder, cursor)
+    return upload_result
+
+
+# returns the changes made on dropbox since the last upload traversal of the given folder pair, as a dict of the case
+# keys (see get_case_key) of the changed files -> their rev and of the deleted paths -> None, along with the listing
+# cursor to save once the upload plan has run. The changes are None when they aren't known (the saved cursor was
+# rejected or the listing failed) so that no index record is trusted, and the cursor is None when the dropbox folder
+# can't be listed, e.g. before its first upload. When the download side runs as well (--sync / --longpoll) it applies
+# the changed files, and with --mirror the deletions, so those are left out rather than uploaded over
+def list_remote_changes(dbx, dropbox_root, local_sync_folder, args):
+    downloading = args.sync or args.longpoll
+    if downloading and args.mirror:
+        return {}, None
+    changes = {}
+    cursor = None if args.full_scan else get_sync_cursor(UPLOAD_CURSOR_PREFIX + dropbox_root, local_sync_folder)
+    if cursor is not None:
+        try:
+            while True:
+                with stopwatch(None, 'list_folder'):
+                    folder_metadata = call_dropbox('list_folder', dbx.files_list_folder_continue, cursor)
+                for entry in folder_metadata.entries:
+                    if isinstance(entry, dropbox.files.FileMetadata) and not downloading:
+                        changes[get_case_key(entry.path_lower)] = entry.rev
+                    elif isinstance(entry, dropbox.files.DeletedMetadata):
+                        changes[get_case_key(entry.path_lower)] = None
+                cursor = folder_metadata.cursor
+                if not folder_metadata.has_more:
+                    return changes, cursor
+        except dropbox.exceptions.ApiError as err:
+            print('*** saved upload cursor rejected for', dropbox_root.encode('ascii', 'ignore'),
+                  '-- checking every file with dropbox:', err)
+            changes = None
+        except Exception as err:
+            print('*** files_list_folder_continue failed for', dropbox_root.encode('ascii', 'ignore'), err)
+            return None, None
+
+    try:
+        with stopwatch(None, 'list_folder'):
+            cursor = call_dropbox('list_folder', dbx.files_list_folder_get_latest_cursor, dropbox_root,
+                                  recursive=True).cursor
+    except dropbox.exceptions.ApiError:
+        cursor = None
+    except Exception as err:
+        print('*** files_list_folder_get_latest_cursor failed for', dropbox_root.encode('ascii', 'ignore'), err)
+        cursor = None
+    return changes, cursor
+
+
+# returns the rev the index record of the given dropbox path must hold to be trusted given the changes made on dropbox
+# since the last upload traversal (see list_remote_changes): None when the path is unchanged, the rev of a changed file
+# (a file this process uploaded is still trusted) or '' when the path or a parent folder was deleted, which no record
+# holds
+def get_remote_change_rev(remote_changes, dropbox_path):
+    if remote_changes is None:
+        return ''
+    if not remote_changes:
+        return None
+    path = get_case_key(dropbox_path)
+    if path in remote_changes:
+        return remote_changes[path] or ''
+    while '/' in path:
+        path = path.rsplit('/', 1)[0]
+        if path in remote_changes and remote_changes[path] is None:
+            return ''
+    return None
+
+
+# compares the given LocalFile records of the local folder dn with dropbox and adds the uploads of new and changed files
+# and the files skipped to the given upload plan. New files whose name differs only in case from a dropbox entry, a
+# local sub folder (folder_names) or another file of the folder are planned as case conflicts and not uploaded
+def process_local_files(dbx, dn, files, local_sync_folder, dropbox_folder, plan, args, folder_names=()):
+    global local_traverse_count
+
+    if len(files) == 0:
+        return
+
+    sub_folder = dn[len(local_sync_folder):].strip(os.path.sep)
+    # the remote folder is only listed once a file is found that isn't known to be in sync
+    listing = None
+    remote_names = None
+    local_names = get_case_index(folder_names)
+    print('Descending into', sub_folder.encode('ascii', 'ignore'), '...')
+
+    # Traverse all the files in this directory
+    for local_file in files:
+
+        local_traverse_count = check_log_runtime(local_traverse_count, plan.transfer_count)
+
+        filename = local_file.name
+        full_filename = os.path.join(dn, filename)
+        file_size = local_file.size
+        destination_path = get_destination_path(dropbox_folder, sub_folder, filename)
+
+        normalized_filename = unicodedata.normalize('NFC', filename)
+
+        if not args.full_scan and is_sync_state_unchanged(
+                full_filename, local_file, get_remote_change_rev(plan.remote_changes, destination_path),
+                destination_path):
+            print(filename.encode('ascii', 'ignore'), 'is already synced [index match]')
+            plan.add('skip', full_filename, destination_path, file_size, 'index match')
+            continue
+
+        if listing is None:
+            listing = list_folder(dbx, dropbox_folder, sub_folder)
+            remote_names = get_case_index(listing)
+
+        conflict = None if normalized_filename in listing else find_case_conflict(normalized_filename, remote_names,
+                                                                                  local_names)
+        local_names.setdefault(get_case_key(normalized_filename), normalized_filename)
+
+        if conflict is not None:
+            print('***', filename.encode('ascii', 'ignore'), 'conflicts with', conflict[1], conflict[0].encode(
+                'ascii', 'ignore'), 'which dropbox sees as the same name, not uploading')
+            case_conflicts[full_filename] = (destination_path,) + conflict
+            plan.add('case_conflict', full_filename, destination_path, file_size,
+                     'same name as {1} {0}'.format(*conflict))
+
+        elif normalized_filename in listing:
+            meta_data = listing[normalized_filename]
+            modified_datetime = get_local_file_modified(local_file)
+            if isinstance(meta_data,
+                          dropbox.files.FileMetadata) and modified_datetime == meta_data.client_modified and file_size == meta_data.size:
+                print(filename.encode('ascii', 'ignore'), 'is already synced [stats match]')
+                save_sync_state(full_filename, local_file, meta_data)
+                plan.add('skip', full_filename, destination_path, file_size, 'stats match')
+            else:
+                print(filename.encode('ascii', 'ignore'), 'exists with different stats, hashing')
+                if (isinstance(meta_data, dropbox.files.FileMetadata) and
+                        file_size == meta_data.size and
+                        get_content_hash(full_filename, local_file) == meta_data.content_hash):
+                    print(filename.encode('ascii', 'ignore'), 'is already synced [content match]')
+                    save_sync_state(full_filename, local_file, meta_data)
+                    plan.add('skip', full_filename, destination_path, file_size, 'content match')
+                else:
+                    print(filename.encode('ascii', 'ignore'), 'has changed since last sync')
+                    plan.add('upload_overwrite', full_filename, destination_path, file_size, 'changed since last sync',
+                             (full_filename, local_file, dropbox_folder, sub_folder, filename, True))
+
+        else:
+            relocation = find_relocation_source(full_filename, local_file) if file_size >= RELOCATE_MIN_SIZE else None
+            if relocation is None:
+                plan.add('upload', full_filename, destination_path, file_size, 'new file',
+                         (full_filename, local_file, dropbox_folder, sub_folder, filename))
+            else:
+                # files that no longer exist at their old local path are moved by --sync, which keeps both sides in
+                # step; everything else is copied, which leaves dropbox as an upload would
+                (source_local_path, source_dropbox_path), content_hash = relocation
+                move = args.sync and not os.path.lexists(source_local_path)
+                plan.add('move' if move else 'copy', full_filename, destination_path, file_size,
+                         'same content as ' + source_dropbox_path,
+                         (full_filename, local_file, dropbox_folder, sub_folder, filename, source_local_path,
+                          source_dropbox_path, content_hash))
+
+
+# long running watch mode: uploads local changes as they happen. Create, modify and move events under
+# local_sync_folder are collected with linux inotify and each changed path is uploaded once it has been quiet for
+# --watch-debounce seconds, repeated events for the same path being coalesced. A full scan runs at startup, every
+# --watch-rescan minutes and whenever the inotify event queue overflows so that no change is missed.
+# Runs until stop_event is set by SIGTERM / SIGINT and returns the accumulated upload counts
+def watch_local_folders(dbx, local_sync_folder, dropbox_folder, args):
+    upload_totals = [0, 0, 0]
+    watcher = InotifyWatcher(local_sync_folder, args)
+    # changed path -> time of the last event seen for the path
+    changed_paths = {}
+    next_full_scan = 0
+    # watches are (re)added for the whole tree at startup and after an event queue overflow
+    rewatch_tree = True
+    log_info_event('Watching ' + local_sync_folder)
+
+    while not stop_event.is_set():
+        if rewatch_tree:
+            watcher.add_tree(local_sync_folder)
+            rewatch_tree = False
+
+        if time.time() >= next_full_scan:
+            add_upload_result(upload_totals, traverse_local_folders(dbx, local_sync_folder, dropbox_folder, args))
+            commit_sync_state()
+            next_full_scan = time.time() + args.watch_rescan * 60
+
+        for path, mask in watcher.read_events(1.0):
+            if mask & IN_Q_OVERFLOW:
+                log_info_event('inotify event queue overflow; a full scan will follow')
+                next_full_scan = 0
+                rewatch_tree = True
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                # deletions aren't propagated
+                changed_paths.pop(path, None)
+            else:
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    watcher.add_tree(path)
+                changed_paths[path] = time.time()
+
+        quiet_time = time.time() - args.watch_debounce
+        quiet_paths = [path for path, event_time in changed_paths.items() if event_time <= quiet_time]
+        if quiet_paths:
+            for path in quiet_paths:
+                del changed_paths[path]
+            add_upload_result(upload_totals,
+                              upload_changed_paths(dbx, quiet_paths, local_sync_folder, dropbox_folder, args))
+            commit_sync_state()
+
+        metrics.write()
+
+    watcher.close()
+    log_info_event('Stopped watching ' + local_sync_folder)
+    return tuple(upload_totals)
+
+
+# adds a (new file count, updated file count, byte count) transfer result to the given running totals
+def add_upload_result(upload_totals, upload_result):
+    for i in range(3):
+        upload_totals[i] += upload_result[i]
+
+
+# sets stop_event on SIGTERM / SIGINT so that the long running --watch / --longpoll loops finish cleanly
+def install_stop_signal_handlers():
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signal_number, lambda signum, frame: stop_event.set())
+
+
+# uploads the given changed local paths; paths that are now folders are walked in full
+def upload_changed_paths(dbx, paths, local_sync_folder, dropbox_folder, args):
+    plan = SyncPlan('upload', args)
+    changed_files = collections.defaultdict(list)
+    changed_folders = []
+
+    for path in sorted(paths):
+        try:
+            path_stat = os.stat(path)
+        except OSError:
+            # already gone again
+            continue
+        is_folder = stat.S_ISDIR(path_stat.st_mode)
+        if not is_valid_local_path(path, is_folder, local_sync_folder, args):
+            continue
+        if is_folder:
+            changed_folders.append(path)
+        elif stat.S_ISREG(path_stat.st_mode):
+            changed_files[os.path.dirname(path)].append(stat_local_file(path, path_stat))
+
+    for dn, files in changed_files.items():
+        process_local_files(dbx, dn, files, local_sync_folder, dropbox_folder, plan, args)
+
+    for changed_folder in changed_folders:
+        for dn, files, dirs in walk_local_subtree(changed_folder, args):
+            process_local_files(dbx, dn, files, local_sync_folder, dropbox_folder, plan, args, dirs)
+
+    return plan.run(dbx)
+
+
+# returns an indicator whether the given file or folder path inside local_sync_folder passes the file and folder filters
+def is_valid_local_path(path, is_folder, local_sync_folder, args):
+    relative_path = os.path.relpath(path, local_sync_folder)
+    if relative_path == os.curdir or relative_path.startswith(os.pardir):
+        return False
+    parts = relative_path.split(os.path.sep)
+    for folder_name in parts[:-1]:
+        if not is_valid_folder(args, folder_name):
+            return False
+    if args.ignore_rules.is_ignored('/'.join(parts), is_folder):
+        return False
+    if is_folder:
+        return is_valid_folder(args, parts[-1])
+    return is_existing_valid_filename(args, parts[-1])
+
+
+# a minimal ctypes binding of the linux inotify api (see inotify(7)) watching every valid folder of a local tree
+class InotifyWatcher(object):
+
+    def __init__(self, local_sync_folder, args):
+        self.local_sync_folder = local_sync_folder
+        self.args = args
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # watch descriptor -> watched folder
+        self.watches = {}
+
+    # adds a watch for the given folder and every valid folder below it
+    def add_tree(self, top):
+        for folder, files, dirs in walk_local_subtree(top, self.args):
+            self.add_watch(folder)
+
+    # adds a watch for a single folder
+    def add_watch(self, folder):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            print('*** Unable to watch', folder.encode('ascii', 'ignore'), os.strerror(err))
+            if err == errno.ENOSPC:
+                app_logger.error('inotify watch limit reached (fs.inotify.max_user_watches); changes below {0} '
+                                 'are only picked up by the periodic full scan'.format(folder))
+            return
+        self.watches[wd] = folder
+
+    # waits up to timeout seconds for events and returns them as a list of (path, mask) tuples
+    def read_events(self, timeout):
+        events = []
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return events
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return events
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(buf):
+            wd, mask, cookie, name_length = INOTIFY_EVENT.unpack_from(buf, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(buf[offset:offset + name_length].rstrip(b'\0'))
+            offset += name_length
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            elif mask & IN_Q_OVERFLOW:
+                events.append((self.local_sync_folder, mask))
+            elif wd in self.watches:
+                events.append((os.path.join(self.watches[wd], name) if name else self.watches[wd], mask))
+        return events
+
+    # releases the inotify instance
+    def close(self):
+        os.close(self.fd)
+
+
+# walks the local folder tree top down like os.walk, yielding (folder, files, dirs) for each folder where files is a
+# list of LocalFile records and dirs a list of folder names that callers can prune in place. With --scan-workers > 1
+# the top level sub folders are scanned concurrently ahead of the caller, each by its own thread, and the results are
+# yielded in the same order as a sequential walk
+def walk_local_folders(local_sync_folder, args):
+    if args.scan_workers <= 1:
+        for item in walk_local_subtree(local_sync_folder, args):
+            yield item
+        return
+
+    files, dirs = scan_local_folder(local_sync_folder, args)
+    yield local_sync_folder, files, dirs
+
+    subtrees = collections.deque(os.path.join(local_sync_folder, d) for d in dirs)
+    running = collections.deque()
+    # folders pruned by the caller; the scanning threads have already moved past them
+    pruned = set()
+    while subtrees or running:
+        while subtrees and len(running) < args.scan_workers:
+            running.append(start_subtree_scan(subtrees.popleft(), args))
+        results = running.popleft()
+        while True:
+            item = results.get()
+            if item is None:
+                break
+            folder, files, dirs = item
+            if is_in_pruned_folder(folder, pruned, local_sync_folder):
+                continue
+            scanned_dirs = list(dirs)
+            yield folder, files, dirs
+            pruned.update(os.path.join(folder, d) for d in scanned_dirs if d not in dirs)
+
+
+# walks a single local folder tree top down in the calling thread, see walk_local_folders
+def walk_local_subtree(top, args):
+    stack = [top]
+    while stack:
+        folder = stack.pop()
+        files, dirs = scan_local_folder(folder, args)
+        yield folder, files, dirs
+        stack.extend(os.path.join(folder, d) for d in reversed(dirs))
+
+
+# starts a thread walking the given local folder tree and returns the queue it yields its results to, ending with None
+def start_subtree_scan(top, args):
+    results = queue.Queue(maxsize=1024)
+
+    def scan():
+        try:
+            for folder, files, dirs in walk_local_subtree(top, args):
+                results.put((folder, files, list(dirs)))
+        finally:
+            results.put(None)
+
+    threading.Thread(target=scan, name='scan', daemon=True).start()
+    return results
+
+
+# returns an indicator whether the given folder is inside one of the pruned folders
+def is_in_pruned_folder(folder, pruned, local_sync_folder):
+    while len(folder) > len(local_sync_folder):
+        if folder in pruned:
+            return True
+        folder = os.path.dirname(folder)
+    return False
+
+
+# scans a single local folder with os.scandir and returns (files, dirs): LocalFile records for the valid regular files
+# and the names of the valid sub folders. Names are filtered, and matched against the ignore rules, before anything is
+# stat'ed and each file is stat'ed once. Ignored folders are never scanned
+def scan_local_folder(folder, args):
+    files = []
+    dirs = []
+    ignore_rules = args.ignore_rules
+    relative_folder = os.path.relpath(folder, os.path.expanduser(args.local_sync_folder)).replace(os.path.sep, '/')
+    relative_folder = '' if relative_folder == os.curdir else relative_folder + '/'
+    try:
+        entries = os.scandir(folder)
+    except OSError as e:
+        print('*** Unable to scan', folder.encode('ascii', 'ignore'), e)
+        metrics.count_error('local_scan', e)
+        return files, dirs
+    with entries, stopwatch(None, 'local_scan'):
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    if ignore_rules.matches(relative_folder + entry.name, True):
+                        print('Skipping ignored directory:', entry.name.encode('ascii', 'ignore'))
+                    # like os.walk, symlinked folders aren't descended into
+                    elif not entry.is_symlink() and is_valid_folder(args, entry.name):
+                        dirs.append(entry.name)
+                elif ignore_rules.matches(relative_folder + entry.name, False):
+                    print('Skipping ignored file:', entry.name.encode('ascii', 'ignore'))
+                elif entry.is_file() and is_existing_valid_filename(args, entry.name):
+                    files.append(stat_local_file(entry.path, entry.stat()))
+            except OSError as e:
+                print('*** Unable to stat', entry.path.encode('ascii', 'ignore'), e)
+    return files, dirs
+
+
+# returns a LocalFile record for the given local file from its stat result, stat'ing the file if none is given
+def stat_local_file(full_filename, file_stat=None):
+    if file_stat is None:
+        file_stat = os.stat(full_filename)
+    return LocalFile(os.path.basename(full_filename), file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino,
+                     file_stat.st_dev)
+
+
+# returns the modified time of the given LocalFile as a naive utc datetime truncated to seconds like client_modified
+def get_local_file_modified(local_file):
+    return datetime.datetime(*time.gmtime(local_file.mtime_ns // 1000000000)[:6])
+
+
+# long running longpoll mode: applies remote changes as they happen. An initial traversal brings the local folder up
+# to date and saves the listing cursor, then files_list_folder_longpoll blocks until dropbox signals changes after that
+# cursor and only the changed entries are fetched with files_list_folder_continue and applied by the usual download
+# logic. Runs until stop_event is set by SIGTERM / SIGINT and returns the accumulated download counts.
+# A dbx of None creates a client of its own with a request timeout long enough for the longpoll call
+def longpoll_dropbox_folders(dbx, dropbox_folder, local_sync_folder, args):
+    download_totals = [0, 0, 0]
+    if dbx is None:
+        dbx = create_dropbox_client(args.token, timeout=LONGPOLL_TIMEOUT + 90)
+    dropbox_root = get_dropbox_root(dropbox_folder)
+    log_info_event('Longpolling ' + (dropbox_root or '/'))
+
+    changes = True
+    while not stop_event.is_set():
+        if changes:
+            download_result = traverse_dropbox_folders(dbx, dropbox_root, local_sync_folder, args)
+            add_upload_result(download_totals, download_result)
+            commit_sync_state()
+            if not download_result[3]:
+                # the traversal failed or didn't complete; retry the same changes later
+                stop_event.wait(LONGPOLL_RETRY_DELAY)
+                continue
+
+        try:
+            result = wait_for_dropbox_changes(dbx, get_sync_cursor(dropbox_root, local_sync_folder))
+            if result is None:
+                break
+        except Exception as e:
+            print('*** files_list_folder_longpoll failed for', dropbox_root.encode('ascii', 'ignore'), e)
+            app_logger.error('files_list_folder_longpoll failed for {0} {1}'.format(dropbox_root, e))
+            changes = False
+            stop_event.wait(LONGPOLL_RETRY_DELAY)
+            continue
+
+        metrics.write()
+        changes = result.changes
+        if result.backoff:
+            stop_event.wait(result.backoff)
+
+    log_info_event('Stopped longpolling ' + (dropbox_root or '/'))
+    return tuple(download_totals)
+
+
+# waits for changes below the listing cursor with files_list_folder_longpoll and returns its result, or None once
+# stop_event is set. The poll runs on a daemon thread of its own that is abandoned on stop, so that SIGTERM / SIGINT
+# end the process within a second rather than after up to LONGPOLL_TIMEOUT seconds
+def wait_for_dropbox_changes(dbx, cursor):
+    outcome = []
+    done = threading.Event()
+
+    def poll():
+        try:
+            outcome.append((dbx.files_list_folder_longpoll(cursor, timeout=LONGPOLL_TIMEOUT), None))
+        except Exception as e:
+            outcome.append((None, e))
+        finally:
+            done.set()
+
+    threading.Thread(target=poll, name='longpoll_wait', daemon=True).start()
+    while not done.wait(1):
+        if stop_event.is_set():
+            return None
+    result, err = outcome[0]
+    if err is not None:
+        raise err
+    return result
+
+
+# returns the given dropbox_folder cli argument as an api path: '' for the account root, otherwise /folder
+def get_dropbox_root(dropbox_folder):
+    dropbox_root = dropbox_folder.replace('~', '').strip('/')
+    return '/' + dropbox_root if dropbox_root else ''
 
 
 # returns an indicator whether the given path exists on dropbox
 def test_dropbox_folder(dbx, path):
     # noinspection PyBroadException
     try:
-        dbx.files_list_folder(path)
+        call_dropbox('list_folder', dbx.files_list_folder, path, limit=1)
         return True
     except:
-        print('dropbox path lookup failure for ', path.encode('ascii', 'ignore'))
+        print('*** dropbox path lookup failure for ', path.encode('ascii', 'ignore'))
         return False
 
 
-# traverses remote dropbox folders and downloads files
+# traverses the remote dropbox folder tree with a single recursive listing, plans the downloads and then runs the plan.
+# The listing cursor is saved in the sync state index per dropbox folder / local folder pair so that the next run only
+# fetches the entries that have changed since this run. Returns the new file, updated file and byte counts along with
+# an indicator whether the traversal completed and its cursor was saved
 def traverse_dropbox_folders(dbx, path, local_root_dir, args):
     global dropbox_traverse_count
-    dl_file_count = 0
-    dl_file_update_count = 0
-    dl_byte_count = 0
+    plan = SyncPlan('download', args)
     folder_metadata = None
 
-    try:
-        folder_metadata = dbx.files_list_folder(path)
-    except (dropbox.exceptions.ApiError, Exception) as err:
-        print('drop box folder traversal failure. files_list_folder failed for', path.encode('ascii', 'ignore'), err)
+    # maps lower case dropbox folder paths to correctly cased local relative folder paths
+    local_folder_names = {path.lower(): ''}
 
-    if folder_metadata is not None:
-        result = process_metadata_entries(dbx, folder_metadata.entries, path, local_root_dir, args)
-        dl_file_count += result[0]
-        dl_file_update_count += result[1]
-        dl_byte_count += result[2]
-
-    while folder_metadata is not None and folder_metadata.has_more:
-        folder_metadata = None
+    # deletions are only applied by --mirror once every change of the traversal has been applied
+    mirror = None
 
+    cursor = None if args.full_scan else get_sync_cursor(path, local_root_dir)
+    if cursor is not None:
+        try:
+            with stopwatch(None, 'list_folder'):
+                folder_metadata = call_dropbox('list_folder', dbx.files_list_folder_continue, cursor)
+            plan.incremental = True
+        except dropbox.exceptions.ApiError as err:
+            print('saved cursor rejected for', path.encode('ascii', 'ignore'), '-- starting a full listing:', err)
+        except Exception as err:
+            print('*** files_list_folder_continue failed for', path.encode('ascii', 'ignore'), err)
+            return plan.run(dbx) + (False,)
+
+    if args.mirror and not args.dry_run:
+        mirror = DownloadMirror(path, local_root_dir, folder_metadata is None, args)
+
+    if folder_metadata is None:
         try:
-            folder_metadata = dbx.files_list_folder_continue(folder_metadata.cursor)
-        except (dropbox.files.ListFolderContinueError, Exception) as err:
-            print('files_list_folder_continue failed for', path.encode('ascii', 'ignore'), err)
+            with stopwatch(None, 'list_folder'):
+                folder_metadata = call_dropbox('list_folder', dbx.files_list_folder, path, recursive=True)
+        except (dropbox.exceptions.ApiError, Exception) as err:
+            print('*** drop box folder traversal failure. files_list_folder failed for', path.encode('ascii', 'ignore'),
+                  err)
+            return plan.run(dbx) + (False,)
 
-        if folder_metadata is not None:
-            sub_traverse = process_metadata_entries(dbx, folder_metadata.entries, path, local_root_dir, args)
-            dl_file_count += sub_traverse[0]
-            dl_file_update_count += sub_traverse[1]
-            dl_byte_count += sub_traverse[2]
+    while True:
+        if mirror is not None:
+            mirror.add_entries(folder_metadata.entries)
 
-    dropbox_traverse_count = check_log_runtime(dropbox_traverse_count, dl_file_count + dl_file_update_count, 1000, 300)
+        process_metadata_entries(dbx, folder_metadata.entries, path, local_root_dir, local_folder_names, plan, args)
 
-    return dl_file_count, dl_file_update_count, dl_byte_count, dropbox_traverse_count
+        dropbox_traverse_count = check_log_runtime(dropbox_traverse_count, plan.transfer_count, 1000, 300)
 
+        if not folder_metadata.has_more:
+            break
 
-# processes remote dropbox file and folder metadata
-def process_metadata_entries(dbx, entries, path, local_root_dir, args):
-    dl_file_count = 0
-    dl_file_update_count = 0
-    dl_byte_count = 0
+        try:
+            with stopwatch(None, 'list_folder'):
+                folder_metadata = call_dropbox('list_folder', dbx.files_list_folder_continue, folder_metadata.cursor)
+        except (dropbox.exceptions.ApiError, Exception) as err:
+            print('*** files_list_folder_continue failed for', path.encode('ascii', 'ignore'), err)
+            return plan.run(dbx) + (False,)
+
+    download_result = plan.run(dbx)
+    if args.dry_run:
+        return download_result + (False,)
+
+    # the cursor is only advanced when every change was applied so that failed downloads are retried next run
+    if plan.failure_count == 0:
+        if mirror is not None:
+            mirror.close()
+        save_sync_cursor(path, local_root_dir, folder_metadata.cursor)
+    else:
+        print('***', plan.failure_count, 'downloads failed; the saved listing cursor has not been advanced')
+
+    return download_result + (plan.failure_count == 0,)
+
+
+# returns the full local path for the given dropbox metadata entry of a recursive listing of dropbox_root
+def get_local_path(entry, dropbox_root, local_root_dir, local_folder_names):
+    parent_path_lower = entry.path_lower.rsplit('/', 1)[0]
+    if parent_path_lower in local_folder_names:
+        local_parent = local_folder_names[parent_path_lower]
+    else:
+        # only the last component of path_display is guaranteed to be correctly cased
+        local_parent = entry.path_display.rsplit('/', 1)[0][len(dropbox_root):].strip('/')
+    local_relative_path = '/'.join(p for p in (local_parent, entry.name) if p)
+    if isinstance(entry, dropbox.files.FolderMetadata):
+        local_folder_names[entry.path_lower] = local_relative_path
+    return os.path.join(local_root_dir, local_relative_path.replace('/', os.path.sep))
 
-    dropbox_root_folder = args.dropbox_folder.strip('~')
 
+# compares remote dropbox file and folder metadata returned by a recursive listing with the local files and adds the
+# downloads of new and changed files, the local folders to create and the files skipped to the given download plan
+def process_metadata_entries(dbx, entries, dropbox_root, local_root_dir, local_folder_names, plan, args):
     for entry in entries:
 
-        if isinstance(entry, dropbox.files.FolderMetadata):
+        # the listed folder itself is included in a recursive listing
+        if entry.path_lower == dropbox_root.lower():
+            continue
 
-            # folder traversal
-            full_dropbox_folder_name = os.path.join(path, entry.name.strip('/'))
+        if isinstance(entry, dropbox.files.FolderMetadata):
 
+            # folder
             try:
 
-                print('folder: %s' % full_dropbox_folder_name.encode('ascii', 'ignore'))
+                print('folder: %s' % entry.path_display.encode('ascii', 'ignore'))
 
-                trimmed_dropbox_folder_name = (
-                    full_dropbox_folder_name[len(dropbox_root_folder):].strip('/')
-                    if dropbox_root_folder != '/'
-                    else full_dropbox_folder_name.strip('/'))
-
-                full_local_folder_name = os.path.join(local_root_dir, trimmed_dropbox_folder_name)
+                full_local_folder_name = get_local_path(entry, dropbox_root, local_root_dir, local_folder_names)
+                if is_ignored_local_path(full_local_folder_name, True, local_root_dir, args):
+                    print('Skipping ignored folder: %s' % entry.path_display.encode('ascii', 'ignore'))
+                    plan.ignored_folders.add(entry.path_lower.rsplit('/', 1)[0])
+                    continue
+                # the folder is recorded in the sync state index once it exists locally, see SyncPlan.execute
                 if not os.path.exists(full_local_folder_name):
-                    ensure_and_get_folder(full_local_folder_name, False)
-
-                if path == '':
-                    path = '/'
-                sub_traverse = traverse_dropbox_folders(dbx, os.path.join(path, entry.name), local_root_dir, args)
-                dl_file_count += sub_traverse[0]
-                dl_file_update_count += sub_traverse[1]
-                dl_byte_count += sub_traverse[2]
+                    plan.add('create_folder', full_local_folder_name, entry.path_display, 0, 'new folder')
+                elif not args.dry_run:
+                    save_sync_folder(full_local_folder_name, entry.path_display)
 
             except UnicodeEncodeError:
-                print('folder: %s caused a UnicodeEncodeError' % full_dropbox_folder_name.encode('ascii', 'ignore'))
+                print('*** folder: %s caused a UnicodeEncodeError' % entry.path_display.encode('ascii', 'ignore'))
 
                 log_info_event(
                     'Unable to download and save this folder due to a UnicodeEncodeError. ' +
                     'Check this folder path (invalid chars have been stripped): ' +
-                    full_dropbox_folder_name.encode('ascii', 'ignore'))
+                    entry.path_display.encode('ascii', 'ignore').decode('ascii'))
 
-        else:
+        elif isinstance(entry, dropbox.files.FileMetadata):
 
-            # file traversal
-            full_dropbox_filename = os.path.join(path, entry.name.strip('/'))
+            # file
+            full_dropbox_filename = entry.path_display
 
             try:
 
                 print('file: %s' % full_dropbox_filename.encode('ascii', 'ignore'))
 
-                trimmed_dropbox_filename = full_dropbox_filename[len(dropbox_root_folder):].strip('/')
-
-                full_local_filename = os.path.join(local_root_dir, trimmed_dropbox_filename)
+                full_local_filename = get_local_path(entry, dropbox_root, local_root_dir, local_folder_names)
+                if is_ignored_local_path(full_local_filename, False, local_root_dir, args):
+                    print('Skipping ignored file: %s' % full_dropbox_filename.encode('ascii', 'ignore'))
+                    plan.ignored_folders.add(entry.path_lower.rsplit('/', 1)[0])
+                    continue
 
-                if not os.path.exists(full_local_filename):
-                    if yesno('Download and save %s' % full_dropbox_filename, True, args):
-                        file_data = download_and_save(dbx, full_dropbox_filename, full_local_filename)
-                        if file_data is not None:
-                            dl_file_count += 1
-                            dl_byte_count += len(file_data)
+                try:
+                    local_file = stat_local_file(full_local_filename)
+                except OSError:
+                    local_file = None
+
+                if local_file is None:
+                    plan.add('download', full_local_filename, full_dropbox_filename, entry.size, 'new file',
+                             (entry.path_lower, full_local_filename, False, entry))
+                elif not args.full_scan and is_sync_state_unchanged(full_local_filename, local_file, entry.rev,
+                                                                    entry.path_display):
+                    print('file: %s is already synced [index match]' % full_dropbox_filename.encode('ascii', 'ignore'))
+                    plan.add('skip', full_local_filename, full_dropbox_filename, entry.size, 'index match')
+                elif entry.client_modified > get_local_file_modified(local_file):
+                    if (local_file.size == entry.size and
+                            get_content_hash(full_local_filename, local_file) == entry.content_hash):
+                        print('file: %s is already synced [content match]' %
+                              full_dropbox_filename.encode('ascii', 'ignore'))
+                        save_sync_state(full_local_filename, local_file, entry)
+                        plan.add('skip', full_local_filename, full_dropbox_filename, entry.size, 'content match')
+                    else:
+                        plan.add('download_overwrite', full_local_filename, full_dropbox_filename, entry.size,
+                                 'newer on dropbox', (entry.path_lower, full_local_filename, True, entry))
                 else:
-                    local_file_modified_time = os.path.getmtime(full_local_filename)
-                    local_file_modified_datetime = datetime.datetime(*time.gmtime(local_file_modified_time)[:6])
-                    if entry.client_modified > local_file_modified_datetime:
-                        if yesno('Download and overwrite %s' % full_dropbox_filename, True, args):
-                            file_data = download_and_save(dbx, full_dropbox_filename, full_local_filename)
-                            if file_data is not None:
-                                dl_file_update_count += 1
-                                dl_byte_count += len(file_data)
+                    plan.add('skip', full_local_filename, full_dropbox_filename, entry.size,
+                             'local file is the same age or newer')
 
             except UnicodeEncodeError:
-                print('file: %s caused a UnicodeEncodeError' % full_dropbox_filename.encode('ascii', 'ignore'))
+                print('*** file: %s caused a UnicodeEncodeError' % full_dropbox_filename.encode('ascii', 'ignore'))
 
                 log_info_event(
                     'Unable to download and save this file due to a UnicodeEncodeError. ' +
                     'Check this file path (invalid chars have been stripped): ' +
-                    full_dropbox_filename.encode('ascii', 'ignore'))
+                    full_dropbox_filename.encode('ascii', 'ignore').decode('ascii'))
+
+
+# returns an indicator whether the given path inside local_root_dir, or one of its parent folders, is ignored by the
+# ignore rules of the sync root
+def is_ignored_local_path(path, is_folder, local_root_dir, args):
+    return args.ignore_rules.is_ignored(os.path.relpath(path, local_root_dir).replace(os.path.sep, '/'), is_folder)
+
+
+# returns the IgnoreRules of the given local sync folder: the rules of its .dropboxignore file, if any, followed by the
+# rules of the given ignore_file
+def load_ignore_rules(local_sync_folder, ignore_file):
+    lines = []
+    for file_name in (os.path.join(local_sync_folder, IGNORE_FILE_NAME), ignore_file):
+        if file_name and (file_name == ignore_file or os.path.isfile(file_name)):
+            with open(file_name, encoding='utf-8') as f:
+                lines.extend((file_name, line_number, line) for line_number, line in enumerate(f, 1))
+    return IgnoreRules(lines)
+
+
+# .dropboxignore style rules compiled once into a single regular expression per entry type. Each line of a rules file
+# is one rule, matched against paths relative to the local sync folder, and the last matching rule decides:
+#   *.iso               a glob without a / matches the name at any depth
+#   photos/@eaDir/      a glob with a / matches the relative path; a trailing / only matches folders
+#   docs/**/*.tmp       ** matches any number of folders
+#   re:.*/cache/\d+     a regular expression matching the whole relative path
+#   !keep.iso           a leading ! re-includes what earlier rules ignored
+# blank lines and lines starting with # are skipped. Everything below an ignored folder is ignored and never scanned
+class IgnoreRules(object):
+
+    def __init__(self, lines):
+        # (rule regex, negated, folders only) per rule
+        rules = []
+        for file_name, line_number, line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                rules.append(compile_ignore_rule(unicodedata.normalize('NFC', line)))
+            except re.error as err:
+                raise ValueError('{0} line {1}: invalid rule "{2}": {3}'.format(file_name, line_number, line, err))
+        self.rules = rules
+        # the rules are tried last to first so that the first alternative matching is the last matching rule
+        try:
+            self.matchers = dict((is_folder, self.compile_matcher([i for i, rule in enumerate(rules)
+                                                                   if is_folder or not rule[2]]))
+                                 for is_folder in (False, True))
+        except re.error as err:
+            raise ValueError('the ignore rules can not be combined, re: rules can not use group names or numbered '
+                             'back references: {0}'.format(err))
+        # relative folder path -> whether the folder or one of its parents is ignored
+        self.ignored_folders = {}
+
+    # returns the combined regex of the given rules and their indexes in matching order or None when there are none
+    def compile_matcher(self, rule_indexes):
+        if not rule_indexes:
+            return None
+        rule_indexes = rule_indexes[::-1]
+        pattern = '|'.join('(?P<ignore_rule_%d>%s)' % (i, self.rules[i][0]) for i in rule_indexes)
+        return re.compile(pattern), rule_indexes
+
+    # returns an indicator whether the given relative path itself is ignored by the rules
+    def matches(self, relative_path, is_folder):
+        matcher = self.matchers[is_folder]
+        if matcher is None:
+            return False
+        regex, rule_indexes = matcher
+        match = regex.fullmatch(unicodedata.normalize('NFC', relative_path))
+        if match is None:
+            return False
+        rule_index = next(i for i in rule_indexes if match.group('ignore_rule_%d' % i) is not None)
+        return not self.rules[rule_index][1]
 
-    return dl_file_count, dl_file_update_count, dl_byte_count
+    # returns an indicator whether the given relative path or one of its parent folders is ignored by the rules
+    def is_ignored(self, relative_path, is_folder):
+        if not self.rules:
+            return False
+        parent_folder = relative_path.rpartition('/')[0]
+        if parent_folder and self.is_ignored(parent_folder, True):
+            return True
+        if not is_folder:
+            return self.matches(relative_path, False)
+        ignored = self.ignored_folders.get(relative_path)
+        if ignored is None:
+            ignored = self.ignored_folders[relative_path] = self.matches(relative_path, True)
+        return ignored
+
+
+# compiles a single ignore rule line into a (regex, negated, folders only) tuple, see IgnoreRules
+def compile_ignore_rule(line):
+    negated = line.startswith('!')
+    if negated:
+        line = line[1:]
+    if line.startswith('re:'):
+        regex = line[3:]
+        re.compile(regex)
+        return '(?:%s)' % regex, negated, False
+    folders_only = line.endswith('/')
+    line = line.rstrip('/')
+    if '/' in line:
+        return translate_glob(line.lstrip('/')), negated, folders_only
+    return '(?:.*/)?' + translate_glob(line), negated, folders_only
+
+
+# translates a glob into a regex: * and ? match within a single path component, ** across components and [...] a
+# character set
+def translate_glob(glob):
+    regex = []
+    i = 0
+    while i < len(glob):
+        c = glob[i]
+        if glob.startswith('**/', i):
+            regex.append('(?:.*/)?')
+            i += 3
+            continue
+        if glob.startswith('**', i):
+            regex.append('.*')
+            i += 2
+            continue
+        if c == '*':
+            regex.append('[^/]*')
+        elif c == '?':
+            regex.append('[^/]')
+        elif c == '[' and ']' in glob[i + 2:]:
+            end = glob.index(']', i + 2)
+            characters = glob[i + 1:end].replace('\\', '\\\\')
+            regex.append('[' + ('^' + characters[1:] if characters.startswith('!') else characters) + ']')
+            i = end
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    return ''.join(regex)
 
 
 # performs a few tests on the given filename to determine whether the filename represents a valid existing file
@@ -393,6 +1400,45 @@ def is_hidden(item, args):
         return False
 
 
+# returns the dropbox case key of a name: dropbox paths are case insensitive, so names with the same case folded NFC
+# form can't be siblings in a dropbox folder
+def get_case_key(name):
+    return unicodedata.normalize('NFC', unicodedata.normalize('NFC', name).casefold())
+
+
+# returns a dictionary mapping the case keys of the given names to the first name with that key
+def get_case_index(names):
+    case_index = {}
+    for name in names:
+        case_index.setdefault(get_case_key(name), unicodedata.normalize('NFC', name))
+    return case_index
+
+
+# returns the (name, 'dropbox' or 'local') of the dropbox entry or local sibling whose name differs from the given NFC
+# file name only in case, or None. remote_names and local_names are get_case_index dictionaries of a dropbox folder
+# listing and of the local names of the folder planned so far
+def find_case_conflict(filename, remote_names, local_names):
+    case_key = get_case_key(filename)
+    for names, side in ((remote_names, 'dropbox'), (local_names, 'local')):
+        name = names.get(case_key)
+        if name is not None and name != filename:
+            return name, side
+    return None
+
+
+# prints the files that weren't uploaded because of case conflicts as a single report and logs it
+def report_case_conflicts():
+    if not case_conflicts:
+        return
+    lines = ['{0} -> {1}: same name as {3} {2}'.format(local_path, *conflict)
+             for local_path, conflict in sorted(case_conflicts.items())]
+    builtins.print('*** Case conflicts: {0} files were not uploaded as dropbox sees their name as the same as another '
+                   'entry (see https://www.dropbox.com/en/help/145)'.format(len(lines)))
+    for line in lines:
+        builtins.print('***   ', line.encode('ascii', 'ignore'))
+    app_logger.warning('Case conflicts: {0} files were not uploaded\n{1}'.format(len(lines), '\n'.join(lines)))
+
+
 # lists a folder and return a dictionary mapping unicode filenames to FileMetadata|FolderMetadata entries.
 def list_folder(dbx, folder, subfolder):
     global app_logger
@@ -401,13 +1447,18 @@ def list_folder(dbx, folder, subfolder):
         path = path.replace('//', '/')
     path = path.rstrip('/')
     try:
-        with stopwatch('list_folder'):
-            res = dbx.files_list_folder(path)
+        with stopwatch('list_folder', 'list_folder'):
+            res = call_dropbox('list_folder', dbx.files_list_folder, path)
     except dropbox.exceptions.ApiError as err:
-        print('Folder listing failed for', path.encode('ascii', 'ignore'), '-- assumped empty:', err)
+        # a local folder that isn't on dropbox yet is the normal case of a new folder, not an error
+        if err.error.is_path() and err.error.get_path().is_not_found():
+            print('Folder', path.encode('ascii', 'ignore'), 'not found on dropbox -- assumped empty')
+            return {}
+        print('*** Folder listing failed for', path.encode('ascii', 'ignore'), '-- assumped empty:', err)
+        app_logger.error('Folder listing failed for {0} {1}'.format(path, err))
         return {}
     except Exception as e:
-        print('Folder listing exception for', path.encode('ascii', 'ignore'), '-- assumped empty:', e)
+        print('*** Folder listing exception for', path.encode('ascii', 'ignore'), '-- assumped empty:', e)
         app_logger.error('Folder listing failed for {0} {1}'.format(path, e))
         return {}
     else:
@@ -417,20 +1468,57 @@ def list_folder(dbx, folder, subfolder):
         return rv
 
 
-# attempts a file download from dropbox and return the bytes of the file or None if it doesn't exist.
-def download(dbx, folder, sub_folder, name):
-    path = '/%s/%s/%s' % (folder, sub_folder.replace(os.path.sep, '/'), name)
-    while '//' in path:
-        path = path.replace('//', '/')
-    with stopwatch('download'):
+# returns the dropbox content_hash of the given local file: the sha256 of the concatenated sha256 digests of each 4mb
+# block of the file (see https://www.dropbox.com/developers/reference/content-hash). Hashes are cached in the sync
+# state index by device, inode, size and mtime so that an unchanged file is never hashed twice
+def get_content_hash(full_filename, local_file=None):
+    if local_file is None:
+        local_file = stat_local_file(full_filename)
+    content_hash = get_cached_content_hash(local_file)
+    if content_hash is None:
+        with stopwatch(None, 'content_hash') as measurement:
+            if local_file.size >= CONTENT_HASH_PARALLEL_SIZE:
+                content_hash = get_parallel_content_hash(full_filename)
+            else:
+                content_hash = read_content_hash(full_filename)
+            measurement.byte_count = local_file.size
+        # the hash of a file that changed while it was hashed is that of neither version, so it isn't cached
         try:
-            md, res = dbx.files_download(path)
-        except (dropbox.exceptions.HttpError, Exception) as err:
-            print('File download failed for', path.encode('ascii', 'ignore'), err)
-            return None
-    data = res.content
-    print(len(data), 'bytes; md:', md)
-    return data
+            if stat_local_file(full_filename) == local_file:
+                save_cached_content_hash(local_file, content_hash)
+        except OSError:
+            pass
+    return content_hash
+
+
+# returns the content_hash of the given local file read one block at a time, so memory use doesn't depend on the file
+# size
+def read_content_hash(full_filename):
+    block_hashes = hashlib.sha256()
+    with open(full_filename, 'rb') as f:
+        while True:
+            block = f.read(CONTENT_HASH_BLOCK_SIZE)
+            if not block:
+                break
+            block_hashes.update(hashlib.sha256(block).digest())
+    return block_hashes.hexdigest()
+
+
+# returns the content_hash of the given large local file. Its blocks are read with pread and hashed in parallel on the
+# content_hash_executor threads, then the block digests are combined in order. The file isn't memory mapped as a file
+# truncated by another program while it was hashed would kill the process with SIGBUS; a short read only gives a hash
+# that doesn't match
+def get_parallel_content_hash(full_filename):
+    with open(full_filename, 'rb') as f:
+
+        def hash_block(offset):
+            return hashlib.sha256(os.pread(f.fileno(), CONTENT_HASH_BLOCK_SIZE, offset)).digest()
+
+        block_hashes = hashlib.sha256()
+        file_size = os.fstat(f.fileno()).st_size
+        for block_hash in content_hash_executor.map(hash_block, range(0, file_size, CONTENT_HASH_BLOCK_SIZE)):
+            block_hashes.update(block_hash)
+    return block_hashes.hexdigest()
 
 
 # converts the given utc_datetime to a local datetime
@@ -441,24 +1529,241 @@ def utc2local(utc_datetime):
 
 
 # attempts a file download from dropbox, saves the file to the given target_file_name in the file system
-# and returns the bytes of the file or None if it doesn't exist
+# and returns the number of bytes saved or None if the download failed.
+# the download is streamed DOWNLOAD_CHUNK_SIZE bytes at a time into a temporary file in the target folder which is
+# fsynced and then atomically renamed into place, so memory use doesn't depend on the file size and an interrupted
+# download never leaves a partial file under the target name. Temporary files start with .~ so the upload side
+# always skips them. A download interrupted by a retryable error is restarted from scratch by call_dropbox
 def download_and_save(dbx, dropbox_file_name, target_file_name):
-    with stopwatch('download and save'):
+    temp_file_name = None
+    with stopwatch('download and save', 'download_and_save') as measurement:
         try:
-            md, res = dbx.files_download(dropbox_file_name)
-            with open(target_file_name, 'wb') as f:
-                f.write(res.content)
+            md, temp_file_name, byte_count = call_dropbox(
+                'download_and_save', download_to_temp_file, dbx, dropbox_file_name, target_file_name)
 
-            local_datetime = utc2local(md.client_modified)
-            mod_time = time.mktime(local_datetime.timetuple())
-            os.utime(target_file_name, (mod_time, mod_time))
+            save_downloaded_file(temp_file_name, target_file_name, md)
+            temp_file_name = None
+            measurement.byte_count = byte_count
 
         except (dropbox.exceptions.HttpError, Exception) as err:
-            print('File download failed for', dropbox_file_name.encode('ascii', 'ignore'), err)
+            print('*** File download failed for', dropbox_file_name.encode('ascii', 'ignore'), err)
+            metrics.count_error('download_and_save', err)
+            return None
+
+        finally:
+            if temp_file_name is not None and os.path.exists(temp_file_name):
+                os.remove(temp_file_name)
+
+    print(byte_count, 'bytes; md:', md)
+    return byte_count
+
+
+# streams the given dropbox file into a new temporary file in the folder of target_file_name and returns its
+# FileMetadata, the temporary file name and the byte count. The temporary file is removed if the download fails
+def download_to_temp_file(dbx, dropbox_file_name, target_file_name):
+    md, res = dbx.files_download(dropbox_file_name)
+    with contextlib.closing(res):
+        fd, temp_file_name = tempfile.mkstemp(prefix='.~', suffix='.download', dir=os.path.dirname(target_file_name))
+        try:
+            byte_count = 0
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in res.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    bandwidth_limiter.consume('download', len(chunk))
+                    f.write(chunk)
+                    byte_count += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            os.remove(temp_file_name)
+            raise
+    return md, temp_file_name, byte_count
+
+
+# gives a downloaded temporary file the client_modified time of its FileMetadata and the permissions of the process
+# umask, renames it to target_file_name and records it in the sync state index
+def save_downloaded_file(temp_file_name, target_file_name, md):
+    local_datetime = utc2local(md.client_modified)
+    mod_time = time.mktime(local_datetime.timetuple())
+    os.utime(temp_file_name, (mod_time, mod_time))
+    os.chmod(temp_file_name, 0o666 & ~process_umask)
+    os.replace(temp_file_name, target_file_name)
+    save_sync_state(target_file_name, stat_local_file(target_file_name), md)
+
+
+# downloads the dropbox folder at folder_path as a single zip archive and saves the files of the given download jobs
+# (dropbox path, target file name, overwrite, FileMetadata) as the archive streams in, see ZipStreamReader. Each file is
+# saved like download_and_save does; a file whose content doesn't match its FileMetadata has changed since the listing
+# and is left out. Other members of the archive are skipped. Returns a dictionary mapping the lower case dropbox paths
+# of the saved files to their byte counts; when the download fails the files not saved yet are left out
+def download_zip_and_save(dbx, folder_path, jobs):
+    jobs_by_path = dict((job[0], job) for job in jobs)
+    parent_path = folder_path.rsplit('/', 1)[0]
+    saved = {}
+    with stopwatch('download zip of %d files' % len(jobs), 'download_zip') as measurement:
+        try:
+            md, res = call_dropbox('download_zip', dbx.files_download_zip, folder_path)
+            with contextlib.closing(res):
+                chunks = throttle_download(res.iter_content(DOWNLOAD_CHUNK_SIZE))
+                for name, data in ZipStreamReader(chunks).members():
+                    job = jobs_by_path.get((parent_path + '/' + name).lower())
+                    if job is not None and job[0] not in saved:
+                        byte_count = save_zip_member(data, job[1], job[3])
+                        if byte_count is not None:
+                            saved[job[0]] = byte_count
+        except Exception as err:
+            print('*** Zip download failed for', folder_path.encode('ascii', 'ignore'), err)
+            metrics.count_error('download_zip', err)
+        measurement.byte_count = sum(saved.values())
+    print('saved', len(saved), 'of', len(jobs), 'files from the zip of', folder_path.encode('ascii', 'ignore'))
+    return saved
+
+
+# yields the given chunks of a download, each once the download bandwidth limit allows for it
+def throttle_download(chunks):
+    for chunk in chunks:
+        bandwidth_limiter.consume('download', len(chunk))
+        yield chunk
+
+
+# writes the content of a zip archive member to a temporary file in the folder of target_file_name and saves it as the
+# file of the given FileMetadata. Returns the byte count or None when the content doesn't match the FileMetadata
+def save_zip_member(data, target_file_name, md):
+    fd, temp_file_name = tempfile.mkstemp(prefix='.~', suffix='.download', dir=os.path.dirname(target_file_name))
+    try:
+        byte_count = 0
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in data:
+                f.write(chunk)
+                byte_count += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        if byte_count != md.size or read_content_hash(temp_file_name) != md.content_hash:
+            print(md.path_display.encode('ascii', 'ignore'), 'has changed since it was listed')
+            os.remove(temp_file_name)
             return None
-    data = res.content
-    print(len(data), 'bytes; md:', md)
-    return data
+        save_downloaded_file(temp_file_name, target_file_name, md)
+        print(byte_count, 'bytes; md:', md)
+    except BaseException:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+        raise
+    return byte_count
+
+
+# reads the members of a zip archive in order from an iterator of byte chunks, such as a streamed download, so that the
+# archive is never held in memory or written to disk. Deflated and stored members are supported; the size of a
+# deflated member written with a data descriptor is found from the end of its deflate stream, and the crc32 of every
+# member is checked
+class ZipStreamReader(object):
+
+    LOCAL_FILE_HEADER = struct.Struct('<4sHHHHHIIIHH')
+    # local file header, central directory header, zip64 end of central directory and end of central directory
+    LOCAL_FILE_SIGNATURE = b'PK\x03\x04'
+    END_SIGNATURES = (b'PK\x01\x02', b'PK\x06\x06', b'PK\x05\x06')
+    DATA_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+        self.position = 0
+
+    # returns the next size bytes, fewer only at the end of the stream
+    def read(self, size):
+        while len(self.buffer) - self.position < size:
+            chunk = next(self.chunks, b'')
+            if not chunk:
+                break
+            self.buffer = self.buffer[self.position:] + chunk
+            self.position = 0
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    # returns at most size of the next bytes, without waiting for more than one chunk
+    def read_some(self, size):
+        if self.position >= len(self.buffer):
+            self.buffer = next(self.chunks, b'')
+            self.position = 0
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    # yields the (name, data) of each file in the archive, data being an iterator over the uncompressed content of the
+    # file. Content not consumed by the caller is skipped before the next member is read
+    def members(self):
+        while True:
+            header = self.read(self.LOCAL_FILE_HEADER.size)
+            if header[:4] in self.END_SIGNATURES:
+                return
+            if len(header) < self.LOCAL_FILE_HEADER.size or header[:4] != self.LOCAL_FILE_SIGNATURE:
+                raise ValueError('invalid zip archive: expected a local file header')
+            (_, _, flags, method, _, _, crc, compressed_size, _, name_length,
+             extra_length) = self.LOCAL_FILE_HEADER.unpack(header)
+            name = self.read(name_length).decode('utf-8' if flags & 0x800 else 'cp437')
+            zip64 = self.read_zip64_sizes(self.read(extra_length))
+            if zip64 is not None and compressed_size == 0xffffffff:
+                compressed_size = zip64[1]
+            if flags & 0x1:
+                raise ValueError('encrypted zip member ' + name)
+            if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                raise ValueError('unsupported compression method {0} of zip member {1}'.format(method, name))
+
+            data = self.read_data(name, flags, method, crc, compressed_size, zip64 is not None)
+            if not name.endswith('/'):
+                yield name, data
+            for _ in data:
+                pass
+
+    # returns the (uncompressed size, compressed size) of a zip64 extended information extra field or None
+    @staticmethod
+    def read_zip64_sizes(extra):
+        while len(extra) >= 4:
+            header_id, size = struct.unpack('<HH', extra[:4])
+            if header_id == 0x0001:
+                return struct.unpack('<QQ', extra[4:20].ljust(16, b'\0'))
+            extra = extra[4 + size:]
+        return None
+
+    # yields the uncompressed content of the member whose local file header was just read, then reads its data
+    # descriptor and checks its crc32
+    def read_data(self, name, flags, method, crc, compressed_size, zip64):
+        actual_crc = 0
+        if method == zipfile.ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            while not decompressor.eof:
+                chunk = self.read_some(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    raise EOFError('zip archive ends inside member ' + name)
+                data = decompressor.decompress(chunk)
+                if data:
+                    actual_crc = zlib.crc32(data, actual_crc)
+                    yield data
+            # the bytes after the end of the deflate stream belong to the next record
+            self.position -= len(decompressor.unused_data)
+        elif flags & 0x8 and not compressed_size:
+            # a stored member with a data descriptor doesn't give its size up front, which is only safe to assume
+            # when it is empty
+            if self.read(4) != self.DATA_DESCRIPTOR_SIGNATURE:
+                raise ValueError('unsupported stored zip member with a data descriptor ' + name)
+            self.position -= 4
+        else:
+            remaining = compressed_size
+            while remaining:
+                chunk = self.read_some(min(remaining, DOWNLOAD_CHUNK_SIZE))
+                if not chunk:
+                    raise EOFError('zip archive ends inside member ' + name)
+                remaining -= len(chunk)
+                actual_crc = zlib.crc32(chunk, actual_crc)
+                yield chunk
+
+        if flags & 0x8:
+            descriptor = self.read(4)
+            if descriptor == self.DATA_DESCRIPTOR_SIGNATURE:
+                descriptor = self.read(4)
+            crc = struct.unpack('<I', descriptor)[0]
+            self.read(16 if zip64 else 8)
+        if actual_crc != crc:
+            raise ValueError('crc32 mismatch of zip member ' + name)
 
 
 # attempts a file upload to dropbox and returns the request response or None if an exception is caught
@@ -473,73 +1778,1392 @@ def download_and_save(dbx, dropbox_file_name, target_file_name):
 # autorename == True and will simply just log a conflict failure if one occurs.
 
 # There is no reasonable solution to this dropbox problem other than to avoid case sensitive copies of files within a
-# single folder..which is quite poor.
+# single folder..which is quite poor. process_local_files checks new files against a case folded index of the dropbox
+# folder and of their local siblings (see find_case_conflict) so that such uploads are reported by
+# report_case_conflicts at the end of the run instead of failing after their data has been sent.
 
 # see https://www.dropbox.com/en/help/145 case conflicts for further info
 
-def upload(dbx, fullname, folder, subfolder, name, overwrite=False):
-    global app_logger
-    destination_path = '/%s/%s/%s' % (folder, subfolder.replace(os.path.sep, '/'), name)
-    while '//' in destination_path:
-        destination_path = destination_path.replace('//', '/')
+def upload(dbx, fullname, folder, subfolder, name, overwrite=False, local_file=None):
+    destination_path = get_destination_path(folder, subfolder, name)
 
     mode = (dropbox.files.WriteMode.overwrite if overwrite else dropbox.files.WriteMode.add)
-    mtime = os.path.getmtime(fullname)
-
-    CHUNK_SIZE = 4 * 1024 * 1024  # 4mb chunks
-    MAX_SIZE = 10 * 1024 * 1024  # 10mb max
+    if local_file is None:
+        local_file = stat_local_file(fullname)
 
     f = open(fullname, 'rb')
-    file_size = os.path.getsize(fullname)
-    file_modified = datetime.datetime(*time.gmtime(mtime)[:6])
-    with stopwatch('upload %d bytes' % file_size):
+    file_size = local_file.size
+    file_modified = get_local_file_modified(local_file)
+    with stopwatch('upload %d bytes' % file_size, 'upload') as measurement:
         try:
 
-            if file_size <= MAX_SIZE:
+            # a limited upload bandwidth is applied a chunk at a time, so only files of up to one chunk are sent in
+            # a single request
+            if file_size <= (UPLOAD_CHUNK_SIZE if bandwidth_limiter.get_rate('upload') else UPLOAD_MAX_SIZE):
                 # one shot upload
-                res = dbx.files_upload(f.read(), destination_path, mode, client_modified=file_modified, mute=True)
+                data = f.read()
+                bandwidth_limiter.consume('upload', len(data))
+                res = call_dropbox('upload', dbx.files_upload, data, destination_path, mode,
+                                   client_modified=file_modified, mute=True)
             else:
                 # chunked upload for files > 10mb
-                upload_session_start_result = dbx.files_upload_session_start(f.read(CHUNK_SIZE))
-                cursor = dropbox.files.UploadSessionCursor(session_id=upload_session_start_result.session_id,
-                                                           offset=f.tell())
                 commit_info = dropbox.files.CommitInfo(path=destination_path)
                 commit_info.client_modified = file_modified
                 commit_info.mode = mode
+                res = upload_session(dbx, f, fullname, local_file, commit_info)
+            measurement.byte_count = file_size
 
-                while f.tell() < file_size:
-                    if (file_size - f.tell()) <= CHUNK_SIZE:
-                        res = dbx.files_upload_session_finish(f.read(CHUNK_SIZE), cursor, commit_info)
-                    else:
-                        dbx.files_upload_session_append(f.read(CHUNK_SIZE), cursor.session_id, cursor.offset)
-                        cursor.offset = f.tell()
+        except Exception as err:
+            metrics.count_error('upload', err)
+            log_upload_exception(err, mode, fullname, destination_path)
+            return None
 
-        except (dropbox.exceptions.ApiError, dropbox.exceptions.InternalServerError) as err:
-            print('*** API upload error for', fullname.encode('ascii', 'ignore'),
-                  destination_path.encode('ascii', 'ignore'), err)
-            app_logger.error(
-                'Caught a dropbox exception at upload time; the process will continue. {0}, {1}, {2} {3}'.format(
+        finally:
+            f.close()
+
+    print('uploaded as', res.name.encode('utf8', 'ignore'))
+    return res
+
+
+# uploads the given open file in upload_chunk_size chunks through an upload session and returns the FileMetadata.
+# the session id and last confirmed offset are saved in the sync state index as each chunk is appended so that when
+# an upload is interrupted, the next attempt to upload the unchanged file continues the saved session. An
+# incorrect_offset error moves the upload to the offset dropbox reports as received. Files without a saved session are
+# uploaded through a concurrent session instead when --upload-chunk-workers is above 1
+def upload_session(dbx, f, fullname, local_file, commit_info, resume=True):
+    file_size = local_file.size
+    saved_session = get_upload_session(fullname, local_file, commit_info.path) if resume else None
+
+    if saved_session is None and upload_chunk_executor is not None:
+        return upload_concurrent_session(dbx, f, fullname, file_size, commit_info)
+
+    if saved_session is not None:
+        cursor = dropbox.files.UploadSessionCursor(session_id=saved_session[0], offset=saved_session[1])
+        next_chunk = None
+        print('resuming upload of', fullname.encode('ascii', 'ignore'), 'at offset', cursor.offset)
+    else:
+        next_chunk = prefetch_chunk(f, 0)
+        with stopwatch(None, 'upload_session_start') as measurement:
+            chunk = next_chunk.result()
+            next_chunk = prefetch_chunk(f, len(chunk))
+            bandwidth_limiter.consume('upload', len(chunk))
+            upload_session_start_result = call_dropbox('upload_session_start', dbx.files_upload_session_start, chunk)
+            measurement.byte_count = len(chunk)
+        cursor = dropbox.files.UploadSessionCursor(session_id=upload_session_start_result.session_id,
+                                                   offset=len(chunk))
+        save_upload_session(fullname, local_file, commit_info.path, cursor)
+
+    offset_corrections = 0
+    while True:
+        # the chunk at the cursor was read while the previous chunk was sent, unless the offset was corrected
+        if next_chunk is None or next_chunk.offset != cursor.offset:
+            next_chunk = prefetch_chunk(f, cursor.offset)
+        chunk = next_chunk.result()
+        next_chunk = prefetch_chunk(f, cursor.offset + len(chunk)) if cursor.offset + len(chunk) < file_size else None
+        try:
+            if (file_size - cursor.offset) <= upload_chunk_size:
+                with stopwatch(None, 'upload_session_finish') as measurement:
+                    bandwidth_limiter.consume('upload', len(chunk))
+                    res = call_dropbox('upload_session_finish', dbx.files_upload_session_finish, chunk, cursor,
+                                       commit_info)
+                    measurement.byte_count = len(chunk)
+                break
+            else:
+                with stopwatch(None, 'upload_session_append') as measurement:
+                    bandwidth_limiter.consume('upload', len(chunk))
+                    call_dropbox('upload_session_append', dbx.files_upload_session_append_v2, chunk, cursor)
+                    measurement.byte_count = len(chunk)
+                cursor.offset += len(chunk)
+                save_upload_session(fullname, local_file, commit_info.path, cursor)
+                offset_corrections = 0
+
+        except dropbox.exceptions.ApiError as err:
+            lookup_error = get_upload_session_lookup_error(err)
+            if lookup_error is not None and lookup_error.is_incorrect_offset() and offset_corrections < 3:
+                cursor.offset = lookup_error.get_incorrect_offset().correct_offset
+                print('upload session offset corrected to', cursor.offset, 'for', fullname.encode('ascii', 'ignore'))
+                save_upload_session(fullname, local_file, commit_info.path, cursor)
+                offset_corrections += 1
+                metrics.count_retry('upload_session_append')
+            elif lookup_error is not None and saved_session is not None:
+                # the saved session has expired or is otherwise unusable, start over
+                print('saved upload session is no longer valid for', fullname.encode('ascii', 'ignore'), err)
+                delete_upload_session(fullname)
+                metrics.count_retry('upload')
+                f.seek(0)
+                return upload_session(dbx, f, fullname, local_file, commit_info, False)
+            else:
+                raise
+
+    delete_upload_session(fullname)
+    return res
+
+
+# uploads the given open file through a concurrent upload session and returns the FileMetadata. The chunks are appended
+# on the upload_chunk_executor threads, up to --upload-chunk-workers at a time, while this thread reads the next chunk
+# from disk. Dropbox puts the chunks together by offset so they may arrive in any order; the last chunk is sent once
+# the others are in and closes the session, which is then committed. Chunks arriving out of order leave no single
+# confirmed offset to continue from, so concurrent sessions aren't saved and an interrupted upload starts over
+def upload_concurrent_session(dbx, f, fullname, file_size, commit_info):
+    with stopwatch(None, 'upload_session_start'):
+        session_id = call_dropbox('upload_session_start', dbx.files_upload_session_start, b'',
+                                  session_type=dropbox.files.UploadSessionType.concurrent).session_id
+
+    in_flight = set()
+    offset = 0
+    try:
+        while offset < file_size:
+            chunk = os.pread(f.fileno(), upload_chunk_size, offset)
+            if not chunk:
+                break
+            close = offset + len(chunk) >= file_size
+            # a closed session takes no more chunks, so the last chunk waits for all the others
+            while len(in_flight) >= (1 if close else upload_chunk_workers):
+                done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            in_flight.add(upload_chunk_executor.submit(append_concurrent_chunk, dbx, session_id, offset, chunk, close))
+            offset += len(chunk)
+        for future in concurrent.futures.as_completed(in_flight):
+            future.result()
+    finally:
+        for future in in_flight:
+            future.cancel()
+    if offset != file_size:
+        raise IOError('{0} changed size during the upload'.format(fullname))
+
+    with stopwatch(None, 'upload_session_finish'):
+        return call_dropbox('upload_session_finish', dbx.files_upload_session_finish, b'',
+                            dropbox.files.UploadSessionCursor(session_id=session_id, offset=file_size), commit_info)
+
+
+# appends a chunk to a concurrent upload session at the given offset, closing the session with the last chunk
+def append_concurrent_chunk(dbx, session_id, offset, chunk, close):
+    chunk_dbx = get_upload_chunk_dbx(dbx)
+    with stopwatch(None, 'upload_session_append') as measurement:
+        bandwidth_limiter.consume('upload', len(chunk))
+        call_dropbox('upload_session_append', chunk_dbx.files_upload_session_append_v2, chunk,
+                     dropbox.files.UploadSessionCursor(session_id=session_id, offset=offset), close=close)
+        measurement.byte_count = len(chunk)
+
+
+# returns the dropbox client of the calling upload_chunk_executor thread: a copy of the given client with a connection
+# of its own, so that the chunks of a file are sent over separate connections
+def get_upload_chunk_dbx(dbx):
+    if not hasattr(upload_chunk_state, 'dbx'):
+        upload_chunk_state.dbx = dbx.clone(session=dropbox.create_session(max_connections=1))
+    return upload_chunk_state.dbx
+
+
+# starts reading the upload_chunk_size bytes of the given open file at the given offset on the upload_prefetch_executor
+# and returns the future of the chunk, so that the next chunk of a chunked upload is read while the current one is sent
+def prefetch_chunk(f, offset):
+    future = upload_prefetch_executor.submit(os.pread, f.fileno(), upload_chunk_size, offset)
+    future.offset = offset
+    return future
+
+
+# returns the bytes held in memory by a chunked upload of a file of the given size: the chunks in flight and the chunk
+# read ahead
+def get_chunked_upload_buffer_size(file_size):
+    return min(file_size, upload_chunk_size * (upload_chunk_workers + 1))
+
+
+# applies the --upload-chunk-size and --upload-chunk-workers options of this process. Concurrent upload sessions need
+# a dropbox sdk that supports session_type, otherwise chunks are uploaded one at a time
+def start_chunk_uploads(args):
+    global upload_chunk_size, upload_chunk_workers, upload_chunk_executor, upload_prefetch_executor
+    upload_chunk_size = args.upload_chunk_size * 1024 * 1024
+    upload_prefetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.upload_workers,
+                                                                     thread_name_prefix='upload_prefetch')
+    if args.upload_chunk_workers > 1 and not hasattr(dropbox.files, 'UploadSessionType'):
+        print('The installed dropbox sdk does not support concurrent upload sessions; uploading chunks one at a time')
+    elif args.upload_chunk_workers > 1:
+        upload_chunk_workers = args.upload_chunk_workers
+        upload_chunk_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.upload_workers * args.upload_chunk_workers, thread_name_prefix='upload_chunk')
+
+
+# returns the UploadSessionLookupError (or the equivalent UploadSessionAppendError) carried by the given upload session
+# ApiError or None
+def get_upload_session_lookup_error(err):
+    error = err.error
+    if isinstance(error, dropbox.files.UploadSessionFinishError):
+        error = error.get_lookup_failed() if error.is_lookup_failed() else None
+    return error if hasattr(error, 'is_incorrect_offset') else None
+
+
+# returns the full dropbox path for an upload of the given file name in the given local sub folder
+def get_destination_path(folder, subfolder, name):
+    destination_path = '/%s/%s/%s' % (folder, subfolder.replace(os.path.sep, '/'), name)
+    while '//' in destination_path:
+        destination_path = destination_path.replace('//', '/')
+    return destination_path
+
+
+# logs an exception caught at upload time; the process continues with the next file
+def log_upload_exception(err, mode, fullname, destination_path):
+    if isinstance(err, (dropbox.exceptions.ApiError, dropbox.exceptions.InternalServerError)):
+        print('*** API upload error for', fullname.encode('ascii', 'ignore'),
+              destination_path.encode('ascii', 'ignore'), err)
+        app_logger.error(
+            'Caught a dropbox exception at upload time; the process will continue. {0}, {1}, {2} {3}'.format(
                 mode._tag, fullname, destination_path, err))
-            return None
+    elif isinstance(err, requests.exceptions.ReadTimeout):
+        print('*** Timeout upload exception for', fullname.encode('ascii', 'ignore'),
+              destination_path.encode('ascii', 'ignore'), err)
+        app_logger.error(
+            'Caught a request timeout exception at upload time; the process will continue. {0}, {1}, {2} {3}'.format(
+                mode._tag, fullname, destination_path, err))
+    else:
+        print('*** General upload exception for', fullname.encode('ascii', 'ignore'),
+              destination_path.encode('ascii', 'ignore'), err)
+        app_logger.error(
+            'Caught a general exception at upload time; the process will continue. {0}, {1}, {2} {3}'.format(
+                mode._tag, fullname, destination_path, err))
+
 
-        except requests.exceptions.ReadTimeout as to:
-            print('*** Timeout upload exception for', fullname.encode('ascii', 'ignore'),
-                  destination_path.encode('ascii', 'ignore'), to)
-            app_logger.error(
-                'Caught a request timeout exception at upload time; the process will continue. {0}, {1}, {2} {3}'.format(
-                    mode._tag, fullname, destination_path, to))
+# uploads the content of a small file into a closed upload session without committing it and returns the
+# UploadSessionFinishArg needed to commit the file with commit_upload_batch or None if an exception is caught
+def upload_session_for_batch(dbx, fullname, local_file, folder, subfolder, name, overwrite=False):
+    destination_path = get_destination_path(folder, subfolder, name)
+    mode = (dropbox.files.WriteMode.overwrite if overwrite else dropbox.files.WriteMode.add)
+    file_modified = get_local_file_modified(local_file)
+    try:
+        with open(fullname, 'rb') as f:
+            data = f.read()
+        bandwidth_limiter.consume('upload', len(data))
+        with stopwatch(None, 'upload_session_start') as measurement:
+            upload_session_start_result = call_dropbox('upload_session_start', dbx.files_upload_session_start, data,
+                                                       close=True)
+            measurement.byte_count = len(data)
+    except Exception as err:
+        log_upload_exception(err, mode, fullname, destination_path)
+        return None
+    return dropbox.files.UploadSessionFinishArg(
+        cursor=dropbox.files.UploadSessionCursor(session_id=upload_session_start_result.session_id, offset=len(data)),
+        commit=dropbox.files.CommitInfo(path=destination_path, mode=mode, client_modified=file_modified, mute=True))
+
+
+# commits up to UPLOAD_BATCH_SIZE closed upload sessions as files in a single dropbox write operation and returns a
+# list holding the FileMetadata or None of each entry in order. Committing many small files at once avoids the
+# too_many_write_operations rate limiting caused by a commit per file
+def commit_upload_batch(dbx, finish_args):
+    results = [None] * len(finish_args)
+    with stopwatch('commit batch of %d uploads' % len(finish_args), 'upload_batch_commit'):
+        try:
+            if hasattr(dbx, 'files_upload_session_finish_batch_v2'):
+                batch_result = call_dropbox('upload_batch_commit', dbx.files_upload_session_finish_batch_v2,
+                                            finish_args)
+            else:
+                launch = call_dropbox('upload_batch_commit', dbx.files_upload_session_finish_batch, finish_args)
+                if launch.is_complete():
+                    batch_result = launch.get_complete()
+                else:
+                    batch_result = poll_batch_job(
+                        'upload_batch_commit', dbx.files_upload_session_finish_batch_check, launch.get_async_job_id())
+        except Exception as err:
+            metrics.count_error('upload_batch_commit', err)
+            print('*** Upload batch commit failed for', len(finish_args), 'files', err)
+            app_logger.error('Caught an exception committing an upload batch of {0} files; '
+                             'the process will continue. {1}'.format(len(finish_args), err))
+            return results
+
+    for i, entry in enumerate(batch_result.entries):
+        if entry.is_success():
+            results[i] = entry.get_success()
+            print('uploaded as', results[i].name.encode('utf8', 'ignore'))
+        else:
+            print('*** API upload error for', finish_args[i].commit.path.encode('ascii', 'ignore'), entry.get_failure())
+            app_logger.error('Caught a dropbox upload batch failure; the process will continue. {0}, {1} {2}'.format(
+                finish_args[i].commit.mode._tag, finish_args[i].commit.path, entry.get_failure()))
+    return results
+
+
+# polls an asynchronous batch job with the given check route until it completes and returns its result
+def poll_batch_job(operation, check, async_job_id):
+    delay = 0.5
+    while True:
+        time.sleep(delay)
+        status = call_dropbox(operation, check, async_job_id)
+        if status.is_complete():
+            return status.get_complete()
+        if hasattr(status, 'is_failed') and status.is_failed():
+            raise dropbox.exceptions.DropboxException(None, 'batch job {0} failed: {1}'.format(
+                async_job_id, status.get_failed()))
+        delay = min(delay * 2, 10)
+
+
+# returns the (local_path, dropbox_path) of an indexed file with the same size and content as the given new local
+# file, preferring one that no longer exists locally, along with the content hash of the new file. Returns None when
+# there is no such file. The new file is only hashed when an indexed file of the same size exists
+def find_relocation_source(full_filename, local_file):
+    if not has_sync_state_size(local_file.size):
+        return None
+    content_hash = get_content_hash(full_filename, local_file)
+    candidates = [c for c in get_sync_states_by_content(local_file.size, content_hash) if c[0] != full_filename]
+    if not candidates:
+        return None
+    moved = [c for c in candidates if not os.path.lexists(c[0])]
+    return (moved or candidates)[0], content_hash
+
+
+# moves the given dropbox file to destination_path once its content is confirmed to still be the given content_hash
+# and returns the FileMetadata at the new path or None if the move didn't happen
+def move_remote_file(dbx, dropbox_path, destination_path, content_hash):
+    with stopwatch('move %s' % destination_path, 'relocate'):
+        try:
+            source = call_dropbox('relocate', dbx.files_get_metadata, dropbox_path)
+            if not isinstance(source, dropbox.files.FileMetadata) or source.content_hash != content_hash:
+                print(dropbox_path.encode('ascii', 'ignore'), 'has changed on dropbox, not moving it')
+                return None
+            return call_dropbox('relocate', dbx.files_move_v2, dropbox_path, destination_path).metadata
+        except Exception as err:
+            metrics.count_error('relocate', err)
+            print('*** Move failed for', dropbox_path.encode('ascii', 'ignore'),
+                  destination_path.encode('ascii', 'ignore'), err)
+            app_logger.error('Caught an exception moving {0} to {1}; the file will be uploaded. {2}'.format(
+                dropbox_path, destination_path, err))
             return None
 
-        except Exception as e:
-            print('*** General upload exception for', fullname.encode('ascii', 'ignore'),
-                  destination_path.encode('ascii', 'ignore'), e)
-            app_logger.error(
-                'Caught a general exception at upload time; the process will continue. {0}, {1}, {2} {3}'.format(
-                    mode._tag, fullname, destination_path, e))
+
+# copies up to RELOCATE_BATCH_SIZE dropbox files in a single call and returns a list holding the FileMetadata of each
+# copy or None in order. relocation_paths is a list of dropbox.files.RelocationPath
+def copy_remote_files(dbx, relocation_paths):
+    results = [None] * len(relocation_paths)
+    with stopwatch('copy batch of %d files' % len(relocation_paths), 'relocate'):
+        try:
+            launch = call_dropbox('relocate', dbx.files_copy_batch_v2, relocation_paths)
+            if launch.is_complete():
+                batch_result = launch.get_complete()
+            else:
+                batch_result = poll_batch_job('relocate', dbx.files_copy_batch_check_v2, launch.get_async_job_id())
+        except Exception as err:
+            metrics.count_error('relocate', err)
+            print('*** Copy batch failed for', len(relocation_paths), 'files', err)
+            app_logger.error('Caught an exception copying a batch of {0} files; the files will be uploaded. {1}'.format(
+                len(relocation_paths), err))
+            return results
+
+    for i, entry in enumerate(batch_result.entries):
+        if entry.is_success() and isinstance(entry.get_success(), dropbox.files.FileMetadata):
+            results[i] = entry.get_success()
+        else:
+            print('*** Copy failed for', relocation_paths[i].from_path.encode('ascii', 'ignore'),
+                  entry.get_failure() if entry.is_failure() else entry)
+    return results
+
+
+# deletes up to MIRROR_BATCH_SIZE dropbox paths in a single call and returns the DeleteBatchResultEntry of each path
+# in order or None if the batch failed. delete_args is a list of dropbox.files.DeleteArg
+def delete_remote_paths(dbx, delete_args):
+    with stopwatch('delete batch of %d paths' % len(delete_args), 'mirror_delete'):
+        try:
+            launch = call_dropbox('mirror_delete', dbx.files_delete_batch, delete_args)
+            if launch.is_complete():
+                return launch.get_complete().entries
+            return poll_batch_job('mirror_delete', dbx.files_delete_batch_check, launch.get_async_job_id()).entries
+        except Exception as err:
+            metrics.count_error('mirror_delete', err)
+            print('*** Delete batch failed for', len(delete_args), 'paths', err)
+            app_logger.error('Caught an exception deleting a batch of {0} paths; the process will continue. {1}'.format(
+                len(delete_args), err))
             return None
 
-    print('uploaded as', res.name.encode('utf8', 'ignore'))
-    return res
+
+# creates up to MIRROR_BATCH_SIZE dropbox folders in a single call and returns a list holding an indicator whether
+# each folder now exists (created or already there) in order
+def create_remote_folders(dbx, paths):
+    results = [False] * len(paths)
+    with stopwatch('create batch of %d folders' % len(paths), 'mirror_create_folder'):
+        try:
+            launch = call_dropbox('mirror_create_folder', dbx.files_create_folder_batch, paths)
+            if launch.is_complete():
+                batch_result = launch.get_complete()
+            else:
+                batch_result = poll_batch_job('mirror_create_folder', dbx.files_create_folder_batch_check,
+                                              launch.get_async_job_id())
+        except Exception as err:
+            metrics.count_error('mirror_create_folder', err)
+            print('*** Folder create batch failed for', len(paths), 'folders', err)
+            app_logger.error('Caught an exception creating a batch of {0} folders; the process will continue. '
+                             '{1}'.format(len(paths), err))
+            return results
+
+    for i, entry in enumerate(batch_result.entries):
+        if entry.is_success():
+            results[i] = True
+        else:
+            failure = entry.get_failure()
+            write_error = failure.get_path() if failure.is_path() else None
+            results[i] = (write_error is not None and write_error.is_conflict() and
+                          write_error.get_conflict().is_folder())
+            if not results[i]:
+                print('*** Folder create failed for', paths[i].encode('ascii', 'ignore'), failure)
+    return results
+
+
+# --mirror for the upload side: creates dropbox folders for the local folders that aren't known to exist there and,
+# once the traversal is done, deletes the dropbox files and folders that were deleted locally since they were last
+# synced. A dropbox file is only deleted while it still has the rev it was synced at, so a file changed on dropbox
+# since is kept, and a dropbox folder is only deleted once it holds no files
+class UploadMirror(object):
+
+    def __init__(self, dbx, local_sync_folder, dropbox_folder, args):
+        self.dbx = dbx
+        self.local_sync_folder = local_sync_folder
+        self.dropbox_folder = dropbox_folder
+        self.args = args
+        # the local files seen by the traversal
+        self.seen_paths = set()
+        # (local folder, dropbox path) of the folders waiting to be created on dropbox
+        self.pending_folders = []
+        self.created_folder_count = 0
+
+    # records a local folder visited by the traversal along with its files
+    def add_folder(self, dn, files):
+        self.seen_paths.update(os.path.join(dn, local_file.name) for local_file in files)
+        if dn == self.local_sync_folder or get_sync_folder(dn) is not None:
+            return
+        sub_folder, name = os.path.split(dn[len(self.local_sync_folder):].strip(os.path.sep))
+        self.pending_folders.append((dn, get_destination_path(self.dropbox_folder, sub_folder, name)))
+        if len(self.pending_folders) >= MIRROR_BATCH_SIZE:
+            self.create_folders()
+
+    # creates the pending folders on dropbox
+    def create_folders(self):
+        batch, self.pending_folders = self.pending_folders, []
+        for (local_folder, dropbox_path), exists in zip(batch, create_remote_folders(self.dbx, [p for _, p in batch])):
+            if exists:
+                save_sync_folder(local_folder, dropbox_path)
+                self.created_folder_count += 1
+
+    # creates any remaining folders and deletes the files and folders deleted locally from dropbox
+    def close(self):
+        if self.pending_folders:
+            self.create_folders()
+
+        deleted_files = [record for record in get_sync_states_under(self.local_sync_folder)
+                         if record[0] not in self.seen_paths and not os.path.lexists(record[0])]
+        deleted_folders = get_top_folders([record for record in get_sync_folders_under(self.local_sync_folder)
+                                           if not os.path.lexists(record[0])])
+        deleted_file_count = 0
+        if ((deleted_files or deleted_folders) and
+                yesno('Delete %d files and %d folders deleted locally from dropbox' % (
+                    len(deleted_files), len(deleted_folders)), True, self.args)):
+            deleted_file_count = self.delete_files(deleted_files)
+            self.delete_folders(deleted_folders)
+
+        log_info_event('Mirror: {0} folders created and {1} files deleted on dropbox'.format(
+            self.created_folder_count, deleted_file_count))
+
+    # deletes the given (local_path, dropbox_path, size, mtime_ns, rev) indexed files from dropbox and returns the
+    # number of files deleted
+    def delete_files(self, records):
+        deleted_count = 0
+        for i in range(0, len(records), MIRROR_BATCH_SIZE):
+            batch = records[i:i + MIRROR_BATCH_SIZE]
+            entries = delete_remote_paths(self.dbx, [dropbox.files.DeleteArg(r[1], r[4]) for r in batch])
+            for record, entry in zip(batch, entries or []):
+                if entry.is_success():
+                    print(record[1].encode('ascii', 'ignore'), 'deleted from dropbox')
+                    deleted_count += 1
+                    delete_sync_state(record[0])
+                elif entry.get_failure().is_path_lookup() and entry.get_failure().get_path_lookup().is_not_found():
+                    delete_sync_state(record[0])
+                else:
+                    print('***', record[1].encode('ascii', 'ignore'), 'was not deleted from dropbox:',
+                          entry.get_failure())
+        return deleted_count
+
+    # deletes the given (local_path, dropbox_path) folders from dropbox when they no longer hold any files
+    def delete_folders(self, records):
+        empty_records = []
+        for local_path, dropbox_path in records:
+            try:
+                listing = call_dropbox('list_folder', self.dbx.files_list_folder, dropbox_path, recursive=True)
+            except dropbox.exceptions.ApiError:
+                delete_sync_folders_under(local_path)
+                continue
+            except Exception as err:
+                print('*** Folder listing exception for', dropbox_path.encode('ascii', 'ignore'), err)
+                continue
+            if listing.has_more or any(not isinstance(e, dropbox.files.FolderMetadata) for e in listing.entries):
+                print(dropbox_path.encode('ascii', 'ignore'), 'still holds files on dropbox, not deleting it')
+            else:
+                empty_records.append((local_path, dropbox_path))
+        for i in range(0, len(empty_records), MIRROR_BATCH_SIZE):
+            batch = empty_records[i:i + MIRROR_BATCH_SIZE]
+            entries = delete_remote_paths(self.dbx, [dropbox.files.DeleteArg(p) for _, p in batch])
+            for (local_path, dropbox_path), entry in zip(batch, entries or []):
+                if entry.is_success():
+                    print(dropbox_path.encode('ascii', 'ignore'), 'deleted from dropbox')
+                    delete_sync_folders_under(local_path)
+
+
+# --mirror for the download side: deletes the local files and folders that were deleted on dropbox since they were
+# last synced. Deletions are taken from the deleted entries of a listing cursor or, for a full listing, are the indexed
+# files that the listing no longer holds. A local file is only deleted while it is unchanged since it was synced, so
+# a file changed locally since is kept, and a local folder is only removed once it is empty. Only files indexed before
+# the traversal started are considered so that a file uploaded meanwhile (--watch with --longpoll) is never deleted
+class DownloadMirror(object):
+
+    def __init__(self, dropbox_root, local_root_dir, full_listing, args):
+        self.dropbox_root = dropbox_root
+        self.local_root_dir = local_root_dir
+        self.full_listing = full_listing
+        self.args = args
+        # lower case dropbox paths listed / reported deleted by the traversal
+        self.seen_paths = set()
+        self.deleted_paths = set()
+        self.indexed_files = set((r[0], r[4]) for r in get_sync_states_under(local_root_dir))
+
+    # records the entries of a listing page
+    def add_entries(self, entries):
+        for entry in entries:
+            if isinstance(entry, dropbox.files.DeletedMetadata):
+                self.deleted_paths.add(entry.path_lower)
+            else:
+                self.seen_paths.add(entry.path_lower)
+
+    # returns an indicator whether the given dropbox path (or one of its parent folders) was deleted on dropbox. Records
+    # outside the listed folder (synced with another dropbox folder, or by a nested --config root) are never deleted
+    def is_deleted(self, dropbox_path):
+        path_lower = dropbox_path.lower()
+        if not path_lower.startswith(self.dropbox_root.lower() + '/') or path_lower in self.seen_paths:
+            return False
+        if self.full_listing:
+            return True
+        while path_lower.startswith(self.dropbox_root.lower() + '/'):
+            if path_lower in self.deleted_paths:
+                return True
+            path_lower = path_lower.rsplit('/', 1)[0]
+        return False
+
+    # deletes the local files and folders deleted on dropbox
+    def close(self):
+        if not self.full_listing and not self.deleted_paths:
+            return
+        # ignored files and folders are left alone, even when they were synced before they were ignored
+        deleted_files = [r for r in get_sync_states_under(self.local_root_dir)
+                         if (r[0], r[4]) in self.indexed_files and self.is_deleted(r[1]) and
+                         not is_ignored_local_path(r[0], False, self.local_root_dir, self.args)]
+        deleted_folders = [r for r in get_sync_folders_under(self.local_root_dir)
+                           if self.is_deleted(r[1]) and
+                           not is_ignored_local_path(r[0], True, self.local_root_dir, self.args)]
+        if not deleted_files and not deleted_folders:
+            return
+        if not yesno('Delete %d local files and %d folders deleted from dropbox' % (
+                len(deleted_files), len(deleted_folders)), True, self.args):
+            return
+        deleted_count = delete_local_files(deleted_files)
+        removed_count = remove_empty_local_folders([local_path for local_path, _ in deleted_folders])
+        log_info_event('Mirror: {0} local files and {1} local folders deleted'.format(deleted_count, removed_count))
+
+
+# deletes the given (local_path, dropbox_path, size, mtime_ns, rev) indexed local files that are unchanged since they
+# were synced along with their sync state index records and returns the number of files deleted
+def delete_local_files(records):
+    deleted_count = 0
+    for local_path, dropbox_path, size, mtime_ns, rev in records:
+        try:
+            local_file = stat_local_file(local_path)
+        except OSError:
+            delete_sync_state(local_path)
+            continue
+        if local_file.size != size or local_file.mtime_ns != mtime_ns:
+            print(local_path.encode('ascii', 'ignore'), 'has changed locally since it was synced, not deleting it')
+            continue
+        try:
+            os.remove(local_path)
+        except OSError as e:
+            print('*** Unable to delete', local_path.encode('ascii', 'ignore'), e)
+            continue
+        print(local_path.encode('ascii', 'ignore'), 'deleted locally')
+        delete_sync_state(local_path)
+        deleted_count += 1
+    return deleted_count
+
+
+# removes the given local folders, deepest first, along with their sync state index records when they are empty and
+# returns the number of folders removed
+def remove_empty_local_folders(folders):
+    removed_count = 0
+    for folder in sorted(folders, key=lambda f: f.count(os.path.sep), reverse=True):
+        try:
+            os.rmdir(folder)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            print(folder.encode('ascii', 'ignore'), 'is not empty, not removing it')
+            continue
+        else:
+            removed_count += 1
+        delete_sync_folders_under(folder)
+    return removed_count
+
+
+# returns the given (local_path, dropbox_path) folder records without those inside another of the given folders
+def get_top_folders(records):
+    top_records = []
+    for record in sorted(records):
+        if not top_records or not record[0].startswith(top_records[-1][0] + os.path.sep):
+            top_records.append(record)
+    return top_records
+
+
+# returns a dropbox client for the given token. The sdk's own retries are turned off so that every rate limit, 5xx and
+# timeout reaches call_dropbox which retries them and adapts the number of concurrent calls
+def create_dropbox_client(token, **kwargs):
+    return dropbox.Dropbox(token, max_retries_on_error=0, max_retries_on_rate_limit=0, **kwargs)
+
+
+# calls func(*args, **kwargs), a dropbox api call or a function making one, within a concurrency_limiter slot and
+# retries it after a backoff when it fails with a retryable error (see get_retry_delay). The operation name is used for
+# the retry metrics. Non retryable errors and the last failure are raised to the caller
+def call_dropbox(operation, func, *args, **kwargs):
+    attempt = 0
+    while True:
+        with concurrency_limiter:
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                delay = get_retry_delay(e, attempt)
+                if delay is None or attempt >= DROPBOX_MAX_RETRIES or stop_event.is_set():
+                    raise
+                if is_rate_limit_error(e):
+                    concurrency_limiter.rate_limited(delay)
+                print('retrying', operation, 'in %.1f secs after' % delay, type(e).__name__, e)
+            else:
+                concurrency_limiter.succeeded()
+                return result
+        attempt += 1
+        metrics.count_retry(operation)
+        stop_event.wait(delay)
+
+
+# returns the seconds to wait before retrying a call that failed with the given exception on the given (zero based)
+# attempt or None if the error is not retryable. Rate limits honour the backoff / Retry-After dropbox sends, other
+# retryable errors use a full jitter exponential backoff so that concurrent workers don't retry in lock step
+def get_retry_delay(err, attempt):
+    if isinstance(err, dropbox.exceptions.RateLimitError) and err.backoff:
+        return err.backoff + random.uniform(0, DROPBOX_MIN_BACKOFF)
+    if is_rate_limit_error(err) or isinstance(err, (dropbox.exceptions.InternalServerError,
+                                                     requests.exceptions.ConnectionError,
+                                                     requests.exceptions.Timeout,
+                                                     requests.exceptions.ChunkedEncodingError)):
+        return random.uniform(DROPBOX_MIN_BACKOFF, min(DROPBOX_MAX_BACKOFF, DROPBOX_MIN_BACKOFF * 2 ** (attempt + 1)))
+    return None
+
+
+# returns an indicator whether the given exception is dropbox pushing back: a 429 rate limit, a 503 or a
+# too_many_write_operations write error
+def is_rate_limit_error(err):
+    if isinstance(err, dropbox.exceptions.RateLimitError):
+        return True
+    if isinstance(err, dropbox.exceptions.InternalServerError):
+        return err.status_code == 503
+    if isinstance(err, dropbox.exceptions.ApiError):
+        error = err.error
+        if hasattr(error, 'is_path') and error.is_path():
+            error = error.get_path()
+            error = getattr(error, 'reason', error)
+            return hasattr(error, 'is_too_many_write_operations') and error.is_too_many_write_operations()
+    return False
+
+
+# limits the number of dropbox calls in flight across all threads. The limit starts at the maximum, is halved (at
+# most once per backoff) when dropbox rate limits a call while every thread also pauses for the backoff dropbox asks
+# for, and grows by one again after each limit successful calls in a row, so throughput settles near the account's
+# real rate limit instead of the workers repeatedly running into it
+class ConcurrencyLimiter(object):
+
+    def __init__(self, maximum=1):
+        self.condition = threading.Condition()
+        self.maximum = maximum
+        self.limit = maximum
+        self.in_flight = 0
+        self.successes = 0
+        self.resume_time = 0
+
+    def set_maximum(self, maximum):
+        with self.condition:
+            self.maximum = self.limit = max(1, maximum)
+            self.condition.notify_all()
+
+    def __enter__(self):
+        with self.condition:
+            while True:
+                wait_time = self.resume_time - time.time()
+                if wait_time > 0:
+                    self.condition.wait(wait_time)
+                elif self.in_flight >= self.limit:
+                    self.condition.wait()
+                else:
+                    break
+            self.in_flight += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    # records a successful call, raising the limit by one after limit successes in a row
+    def succeeded(self):
+        with self.condition:
+            self.successes += 1
+            if self.limit < self.maximum and self.successes >= self.limit:
+                self.limit += 1
+                self.successes = 0
+                self.condition.notify()
+
+    # records a rate limited call: halves the limit unless it was already lowered within the current backoff, and
+    # holds every new call back until the backoff has passed
+    def rate_limited(self, backoff):
+        with self.condition:
+            self.successes = 0
+            now = time.time()
+            if now >= self.resume_time:
+                self.limit = max(1, self.limit // 2)
+                print('dropbox rate limited; concurrency limit lowered to', self.limit,
+                      'and pausing for %.1f secs' % backoff)
+                app_logger.warning('Rate limited by dropbox; concurrency limit lowered to {0}'.format(self.limit))
+            self.resume_time = max(self.resume_time, now + backoff)
+
+
+# limits the upload and download bandwidth of all workers with a token bucket per direction. Each chunk waits until
+# the bucket holds its bytes; the bucket refills at the current rate and holds at most one second of transfer. The rate
+# is --upload-limit / --download-limit unless a window of the --bandwidth-schedule file covers the current local time.
+# The schedule file is re-read when it changes so that the limits of a running --watch / --longpoll process can be
+# adjusted without a restart. A rate of 0 is unlimited
+class BandwidthLimiter(object):
+
+    def __init__(self, upload_limit=0, download_limit=0, schedule_file=None):
+        self.default_rates = {'upload': upload_limit * 1024 * 1024, 'download': download_limit * 1024 * 1024}
+        self.schedule_file = schedule_file
+        self.schedule_mtime = None
+        self.schedule_checked = time.time()
+        self.rules = []
+        self.lock = threading.Lock()
+        # direction -> [tokens, last refill time, rate]
+        self.buckets = dict((direction, [0.0, time.time(), None]) for direction in self.default_rates)
+        if schedule_file:
+            self.schedule_mtime = os.stat(schedule_file).st_mtime_ns
+            self.rules = parse_bandwidth_schedule(schedule_file)
+
+    # returns the current rate in bytes/sec of the given direction, 0 if unlimited
+    def get_rate(self, direction):
+        with self.lock:
+            return self.get_current_rate(direction)
+
+    # returns the current rate of the given direction; called holding the lock
+    def get_current_rate(self, direction):
+        self.reload_schedule()
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rates in self.rules:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                return rates[direction]
+        return self.default_rates[direction]
+
+    # re-reads the schedule file when it has changed, at most every BANDWIDTH_SCHEDULE_CHECK_INTERVAL seconds. An
+    # invalid or missing file is logged once and the previous schedule is kept
+    def reload_schedule(self):
+        now = time.time()
+        if not self.schedule_file or now - self.schedule_checked < BANDWIDTH_SCHEDULE_CHECK_INTERVAL:
+            return
+        self.schedule_checked = now
+        try:
+            mtime = os.stat(self.schedule_file).st_mtime_ns
+        except OSError as err:
+            if self.schedule_mtime is not None:
+                self.schedule_mtime = None
+                app_logger.error(
+                    'Unable to read the bandwidth schedule; keeping the previous schedule. {0}'.format(err))
+            return
+        if mtime == self.schedule_mtime:
+            return
+        self.schedule_mtime = mtime
+        try:
+            self.rules = parse_bandwidth_schedule(self.schedule_file)
+            log_info_event('Bandwidth schedule reloaded from ' + self.schedule_file)
+        except (OSError, ValueError) as err:
+            app_logger.error('Invalid bandwidth schedule; keeping the previous schedule. {0}'.format(err))
+
+    # waits until byte_count bytes may be transferred in the given direction
+    def consume(self, direction, byte_count):
+        with self.lock:
+            rate = self.get_current_rate(direction)
+            bucket = self.buckets[direction]
+            now = time.time()
+            if rate != bucket[2]:
+                if bucket[2] is not None or rate:
+                    log_info_event('{0} bandwidth limit set to {1}'.format(
+                        direction, '%.2f MB/sec' % (rate / 1024.0 / 1024) if rate else 'unlimited'))
+                bucket[0] = min(bucket[0], rate)
+                bucket[2] = rate
+            if not rate:
+                return
+            bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate) - byte_count
+            bucket[1] = now
+            delay = -bucket[0] / rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+# parses a --bandwidth-schedule file and returns its (start minute, end minute, direction -> bytes/sec) rules. Each line
+# holds a local time window and the upload and download megabytes/sec that apply during it, 0 for unlimited, e.g.
+#   22:00-07:00 0 0
+#   07:00-22:00 2 4
+# windows may wrap around midnight and the first window covering the current time applies. # starts a comment
+def parse_bandwidth_schedule(file_name):
+    rules = []
+    with open(file_name) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            try:
+                window, upload_limit, download_limit = line.split()
+                start, end = [parse_schedule_time(t) for t in window.split('-')]
+                rates = {'upload': float(upload_limit) * 1024 * 1024, 'download': float(download_limit) * 1024 * 1024}
+                if min(rates.values()) < 0:
+                    raise ValueError('negative limit')
+            except ValueError:
+                raise ValueError('{0} line {1}: expected HH:MM-HH:MM UPLOAD DOWNLOAD but found "{2}"'.format(
+                    file_name, line_number, line))
+            rules.append((start, end, rates))
+    return rules
+
+
+# returns the minute of the day of the given HH:MM time
+def parse_schedule_time(text):
+    hours, minutes = text.split(':')
+    minute = int(hours) * 60 + int(minutes)
+    if not 0 <= int(minutes) < 60 or not 0 <= minute <= 24 * 60:
+        raise ValueError('invalid time ' + text)
+    return minute
+
+
+# the transfer prompts asked once per plan by SyncPlan.confirm: direction -> (actions, message, default answer)
+PLAN_PROMPTS = {
+    'upload': ((('upload', 'copy', 'move'), 'Upload and save %d new files (%d bytes)', True),
+               (('upload_overwrite',), 'Upload and overwrite %d changed files on dropbox (%d bytes)', False)),
+    'download': ((('download',), 'Download and save %d new files (%d bytes)', True),
+                 (('download_overwrite',), 'Download and overwrite %d local files (%d bytes)', True))}
+
+
+# the upload or download plan of a traversal. The traversal only compares and adds a PlanAction per file; the plan is
+# then reported, confirmed once per kind of transfer instead of once per file and executed as a whole. With --dry-run
+# the plan is only reported. Plans are exported as json by --plan-file
+class SyncPlan(object):
+
+    def __init__(self, direction, args):
+        self.direction = direction
+        self.args = args
+        self.actions = []
+        self.transfer_count = 0
+        self.failure_count = 0
+        # whether a download plan was made from the changes since the saved listing cursor rather than a full listing
+        self.incremental = False
+        # the changes made on dropbox since the last upload traversal of an upload plan, see list_remote_changes
+        self.remote_changes = {}
+        # the lower case dropbox folders holding entries left out of a download plan by the ignore rules
+        self.ignored_folders = set()
+
+    # adds an action to the plan
+    def add(self, action, local_path, dropbox_path, size, reason, job=None):
+        self.actions.append(PlanAction(action, local_path, dropbox_path, size, reason, job))
+        progress.count_checked()
+        if action not in ('skip', 'case_conflict'):
+            self.transfer_count += 1
+
+    # returns action -> [file count, byte count] of the plan
+    def get_totals(self):
+        totals = {}
+        for action in self.actions:
+            total = totals.setdefault(action.action, [0, 0])
+            total[0] += 1
+            total[1] += action.size
+        return totals
+
+    # returns the plan as a json serializable dict
+    def to_dict(self):
+        return {'direction': self.direction,
+                'dropbox_folder': self.args.dropbox_folder,
+                'local_sync_folder': os.path.expanduser(self.args.local_sync_folder),
+                'dry_run': self.args.dry_run,
+                'totals': dict((action, {'files': count, 'bytes': size})
+                               for action, (count, size) in self.get_totals().items()),
+                'actions': [{'action': a.action, 'local_path': a.local_path, 'dropbox_path': a.dropbox_path,
+                             'size': a.size, 'reason': a.reason} for a in self.actions]}
+
+    # prints the planned transfers and logs the totals of the plan
+    def report(self):
+        if self.args.plan_file:
+            sync_plans[(self.direction, os.path.expanduser(self.args.local_sync_folder))] = self
+        prefix = '[dry run] ' if self.args.dry_run else ''
+        for action in self.actions:
+            if action.action != 'skip':
+                print(prefix + action.action, action.dropbox_path.encode('ascii', 'ignore'), action.size, 'bytes',
+                      '[%s]' % action.reason)
+        totals = self.get_totals()
+        log_info_event('{0}{1} plan: {2}'.format(prefix, self.direction, ', '.join(
+            '{0} {1} ({2} bytes)'.format(action, count, size) for action, (count, size) in sorted(totals.items()))
+            or 'nothing to do'))
+
+    # asks once per kind of transfer whether the planned transfers should be made; declined transfers are skipped
+    def confirm(self):
+        declined = set()
+        for actions, message, default in PLAN_PROMPTS[self.direction]:
+            planned = [a for a in self.actions if a.action in actions]
+            if planned and not yesno(message % (len(planned), sum(a.size for a in planned)), default, self.args):
+                declined.update(actions)
+        if declined:
+            self.actions = [a._replace(action='skip', reason='declined', job=None) if a.action in declined else a
+                            for a in self.actions]
+
+    # reports, confirms and executes the plan and returns the new file, updated file and byte counts
+    def run(self, dbx):
+        self.report()
+        if self.args.dry_run:
+            return 0, 0, 0
+        self.confirm()
+        return self.execute(dbx)
+
+    # executes the plan. Local folders are created and relocations made first. With --zip-downloads the folders found
+    # by find_zip_folders are queued as one zip download each. Files up to LARGE_TRANSFER_SIZE are then transferred
+    # smallest first so that most files complete early, while larger files run largest first on a quarter of the
+    # workers so that a few huge files neither hold up the small ones nor end up as a long tail
+    def execute(self, dbx):
+        zip_folders = self.find_zip_folders() if self.direction == 'download' and self.args.zip_downloads else []
+        zipped = set(id(a) for _, downloads in zip_folders for a in downloads)
+        transfers = [a for a in self.actions
+                     if a.job is not None and a.action not in ('copy', 'move') and id(a) not in zipped]
+        small = sorted((a for a in transfers if a.size <= LARGE_TRANSFER_SIZE), key=lambda a: a.size)
+        large = sorted((a for a in transfers if a.size > LARGE_TRANSFER_SIZE), key=lambda a: a.size, reverse=True)
+        workers = transfer_schedulers[self.direction].workers
+        large_workers = min(len(large), max(1, workers // 4)) if workers > 1 and small and large else 0
+        pool = (UploadPool if self.direction == 'upload' else DownloadPool)(dbx, self.args, large_workers)
+
+        for action in self.actions:
+            if action.action == 'create_folder':
+                ensure_and_get_folder(action.local_path, False)
+                save_sync_folder(action.local_path, action.dropbox_path)
+            elif action.action == 'download':
+                ensure_and_get_folder(os.path.dirname(action.local_path), False)
+            elif action.action in ('copy', 'move'):
+                pool.relocate(action.action == 'move', *action.job)
+
+        if zip_folders:
+            log_info_event('Downloading {0} folders as zip archives ({1} files)'.format(len(zip_folders), len(zipped)))
+        for folder_path, downloads in zip_folders:
+            pool.submit_zip(folder_path, downloads)
+
+        if large_workers:
+            for action in large:
+                pool.submit_large(*action.job)
+            large = []
+        for action in small + large:
+            pool.submit(*action.job)
+
+        result = pool.close()
+        self.failure_count = pool.failure_count
+        return result
+
+    # returns the (lower case dropbox folder path, planned downloads) of the folders of a download plan that are
+    # downloaded as a single zip archive: the top most folders below the dropbox folder, or the dropbox folder itself,
+    # where ZIP_DOWNLOAD_MIN_FILES and ZIP_DOWNLOAD_MIN_NEW_SHARE of the files are new locally and the files are small
+    # on average. An incremental plan leaves out the unchanged files of a folder, so only folders new locally qualify.
+    # A zip archive can't leave out ignored entries, so folders holding any aren't zipped
+    def find_zip_folders(self):
+        dropbox_root = get_dropbox_root(self.args.dropbox_folder).lower()
+        ignored_folders = set()
+        for path in self.ignored_folders:
+            while path and path not in ignored_folders:
+                ignored_folders.add(path)
+                path = path.rsplit('/', 1)[0]
+        # folder path -> [file count, byte count, [new file downloads]], folder path -> number of sub folders
+        folders = collections.defaultdict(lambda: [0, 0, []])
+        sub_folder_counts = collections.Counter()
+        new_folders = set()
+        for action in self.actions:
+            path = action.dropbox_path.lower()
+            if action.action == 'create_folder':
+                new_folders.add(path)
+            while '/' in path and path != dropbox_root:
+                path = path.rsplit('/', 1)[0]
+                if action.action == 'create_folder':
+                    sub_folder_counts[path] += 1
+                else:
+                    folder = folders[path]
+                    folder[0] += 1
+                    folder[1] += action.size
+                    if action.action == 'download':
+                        folder[2].append(action)
+
+        zip_folders = []
+        for path in sorted(folders, key=lambda p: p.count('/')):
+            file_count, byte_count, downloads = folders[path]
+            if (path and
+                    path not in ignored_folders and
+                    (path in new_folders or not self.incremental) and
+                    len(downloads) >= max(ZIP_DOWNLOAD_MIN_FILES, file_count * ZIP_DOWNLOAD_MIN_NEW_SHARE) and
+                    byte_count <= file_count * ZIP_DOWNLOAD_MAX_AVERAGE_SIZE and
+                    file_count + sub_folder_counts[path] < ZIP_DOWNLOAD_MAX_ENTRIES and
+                    not any(path.startswith(zip_path + '/') for zip_path, _ in zip_folders)):
+                zip_folders.append((path, downloads))
+        return zip_folders
+
+
+# runs the transfer jobs of every sync root on one set of worker threads per direction. Jobs are queued per key (the
+# local sync folder of the root) and the workers take the next job from each key in turn, so a root with a large
+# backlog can't starve the others. A key can be limited to a number of concurrently running jobs. The worker threads
+# start on demand and each create one dropbox client / http connection pool that is kept for the rest of the run
+class TransferScheduler(object):
+
+    def __init__(self, workers, label):
+        self.workers = workers
+        self.label = label
+        self.condition = threading.Condition()
+        # key -> deque of (func, args) in round robin order
+        self.queues = collections.OrderedDict()
+        # key -> number of running jobs, key -> maximum number of running jobs
+        self.running = collections.Counter()
+        self.limits = {}
+        self.threads = []
+        self.worker_state = threading.local()
+
+    # limits the number of concurrently running jobs of the given key
+    def set_limit(self, key, limit):
+        with self.condition:
+            self.limits[key] = limit
+
+    # queues func(*args) under the given key
+    def submit(self, key, func, *args):
+        with self.condition:
+            self.queues.setdefault(key, collections.deque()).append((func, args))
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.run_worker, name='%s_%d' % (self.label, len(self.threads)),
+                                          daemon=True)
+                self.threads.append(thread)
+                thread.start()
+            self.condition.notify()
+
+    # returns the next job and its key, moving the key to the back of the round robin; called holding the condition
+    def next_job(self):
+        for key, jobs in self.queues.items():
+            if self.running[key] < self.limits.get(key, self.workers):
+                func, args = jobs.popleft()
+                del self.queues[key]
+                if jobs:
+                    self.queues[key] = jobs
+                self.running[key] += 1
+                return key, func, args
+        return None
+
+    # runs queued jobs for the rest of the process
+    def run_worker(self):
+        while True:
+            with self.condition:
+                job = self.next_job()
+                while job is None:
+                    self.condition.wait()
+                    job = self.next_job()
+            key, func, args = job
+            try:
+                func(*args)
+            finally:
+                with self.condition:
+                    self.running[key] -= 1
+                    self.condition.notify_all()
+
+    # returns the dropbox client owned by the current worker thread
+    def worker_dbx(self, token):
+        if not hasattr(self.worker_state, 'dbx'):
+            self.worker_state.dbx = create_dropbox_client(token, session=dropbox.create_session(max_connections=2))
+        return self.worker_state.dbx
+
+
+# caps the bytes held in memory by the in flight parallel uploads of every sync root at --upload-buffer megabytes
+class MemoryBudget(object):
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    # waits until size bytes (at most the whole budget) are available and returns the bytes taken
+    def acquire(self, size):
+        size = min(size, self.limit)
+        with self.condition:
+            while self.used + size > self.limit:
+                self.condition.wait()
+            self.used += size
+        return size
+
+    # returns bytes taken by acquire
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+# runs file transfers for a traversal and keeps the transfer counters reported by complete_process. With a single
+# worker transfers run inline on the calling thread, otherwise they are queued to the TransferScheduler of the
+# direction under the local sync folder of the root. At most large_workers of the workers run the jobs queued by
+# submit_large. Per worker throughput is logged when the pool is closed
+class TransferPool(object):
+
+    def __init__(self, dbx, args, label, large_workers=0):
+        self.dbx = dbx
+        self.args = args
+        self.label = label
+        self.scheduler = transfer_schedulers[label]
+        self.key = os.path.expanduser(args.local_sync_folder)
+        self.large_key = (self.key, 'large')
+        self.large_workers = large_workers
+        if large_workers:
+            self.scheduler.set_limit(self.large_key, large_workers)
+        self.new_file_count = 0
+        self.updated_file_count = 0
+        self.byte_count = 0
+        self.failure_count = 0
+        self.lock = threading.Lock()
+        # thread name -> [file count, byte count, busy seconds]
+        self.worker_stats = {}
+        # bounds the number of queued transfers so a fast traversal can't run arbitrarily far ahead of the workers
+        self.queue_slots = threading.BoundedSemaphore(self.scheduler.workers * 64)
+        # the number of queued and running transfers
+        self.pending_count = 0
+        self.pending_condition = threading.Condition()
+
+    # runs the given transfer job, inline or on a worker thread
+    def submit(self, *job):
+        self.queue(self.key, job)
+
+    # runs the given transfer job on the workers allowed to run large transfers
+    def submit_large(self, *job):
+        self.queue(self.large_key if self.large_workers else self.key, job)
+
+    # runs the given transfer job inline or queues it to the scheduler under the given key. The job is run by the given
+    # method of the pool, by default run
+    def queue(self, key, job, run=None):
+        run = run or self.run
+        if self.scheduler.workers <= 1:
+            self.run_timed(self.dbx, run, *job)
+        else:
+            self.queue_slots.acquire()
+            with self.pending_condition:
+                self.pending_count += 1
+            self.scheduler.submit(key, self.run_on_worker, run, *job)
+
+    # returns the number of files transferred so far
+    def file_count(self):
+        with self.lock:
+            return self.new_file_count + self.updated_file_count
+
+    # waits for all queued transfers to finish and logs the worker throughput
+    def shutdown(self):
+        with self.pending_condition:
+            while self.pending_count:
+                self.pending_condition.wait()
+        if self.worker_stats and self.scheduler.workers > 1:
+            self.log_worker_throughput()
+            self.worker_stats = {}
+
+    # waits for all queued transfers to finish and returns the new file, updated file and byte counts
+    def close(self):
+        self.shutdown()
+        return self.new_file_count, self.updated_file_count, self.byte_count
+
+    # logs the files, bytes and bytes/sec transferred by each worker thread
+    def log_worker_throughput(self):
+        for worker_name, (file_count, byte_count, busy_time) in sorted(self.worker_stats.items()):
+            log_info_event('{0}: {1} files, {2} bytes in {3:.1f} secs ({4:.0f} bytes/sec)'.format(
+                worker_name, file_count, byte_count, busy_time, byte_count / busy_time if busy_time else 0))
+
+    # runs a transfer job on a worker thread
+    def run_on_worker(self, run, *job):
+        try:
+            self.run_timed(self.scheduler.worker_dbx(self.args.token), run, *job)
+        except Exception as e:
+            print('***', self.label, 'worker exception for', job[0].encode('ascii', 'ignore'), e)
+            app_logger.error('Caught a {0} worker exception; the process will continue. {1} {2}'.format(
+                self.label, job[0], e))
+            with self.lock:
+                self.failure_count += 1
+        finally:
+            self.queue_slots.release()
+            with self.pending_condition:
+                self.pending_count -= 1
+                self.pending_condition.notify_all()
+
+    # runs a transfer job and adds its elapsed time and bytes to the stats of the current thread
+    def run_timed(self, dbx, run, *job):
+        t0 = time.time()
+        byte_count = run(dbx, *job)
+        with self.lock:
+            stats = self.worker_stats.setdefault(threading.current_thread().name, [0, 0, 0.0])
+            stats[0] += 1 if byte_count is not None else 0
+            stats[1] += byte_count or 0
+            stats[2] += time.time() - t0
+
+    # records the outcome of a transfer and returns the transferred byte count or None on failure
+    def record(self, byte_count, overwrite):
+        progress.count_transfer(self.label, byte_count)
+        with self.lock:
+            if byte_count is None:
+                self.failure_count += 1
+            else:
+                if overwrite:
+                    self.updated_file_count += 1
+                else:
+                    self.new_file_count += 1
+                self.byte_count += byte_count
+        return byte_count
+
+    # performs a single transfer; implemented by subclasses
+    def run(self, dbx, *job):
+        raise NotImplementedError
+
+
+# runs file uploads. The bytes read into memory by in flight parallel uploads are capped at --upload-buffer megabytes:
+# a one shot upload holds the whole file and a chunked upload holds its chunks in flight and the chunk read ahead
+class UploadPool(TransferPool):
+
+    def __init__(self, dbx, args, large_workers=0):
+        TransferPool.__init__(self, dbx, args, 'upload', large_workers)
+        # (full_filename, local_file, overwrite, UploadSessionFinishArg) of uploads waiting to be committed
+        self.pending_batch = []
+        # (full_filename, local_file, upload job, content_hash, RelocationPath) of copies waiting to be made
+        self.pending_copies = []
+        self.relocated_file_count = 0
+
+    # runs an upload on a worker thread once its share of the memory buffer is available
+    def run_on_worker(self, run, full_filename, local_file, *job):
+        buffer_size = upload_buffer.acquire(
+            local_file.size if local_file.size <= UPLOAD_MAX_SIZE else get_chunked_upload_buffer_size(local_file.size))
+        try:
+            TransferPool.run_on_worker(self, run, full_filename, local_file, *job)
+        finally:
+            upload_buffer.release(buffer_size)
+
+    # uploads a file and updates the upload counters and the sync state index with the result. With --batch-uploads
+    # small files are uploaded into closed upload sessions which are committed UPLOAD_BATCH_SIZE files at a time
+    def run(self, dbx, full_filename, local_file, folder, subfolder, name, overwrite=False):
+        if self.args.batch_uploads and local_file.size <= UPLOAD_MAX_SIZE:
+            finish_arg = upload_session_for_batch(dbx, full_filename, local_file, folder, subfolder, name, overwrite)
+            if finish_arg is None:
+                return self.record(None, overwrite)
+            batch = None
+            with self.lock:
+                self.pending_batch.append((full_filename, local_file, overwrite, finish_arg))
+                if len(self.pending_batch) >= UPLOAD_BATCH_SIZE:
+                    batch, self.pending_batch = self.pending_batch, []
+            if batch:
+                self.commit_batch(dbx, batch)
+            return local_file.size
+
+        res = upload(dbx, full_filename, folder, subfolder, name, overwrite=overwrite, local_file=local_file)
+        if res is not None:
+            save_sync_state(full_filename, local_file, res)
+        return self.record(local_file.size if res is not None else None, overwrite)
+
+    # commits a batch of upload sessions and records the result of each file
+    def commit_batch(self, dbx, batch):
+        results = commit_upload_batch(dbx, [finish_arg for _, _, _, finish_arg in batch])
+        for (full_filename, local_file, overwrite, _), res in zip(batch, results):
+            if res is not None:
+                save_sync_state(full_filename, local_file, res)
+            self.record(local_file.size if res is not None else None, overwrite)
+
+    # moves or copies the file already on dropbox at source_dropbox_path to the destination of the given new file
+    # instead of uploading it. Copies are queued and made in batches. Files that can't be moved or copied are uploaded
+    def relocate(self, move, full_filename, local_file, folder, subfolder, name, source_local_path, source_dropbox_path,
+                 content_hash):
+        destination_path = get_destination_path(folder, subfolder, name)
+
+        if move:
+            res = move_remote_file(self.dbx, source_dropbox_path, destination_path, content_hash)
+            if res is None:
+                self.submit(full_filename, local_file, folder, subfolder, name)
+                return
+            print(name.encode('ascii', 'ignore'), 'moved on dropbox from',
+                  source_dropbox_path.encode('ascii', 'ignore'))
+            delete_sync_state(source_local_path)
+            self.record_relocation(full_filename, local_file, res)
+            return
+
+        batch = None
+        with self.lock:
+            self.pending_copies.append((full_filename, local_file, (folder, subfolder, name), content_hash,
+                                        dropbox.files.RelocationPath(source_dropbox_path, destination_path)))
+            if len(self.pending_copies) >= RELOCATE_BATCH_SIZE:
+                batch, self.pending_copies = self.pending_copies, []
+        if batch:
+            self.copy_batch(batch)
+
+    # makes a batch of queued copies, uploading the files that couldn't be copied or whose copy has other content
+    def copy_batch(self, batch):
+        results = copy_remote_files(self.dbx, [relocation_path for _, _, _, _, relocation_path in batch])
+        for (full_filename, local_file, job, content_hash, relocation_path), res in zip(batch, results):
+            if res is not None and res.content_hash == content_hash:
+                print(job[2].encode('ascii', 'ignore'), 'copied on dropbox from',
+                      relocation_path.from_path.encode('ascii', 'ignore'))
+                self.record_relocation(full_filename, local_file, res)
+            else:
+                # overwrite a copy whose source had changed on dropbox since it was indexed
+                self.submit(full_filename, local_file, *(job + (res is not None,)))
+
+    # records a file moved or copied on dropbox as a new file without transferred bytes
+    def record_relocation(self, full_filename, local_file, res):
+        save_sync_state(full_filename, local_file, res)
+        self.record(0, False)
+        with self.lock:
+            self.relocated_file_count += 1
+
+    # waits for all queued uploads to finish, commits any remaining batched uploads and returns the counts
+    def close(self):
+        if self.pending_copies:
+            batch, self.pending_copies = self.pending_copies, []
+            self.copy_batch(batch)
+        if self.relocated_file_count:
+            log_info_event('{0} files moved or copied on dropbox instead of being uploaded'.format(
+                self.relocated_file_count))
+        self.shutdown()
+        if self.pending_batch:
+            batch, self.pending_batch = self.pending_batch, []
+            self.commit_batch(self.dbx, batch)
+        return TransferPool.close(self)
+
+
+# runs file downloads. Local folders are created by SyncPlan.execute before the files are queued
+class DownloadPool(TransferPool):
+
+    def __init__(self, dbx, args, large_workers=0):
+        TransferPool.__init__(self, dbx, args, 'download', large_workers)
+
+    # runs the planned downloads of the given dropbox folder as a single zip download, see run_zip
+    def submit_zip(self, folder_path, downloads):
+        self.queue(self.key, (folder_path, downloads), self.run_zip)
+
+    # downloads a file and updates the download counters with the result
+    def run(self, dbx, dropbox_file_name, target_file_name, overwrite=False, entry=None):
+        return self.record(download_and_save(dbx, dropbox_file_name, target_file_name), overwrite)
+
+    # downloads the given dropbox folder as a zip archive, then downloads the planned files that weren't saved from the
+    # archive one by one, and updates the download counters with the result of each file
+    def run_zip(self, dbx, folder_path, downloads):
+        saved = download_zip_and_save(dbx, folder_path, [a.job for a in downloads])
+        total_byte_count = 0
+        for action in downloads:
+            byte_count = saved.get(action.job[0])
+            if byte_count is None:
+                byte_count = download_and_save(dbx, *action.job[:2])
+            self.record(byte_count, False)
+            total_byte_count += byte_count or 0
+        return total_byte_count
 
 
 # A handy helper function to ask a yes/no question
@@ -559,7 +3183,7 @@ def yesno(message, default, args):
     """
     ascii_msg = message.encode('ascii', 'ignore')
     if args.default:
-        print(ascii_msg + '? [auto]', 'Y' if default else 'N')
+        print(ascii_msg + ('? [auto] ' + ('Y' if default else 'N')).encode('ascii'))
         return default
     if args.yes:
         print(ascii_msg + '? [auto] YES'.encode('ascii'))
@@ -592,7 +3216,7 @@ def yesno(message, default, args):
 def checkToken(dbx):
     # noinspection PyBroadException
     try:
-        dbx.users_get_current_account()
+        call_dropbox('check_token', dbx.users_get_current_account)
         return True
     except Exception as e:
         return False
@@ -603,6 +3227,298 @@ def app_base_path():
     return os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
 
+# opens the sqlite sync state index kept in the state folder under the app base path, creating it on first use.
+# the index records the local stat and the dropbox rev / content_hash of every file known to be in sync after a
+# successful transfer or comparison so that unchanged files can be skipped on later runs without any api calls
+def open_sync_state():
+    global sync_state_db
+    if sync_state_db is None:
+        db_filename = ensure_and_get_folder('state') + 'sync_state.db'
+        sync_state_db = sqlite3.connect(db_filename, timeout=60, check_same_thread=False)
+        sync_state_db.execute('PRAGMA journal_mode=WAL')
+        sync_state_db.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'local_path TEXT PRIMARY KEY, '
+            'dropbox_path TEXT NOT NULL, '
+            'size INTEGER NOT NULL, '
+            'mtime_ns INTEGER NOT NULL, '
+            'rev TEXT, '
+            'content_hash TEXT)')
+        sync_state_db.execute(
+            'CREATE INDEX IF NOT EXISTS files_size ON files (size)')
+        sync_state_db.execute(
+            'CREATE TABLE IF NOT EXISTS cursors ('
+            'dropbox_folder TEXT NOT NULL, '
+            'local_sync_folder TEXT NOT NULL, '
+            'cursor TEXT NOT NULL, '
+            'PRIMARY KEY (dropbox_folder, local_sync_folder))')
+        sync_state_db.execute(
+            'CREATE TABLE IF NOT EXISTS folders ('
+            'local_path TEXT PRIMARY KEY, '
+            'dropbox_path TEXT NOT NULL)')
+        sync_state_db.execute(
+            'CREATE TABLE IF NOT EXISTS upload_sessions ('
+            'local_path TEXT PRIMARY KEY, '
+            'dropbox_path TEXT NOT NULL, '
+            'size INTEGER NOT NULL, '
+            'mtime_ns INTEGER NOT NULL, '
+            'session_id TEXT NOT NULL, '
+            'offset INTEGER NOT NULL, '
+            'started REAL NOT NULL)')
+        # the content_hashes of an older index were keyed on the inode alone; being a cache they are simply dropped
+        if 'device' not in [c[1] for c in sync_state_db.execute('PRAGMA table_info(content_hashes)')]:
+            sync_state_db.execute('DROP TABLE IF EXISTS content_hashes')
+        sync_state_db.execute(
+            'CREATE TABLE IF NOT EXISTS content_hashes ('
+            'device INTEGER NOT NULL, '
+            'inode INTEGER NOT NULL, '
+            'size INTEGER NOT NULL, '
+            'mtime_ns INTEGER NOT NULL, '
+            'content_hash TEXT NOT NULL, '
+            'PRIMARY KEY (device, inode))')
+        sync_state_db.commit()
+    return sync_state_db
+
+
+# commits pending sync state index writes
+def commit_sync_state():
+    global sync_state_pending_writes
+    with sync_state_lock:
+        if sync_state_db is not None:
+            sync_state_db.commit()
+            sync_state_pending_writes = 0
+
+
+# commits and closes the sync state index
+def close_sync_state():
+    global sync_state_db
+    with sync_state_lock:
+        if sync_state_db is not None:
+            sync_state_db.commit()
+            sync_state_db.close()
+            sync_state_db = None
+
+
+# returns the sync state index record for the given local file as a
+# (dropbox_path, size, mtime_ns, rev, content_hash) tuple or None if the file isn't indexed
+def get_sync_state(local_path):
+    if sync_state_db is None:
+        return None
+    with sync_state_lock:
+        return sync_state_db.execute(
+            'SELECT dropbox_path, size, mtime_ns, rev, content_hash FROM files WHERE local_path = ?',
+            (local_path,)).fetchone()
+
+
+# returns an indicator whether the given local file stat (and optionally the remote rev and the dropbox path the file is
+# synced with) matches the sync state index
+def is_sync_state_unchanged(local_path, local_file, rev=None, dropbox_path=None):
+    record = get_sync_state(local_path)
+    return (record is not None and
+            record[1] == local_file.size and
+            record[2] == local_file.mtime_ns and
+            (rev is None or record[3] == rev) and
+            (dropbox_path is None or get_case_key(record[0]) == get_case_key(dropbox_path)))
+
+
+# records the given local file stat along with the dropbox FileMetadata it is in sync with in the sync state index
+def save_sync_state(local_path, local_file, metadata):
+    global sync_state_pending_writes
+    if sync_state_db is None:
+        return
+    with sync_state_lock:
+        sync_state_db.execute(
+            'INSERT OR REPLACE INTO files (local_path, dropbox_path, size, mtime_ns, rev, content_hash) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (local_path, metadata.path_display, local_file.size, local_file.mtime_ns,
+             metadata.rev, metadata.content_hash))
+        # commit in batches; a crash only loses index records, never data
+        sync_state_pending_writes += 1
+        if sync_state_pending_writes >= 100:
+            sync_state_db.commit()
+            sync_state_pending_writes = 0
+
+
+# returns the cached content_hash of the given LocalFile or None if the file has changed or wasn't hashed before
+def get_cached_content_hash(local_file):
+    if sync_state_db is None:
+        return None
+    with sync_state_lock:
+        record = sync_state_db.execute(
+            'SELECT content_hash FROM content_hashes WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ?',
+            (local_file.device, local_file.inode, local_file.size, local_file.mtime_ns)).fetchone()
+    return record[0] if record else None
+
+
+# caches the content_hash of the given LocalFile, replacing the hash of an earlier version of the same device / inode
+def save_cached_content_hash(local_file, content_hash):
+    global sync_state_pending_writes
+    if sync_state_db is None:
+        return
+    with sync_state_lock:
+        sync_state_db.execute(
+            'INSERT OR REPLACE INTO content_hashes (device, inode, size, mtime_ns, content_hash) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (local_file.device, local_file.inode, local_file.size, local_file.mtime_ns, content_hash))
+        sync_state_pending_writes += 1
+        if sync_state_pending_writes >= 100:
+            sync_state_db.commit()
+            sync_state_pending_writes = 0
+
+
+# removes the sync state index record of the given local file
+def delete_sync_state(local_path):
+    if sync_state_db is None:
+        return
+    with sync_state_lock:
+        sync_state_db.execute('DELETE FROM files WHERE local_path = ?', (local_path,))
+
+
+# returns the (local_path, dropbox_path, size, mtime_ns, rev) sync state index records of the files below the given
+# local folder
+def get_sync_states_under(local_folder):
+    if sync_state_db is None:
+        return []
+    with sync_state_lock:
+        return sync_state_db.execute(
+            'SELECT local_path, dropbox_path, size, mtime_ns, rev FROM files WHERE local_path > ? AND local_path < ?',
+            get_path_range(local_folder)).fetchall()
+
+
+# returns the (exclusive) bounds of the paths below the given local folder for a range query on a path column
+def get_path_range(local_folder):
+    prefix = local_folder.rstrip(os.path.sep) + os.path.sep
+    return prefix, prefix[:-1] + chr(ord(os.path.sep) + 1)
+
+
+# returns the dropbox path the given local folder is known to exist at or None
+def get_sync_folder(local_path):
+    if sync_state_db is None:
+        return None
+    with sync_state_lock:
+        record = sync_state_db.execute(
+            'SELECT dropbox_path FROM folders WHERE local_path = ?', (local_path,)).fetchone()
+    return record[0] if record else None
+
+
+# records that the given local folder exists on dropbox at the given path
+def save_sync_folder(local_path, dropbox_path):
+    global sync_state_pending_writes
+    if sync_state_db is None:
+        return
+    with sync_state_lock:
+        sync_state_db.execute('INSERT OR REPLACE INTO folders (local_path, dropbox_path) VALUES (?, ?)',
+                              (local_path, dropbox_path))
+        sync_state_pending_writes += 1
+        if sync_state_pending_writes >= 100:
+            sync_state_db.commit()
+            sync_state_pending_writes = 0
+
+
+# returns the (local_path, dropbox_path) records of the folders below the given local folder known to exist on dropbox
+def get_sync_folders_under(local_folder):
+    if sync_state_db is None:
+        return []
+    with sync_state_lock:
+        return sync_state_db.execute(
+            'SELECT local_path, dropbox_path FROM folders WHERE local_path > ? AND local_path < ?',
+            get_path_range(local_folder)).fetchall()
+
+
+# removes the folder records of the given local folder and the folders below it from the sync state index
+def delete_sync_folders_under(local_folder):
+    if sync_state_db is None:
+        return
+    with sync_state_lock:
+        sync_state_db.execute('DELETE FROM folders WHERE local_path = ?', (local_folder,))
+        sync_state_db.execute('DELETE FROM folders WHERE local_path > ? AND local_path < ?',
+                              get_path_range(local_folder))
+
+
+# returns an indicator whether the sync state index holds a file of the given size
+def has_sync_state_size(size):
+    if sync_state_db is None:
+        return False
+    with sync_state_lock:
+        return sync_state_db.execute('SELECT 1 FROM files WHERE size = ? LIMIT 1', (size,)).fetchone() is not None
+
+
+# returns the (local_path, dropbox_path) of the indexed files with the given size and content hash
+def get_sync_states_by_content(size, content_hash):
+    if sync_state_db is None:
+        return []
+    with sync_state_lock:
+        return sync_state_db.execute(
+            'SELECT local_path, dropbox_path FROM files WHERE size = ? AND content_hash = ?',
+            (size, content_hash)).fetchall()
+
+
+# returns the list folder cursor saved at the end of the last download traversal of the given folder pair (or of the
+# last upload traversal, for a dropbox folder starting with UPLOAD_CURSOR_PREFIX) or None
+def get_sync_cursor(dropbox_folder, local_sync_folder):
+    if sync_state_db is None:
+        return None
+    with sync_state_lock:
+        record = sync_state_db.execute(
+            'SELECT cursor FROM cursors WHERE dropbox_folder = ? AND local_sync_folder = ?',
+            (dropbox_folder, local_sync_folder)).fetchone()
+    return record[0] if record else None
+
+
+# saves the list folder cursor for the given folder pair in the sync state index
+def save_sync_cursor(dropbox_folder, local_sync_folder, cursor):
+    if sync_state_db is None:
+        return
+    with sync_state_lock:
+        sync_state_db.execute(
+            'INSERT OR REPLACE INTO cursors (dropbox_folder, local_sync_folder, cursor) VALUES (?, ?, ?)',
+            (dropbox_folder, local_sync_folder, cursor))
+        sync_state_db.commit()
+
+
+# returns the (session_id, offset) of the saved upload session for the given local file or None if there is no saved
+# session, the file has changed since the session was started or the session is too old to be continued
+def get_upload_session(local_path, local_file, dropbox_path):
+    if sync_state_db is None:
+        return None
+    with sync_state_lock:
+        record = sync_state_db.execute(
+            'SELECT session_id, offset, dropbox_path, size, mtime_ns, started FROM upload_sessions '
+            'WHERE local_path = ?', (local_path,)).fetchone()
+    if (record is None or
+            record[2] != dropbox_path or
+            record[3] != local_file.size or
+            record[4] != local_file.mtime_ns or
+            time.time() - record[5] > UPLOAD_SESSION_MAX_AGE):
+        return None
+    return record[0], record[1]
+
+
+# saves the session id and confirmed offset of an in progress upload session for the given local file
+def save_upload_session(local_path, local_file, dropbox_path, cursor):
+    if sync_state_db is None:
+        return
+    with sync_state_lock:
+        record = sync_state_db.execute(
+            'SELECT started FROM upload_sessions WHERE local_path = ? AND session_id = ?',
+            (local_path, cursor.session_id)).fetchone()
+        sync_state_db.execute(
+            'INSERT OR REPLACE INTO upload_sessions '
+            '(local_path, dropbox_path, size, mtime_ns, session_id, offset, started) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (local_path, dropbox_path, local_file.size, local_file.mtime_ns, cursor.session_id, cursor.offset,
+             record[0] if record else time.time()))
+        sync_state_db.commit()
+
+
+# removes the saved upload session for the given local file
+def delete_upload_session(local_path):
+    if sync_state_db is None:
+        return
+    with sync_state_lock:
+        sync_state_db.execute('DELETE FROM upload_sessions WHERE local_path = ?', (local_path,))
+        sync_state_db.commit()
+
+
 # Returns the run-time log directory for this script in the file system
 def ensure_and_get_folder(folder_name, use_base_path=True):
     full_folder_path = (app_base_path() + '/' + folder_name if use_base_path else folder_name)
@@ -617,7 +3533,6 @@ def ensure_and_get_folder(folder_name, use_base_path=True):
 # Attempts to acquire a lock for the script. Automatically creates a lock file for the given rootdir ensuring multiple
 # instances of the script can run concurrently for different rootdir folders
 def acquireLock(rootdir):
-    global processLockFile
     lock_file_name = rootdir.replace('/', '.').replace('~', '')
     processLockFile = ensure_and_get_folder('lock') + lock_file_name
     if not os.path.isfile(processLockFile):
@@ -627,42 +3542,98 @@ def acquireLock(rootdir):
     lock = lockfile.FileLock(processLockFile)
     try:
         lock.acquire(0)
+        processLockFiles.append(processLockFile)
         return True
     except lockfile.AlreadyLocked:
         return False
 
 
-# Releases a previously acquired lock
+# Releases the previously acquired locks
 def releaseLock():
-    global processLockFile
-    lock = lockfile.FileLock(processLockFile)
-    try:
-        lock.release()
-    except (lockfile.NotLocked, lockfile.NotMyLock):
-        print('lock release failure')
+    for processLockFile in processLockFiles:
+        lock = lockfile.FileLock(processLockFile)
+        try:
+            lock.release()
+        except (lockfile.NotLocked, lockfile.NotMyLock):
+            print('*** lock release failure')
 
 
 # Aborts the process with a reason descriptor and an exit code
 def abortProcess(reason, exitcode):
-    print(reason)
+    progress.stop()
+    builtins.print(reason)
     log_info_event('process aborted with: ' + reason, True)
     sys.exit(exitcode)
 
 
 # helper logging procedure
 def log_info_event(log_string, shutdown=False):
-    global app_logger
     if not app_logger:
-        log_filename = ensure_and_get_folder('log') + datetime.datetime.utcnow().strftime('%Y%m%d.%H%M%S%f') + '.log'
-        app_logger = logging.getLogger('dropbox_app_logger')
-        logging.basicConfig(filename=log_filename, level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s',
-                            datefmt='%d/%m/%Y %H:%M:%S')
-        # quieten down noisy module loggers
-        logging.getLogger('dropbox').setLevel(logging.WARNING)
-        logging.getLogger('requests.packages.urllib3').setLevel(logging.WARNING)
+        start_logging()
     app_logger.info(log_string)
     if shutdown:
-        logging.shutdown()
+        stop_logging()
+
+
+# creates the log file of this run in the log folder and routes all logging through a queue to a background listener
+# thread so that logging calls from the traversal and the workers never wait on file io. The log file is rotated at
+# LOG_MAX_SIZE bytes and old logs are removed from the log folder first, see prune_log_folder
+def start_logging():
+    global app_logger
+    global log_filename
+    global log_listener
+    log_folder = ensure_and_get_folder('log')
+    prune_log_folder(log_folder)
+    log_filename = log_folder + datetime.datetime.utcnow().strftime('%Y%m%d.%H%M%S%f') + '.log'
+    file_handler = logging.handlers.RotatingFileHandler(log_filename, maxBytes=LOG_MAX_SIZE,
+                                                        backupCount=LOG_BACKUP_COUNT)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s', datefmt='%d/%m/%Y %H:%M:%S'))
+    log_queue = queue.Queue()
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+    log_listener.start()
+    root_logger = logging.getLogger()
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(logging.INFO)
+    app_logger = logging.getLogger('dropbox_app_logger')
+    # quieten down noisy module loggers
+    logging.getLogger('dropbox').setLevel(logging.WARNING)
+    logging.getLogger('requests.packages.urllib3').setLevel(logging.WARNING)
+    atexit.register(stop_logging)
+
+
+# writes the queued log records and stops the log listener thread. Anything logged afterwards is written to the log
+# file directly
+def stop_logging():
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        root_logger = logging.getLogger()
+        for handler in list(root_logger.handlers):
+            if isinstance(handler, logging.handlers.QueueHandler):
+                root_logger.removeHandler(handler)
+        for handler in log_listener.handlers:
+            root_logger.addHandler(handler)
+        log_listener = None
+    logging.shutdown()
+
+
+# removes the logs and run summaries older than LOG_MAX_AGE days from the given log folder and then the oldest files
+# until the folder holds at most LOG_MAX_TOTAL_SIZE bytes
+def prune_log_folder(log_folder):
+    log_files = []
+    for entry in os.scandir(log_folder):
+        if entry.is_file(follow_symlinks=False):
+            entry_stat = entry.stat(follow_symlinks=False)
+            log_files.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+    oldest_time = time.time() - LOG_MAX_AGE * 86400
+    total_size = 0
+    for mtime, size, path in sorted(log_files, reverse=True):
+        total_size += size
+        if mtime < oldest_time or total_size > LOG_MAX_TOTAL_SIZE:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
 
 # logs the script runtime
@@ -711,7 +3682,9 @@ def complete_process(
     log_info_event('Updated files downloaded: {}'.format(download_updated_file_count))
     log_info_event('Total bytes downloaded: {}'.format(download_byte_count))
 
-    print(
+    progress.stop()
+    report_case_conflicts()
+    builtins.print(
         'New files uploaded: {}, Updated files uploaded: {}, Total bytes uploaded: {},'.format(
             upload_new_file_count,
             upload_updated_file_count,
@@ -722,21 +3695,272 @@ def complete_process(
             download_byte_count)
     )
 
+    metrics.write(get_run_counts(
+        upload_new_file_count,
+        upload_updated_file_count,
+        upload_byte_count,
+        download_new_file_count,
+        download_updated_file_count,
+        download_byte_count), True)
+
+    close_sync_state()
     log_runtime()
     log_info_event('Process finished', True)
     releaseLock()
 
 
+# returns the per run counters reported by complete_process as a metrics dictionary
+def get_run_counts(
+        upload_new_file_count,
+        upload_updated_file_count,
+        upload_byte_count,
+        download_new_file_count,
+        download_updated_file_count,
+        download_byte_count):
+    return {
+        'upload_new_files': upload_new_file_count,
+        'upload_updated_files': upload_updated_file_count,
+        'upload_bytes': upload_byte_count,
+        'download_new_files': download_new_file_count,
+        'download_updated_files': download_updated_file_count,
+        'download_bytes': download_byte_count}
+
+
 @contextlib.contextmanager
-def stopwatch(message):
-    """Context manager to print how long a block of code took."""
+def stopwatch(message, operation=None):
+    """Context manager to print how long a block of code took.
+
+    When an operation name is given the call, its latency, the byte_count set on the yielded measurement and any
+    exception raised are also recorded in the metrics registry. A message of None skips the print."""
     t0 = time.time()
+    measurement = types.SimpleNamespace(byte_count=0)
     try:
-        yield
+        yield measurement
+    except Exception as e:
+        if operation:
+            metrics.count_error(operation, e)
+        raise
     finally:
         t1 = time.time()
-        print('Total elapsed time for %s: %.3f' % (message, t1 - t0))
-
+        if operation:
+            metrics.observe(operation, t1 - t0, measurement.byte_count)
+        if message:
+            print('Total elapsed time for %s: %.3f' % (message, t1 - t0))
+
+
+# aggregate counters of the files checked and transferred by this run. With --progress a background thread prints them
+# as a single progress line every PROGRESS_INTERVAL seconds in place of the line per file console output
+class ProgressReporter(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.checked_count = 0
+        # direction -> [file count, byte count]
+        self.transfers = {'upload': [0, 0], 'download': [0, 0]}
+        self.failure_count = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    # counts a file compared by a traversal
+    def count_checked(self):
+        with self.lock:
+            self.checked_count += 1
+
+    # counts a transfer in the given direction; a byte_count of None is a failed transfer
+    def count_transfer(self, direction, byte_count):
+        with self.lock:
+            if byte_count is None:
+                self.failure_count += 1
+            else:
+                self.transfers[direction][0] += 1
+                self.transfers[direction][1] += byte_count
+
+    # starts the progress line thread
+    def start(self):
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self.run, name='progress', daemon=True)
+        self.thread.start()
+
+    # stops the progress line thread
+    def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    # prints the progress line until stopped
+    def run(self):
+        while not self.stopped.wait(PROGRESS_INTERVAL):
+            builtins.print(self.get_line())
+
+    # returns the progress line
+    def get_line(self):
+        with self.lock:
+            elapsed = max(time.time() - self.start_time, 1)
+            (upload_count, upload_bytes), (download_count, download_bytes) = (self.transfers['upload'],
+                                                                              self.transfers['download'])
+            return ('{0}: {1} files checked, {2} files ({3} bytes) uploaded, {4} files ({5} bytes) downloaded, '
+                    '{6} failed, {7:.2f} MB/sec').format(
+                time.strftime('%H:%M:%S'), self.checked_count, upload_count, upload_bytes, download_count,
+                download_bytes, self.failure_count, (upload_bytes + download_bytes) / elapsed / 1024 / 1024)
+
+
+# per operation call counts, latency histograms, byte counts, errors by exception type and retry counts for this run.
+# Written as a prometheus node-exporter textfile (--metrics-textfile) and as a json run summary next to the run log
+class MetricsRegistry(object):
+
+    # latency histogram bucket upper bounds in seconds
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.textfile = None
+        self.labels = {}
+        self.last_write = 0
+
+    # returns the stats of the given operation, creating them on first use. Callers hold the lock
+    def get(self, operation):
+        if operation not in self.operations:
+            self.operations[operation] = {
+                'calls': 0,
+                'seconds': 0.0,
+                'max_seconds': 0.0,
+                'bytes': 0,
+                'buckets': [0] * (len(self.BUCKETS) + 1),
+                'errors': {},
+                'retries': 0}
+        return self.operations[operation]
+
+    # records a call of the given operation
+    def observe(self, operation, seconds, byte_count=0):
+        with self.lock:
+            stats = self.get(operation)
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['bytes'] += byte_count
+            bucket = 0
+            while bucket < len(self.BUCKETS) and seconds > self.BUCKETS[bucket]:
+                bucket += 1
+            stats['buckets'][bucket] += 1
+
+    # records an exception raised by the given operation
+    def count_error(self, operation, err):
+        with self.lock:
+            errors = self.get(operation)['errors']
+            error_type = type(err).__name__
+            errors[error_type] = errors.get(error_type, 0) + 1
+
+    # records a retry of the given operation
+    def count_retry(self, operation):
+        with self.lock:
+            self.get(operation)['retries'] += 1
+
+    # returns the json run summary
+    def summary(self, counts=None):
+        with self.lock:
+            operations = {}
+            for operation, stats in sorted(self.operations.items()):
+                operations[operation] = {
+                    'calls': stats['calls'],
+                    'errors': dict(stats['errors']),
+                    'retries': stats['retries'],
+                    'bytes': stats['bytes'],
+                    'seconds': round(stats['seconds'], 3),
+                    'max_seconds': round(stats['max_seconds'], 3),
+                    'bytes_per_second': round(stats['bytes'] / stats['seconds'], 1) if stats['seconds'] else 0,
+                    'latency_buckets': [[bound, count] for bound, count in
+                                        zip(list(self.BUCKETS) + ['+Inf'], stats['buckets'])]}
+        return {
+            'labels': self.labels,
+            'started': start_time,
+            'updated': time.time(),
+            'runtime_seconds': round(time.time() - start_time, 3) if start_time else 0,
+            'counts': counts or {},
+            'operations': operations}
+
+    # returns the prometheus text exposition of the metrics
+    def prometheus_text(self, counts=None):
+        labels = ''.join(',{0}="{1}"'.format(k, escape_label_value(v)) for k, v in sorted(self.labels.items()))
+        lines = [
+            '# HELP updown_operation_calls_total Dropbox sync operations performed.',
+            '# TYPE updown_operation_calls_total counter',
+            '# HELP updown_operation_duration_seconds Dropbox sync operation latency.',
+            '# TYPE updown_operation_duration_seconds histogram',
+            '# HELP updown_operation_bytes_total Bytes transferred by dropbox sync operations.',
+            '# TYPE updown_operation_bytes_total counter',
+            '# HELP updown_operation_bytes_per_second Average throughput of dropbox sync operations.',
+            '# TYPE updown_operation_bytes_per_second gauge',
+            '# HELP updown_operation_errors_total Exceptions raised by dropbox sync operations.',
+            '# TYPE updown_operation_errors_total counter',
+            '# HELP updown_operation_retries_total Retried dropbox sync operations.',
+            '# TYPE updown_operation_retries_total counter']
+        with self.lock:
+            for operation, stats in sorted(self.operations.items()):
+                op = 'operation="{0}"{1}'.format(operation, labels)
+                lines.append('updown_operation_calls_total{%s} %d' % (op, stats['calls']))
+                cumulative = 0
+                for bound, count in zip(list(self.BUCKETS) + ['+Inf'], stats['buckets']):
+                    cumulative += count
+                    lines.append('updown_operation_duration_seconds_bucket{%s,le="%s"} %d' % (op, bound, cumulative))
+                lines.append('updown_operation_duration_seconds_sum{%s} %.6f' % (op, stats['seconds']))
+                lines.append('updown_operation_duration_seconds_count{%s} %d' % (op, stats['calls']))
+                lines.append('updown_operation_bytes_total{%s} %d' % (op, stats['bytes']))
+                lines.append('updown_operation_bytes_per_second{%s} %.1f' % (
+                    op, stats['bytes'] / stats['seconds'] if stats['seconds'] else 0))
+                for error_type, count in sorted(stats['errors'].items()):
+                    lines.append('updown_operation_errors_total{%s,exception="%s"} %d' % (op, error_type, count))
+                lines.append('updown_operation_retries_total{%s} %d' % (op, stats['retries']))
+        for name, value in sorted((counts or {}).items()):
+            lines.append('# TYPE updown_run_{0} gauge'.format(name))
+            lines.append('updown_run_{0}{{{1}}} {2}'.format(name, labels.lstrip(','), value))
+        lines.append('# TYPE updown_run_start_time_seconds gauge')
+        lines.append('updown_run_start_time_seconds{%s} %.3f' % (labels.lstrip(','), start_time or 0))
+        lines.append('# TYPE updown_last_update_time_seconds gauge')
+        lines.append('updown_last_update_time_seconds{%s} %.3f' % (labels.lstrip(','), time.time()))
+        return '\n'.join(lines) + '\n'
+
+    # writes the prometheus textfile (when configured) and the json run summary. Unless forced, writes are skipped when
+    # the last write was less than a minute ago so that long running modes can call this on every loop
+    def write(self, counts=None, force=False):
+        if not force and time.time() - self.last_write < 60:
+            return
+        self.last_write = time.time()
+        try:
+            if self.textfile:
+                write_file_atomically(self.textfile, self.prometheus_text(counts))
+            if log_filename:
+                write_file_atomically(os.path.splitext(log_filename)[0] + '.json',
+                                      json.dumps(self.summary(counts), indent=2, sort_keys=True))
+        except (OSError, IOError) as e:
+            print('*** Unable to write metrics', e)
+
+
+# escapes a prometheus label value
+def escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# writes the given text to a temporary file next to file_name and renames it into place so that readers such as the
+# node-exporter textfile collector never see a partial file
+def write_file_atomically(file_name, text):
+    temp_file_name = file_name + '.tmp'
+    with open(temp_file_name, 'w') as f:
+        f.write(text)
+    os.replace(temp_file_name, file_name)
+
+
+metrics = MetricsRegistry()
+progress = ProgressReporter()
+concurrency_limiter = ConcurrencyLimiter()
+transfer_schedulers = {'upload': TransferScheduler(1, 'upload'), 'download': TransferScheduler(1, 'download')}
+upload_buffer = MemoryBudget(64 * 1024 * 1024)
+upload_prefetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='upload_prefetch')
+bandwidth_limiter = BandwidthLimiter()
+content_hash_executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1,
+                                                              thread_name_prefix='content_hash')
 
 if __name__ == '__main__':
     main()